@@ -18,16 +18,15 @@ dir /ad %1 >nul 2>nul && goto DIR_ || call :Process %1 & goto End
 :DIR_
 set DIR=%~1
 echo DIR="%DIR%"
-::for /r "%DIR%" %%f in (*.*) do ( 
-for %%f in ("%DIR%\*.%EXT%") do ( 
-    rem echo %%f
-    call :Process "%%f"
-)
+::批量处理: 文件夹内所有文件由 bookmark_tool.py 在一个进程内并行处理, -cache 跳过输入未变化的文件
+python -m bookmark_tool -mode=format -i="%DIR%" -y -cache
+if not %errorlevel%==0 set exist_error=1
 goto End
 
 
 :Process
-python bookmark_tool.py -mode=format -i="%~dpn1.txt" -y
+::python -m 使用 __pycache__ 中编译好的模块, 每个文件一个进程时启动更快
+python -m bookmark_tool -mode=format -i="%~dpn1.txt" -y
 if not %errorlevel%==0 set exist_error=1
 goto:eof
 
@@ -19,18 +19,15 @@ dir /ad %1 >nul 2>nul && goto DIR_ || call :Process %1 & goto End
 :DIR_
 set DIR=%~1
 echo DIR="%DIR%"
-::for /r "%DIR%" %%f in (*.*) do ( 
-for %%f in ("%DIR%\*.%EXT%") do ( 
-    rem echo %%f
-    call :Process "%%f"
-)
+::批量处理: 文件夹内所有文件由 bookmark_tool.py 在一个进程内并行处理, -cache 跳过输入未变化的文件
+python -m bookmark_tool -mode=%MODE% -i="%DIR%" -bmk-out -y -cache
+if not %errorlevel%==0 set exist_error=1
 goto End
 
 
 :Process
-python bookmark_tool.py -mode=format -i="%~dpn1.txt" -y
-if not %errorlevel%==0 set exist_error=1
-python bookmark_tool.py -mode=add -i="%~dpn1.pdf" -bmk="%~dpn1.txt" -y
+::格式化后的书签直接在内存中添加到PDF, -bmk-out 同时保存格式化后的书签文件
+python -m bookmark_tool -mode=%MODE% -i="%~dpn1.pdf" -bmk="%~dpn1.txt" -bmk-out -y
 if not %errorlevel%==0 set exist_error=1
 goto:eof
 
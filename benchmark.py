@@ -0,0 +1,1066 @@
+import sys
+import os
+import re
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+
+from bookmark_tool import BookmarkNode, BookmarkFormatter, BookmarkConfig, Constant
+
+# 性能测试脚本, 例如:
+#   python benchmark.py parse -n 1000000
+#   python benchmark.py outline -n 1000000
+#   python benchmark.py memory -n 1000000
+#   python benchmark.py format -n 1000000
+#   python benchmark.py serve -n 100
+#   python benchmark.py startup
+#   python benchmark.py suite -o baseline.json
+#   python benchmark.py suite -baseline baseline.json -o results.json
+
+
+def generate_outline_lines(line_count, max_level=4, seed=0):
+    """Generate a formatted bookmark outline with line_count lines"""
+    rnd = random.Random(seed)
+    level = 0
+    page = 1
+    lines = []
+    for i in range(line_count):
+        level = rnd.randint(1, min(level + 1, max_level))
+        page += rnd.randint(0, 2)
+        lines.append(f'{Constant.MARK_LEVEL * (level - 1)}标题 Title {i}{Constant.MARK_PAGE}{page}\n')
+    return lines
+
+
+def generate_toc_lines(line_count, seed=0):
+    """Generate an unformatted (OCR like) table of contents with line_count lines"""
+    rnd = random.Random(seed)
+    chapter = section = sub_section = 0
+    page = 1
+    lines = []
+    for i in range(line_count):
+        page += rnd.randint(0, 2)
+        indent = ' ' * rnd.randint(0, 4)
+        sep = rnd.choice([' ', '  ', '\t', ' ...... '])
+        kind = rnd.random()
+        if kind < 0.05:
+            lines.append(f'{indent}前言 Preface {i}{sep}{page}\n')
+        elif kind < 0.15:
+            chapter += 1
+            section = sub_section = 0
+            lines.append(f'{indent}第{chapter}章 标题 Title {i}{sep}{page}\n')
+        elif kind < 0.5:
+            section += 1
+            sub_section = 0
+            lines.append(f'{indent}{chapter}.{section}标题 Title {i}{sep}{page}-{page + 1}\n')
+        elif kind < 0.9:
+            sub_section += 1
+            lines.append(f'{indent}{chapter}.{section}.{sub_section} 标题 Title {i}{sep}{page}\n')
+        else:
+            lines.append(f'{indent}{chapter}.{section}.{sub_section}.1 标题 Title {i}\n')
+    return lines
+
+
+def legacy_format_lines(bmk_text_lines):
+    """format_bookmark_file before the single-pass rule engine, kept for comparison"""
+    L = BookmarkConfig.get().mark_level_re
+    list_reg_patern = [
+        (r'^(%s|\s)*([^\d%s第])' % (L, L), r'\2'),
+        (r'^(%s|\s)*(第\d{1,}章)\s*(?=[^.])' % L, r'\2 '),
+        (r'^(%s|\s)*(第[一二三四五六七八九十〇IV]+章)\s*(?=[^.])' % L, r'\2 '),
+        (r'^(%s|\s)*(chapter\s*[\dIV]+)\s*(?=[^.])' % L, r'\2 '),
+        (r'^(%s|\s)*(\d{1,}\.?)\s*(?=[^\d.])' % L, r'\2 '),
+        (r'^(%s|\s)*(\d{1,}\.\d{1,})\s*(?=[^\d.])' % L, Constant.MARK_LEVEL + r'\2 '),
+        (r'^(%s|\s)*(第[一二三四五六七八九十IV]+节)\s*(?=[^.])' % L, Constant.MARK_LEVEL + r'\2 '),
+        (r'^(%s|\s)*(\d{1,}\.\d{1,}\.\d{1,})\s*(?=[^\d.])' % L, Constant.MARK_LEVEL*2 + r'\2 '),
+        (r'^(%s|\s)*(\d{1,}\.\d{1,}\.\d{1,}.\d{1,})\s*(?=[^\d.])' % L, Constant.MARK_LEVEL*3 + r'\2 '),
+        (r'(%s|\s)*(\d{1,})-?\d{0,}\s*\r?$' % BookmarkConfig.get().mark_page_re, Constant.MARK_PAGE + r'\2'),
+        (r'([^\d])(%s|\s)*$' % Constant.MARK_PAGE, r'\1' + Constant.MARK_PAGE),
+    ]
+    res_txt = ''.join(bmk_text_lines)
+    for reg_txt, rep_txt in list_reg_patern:
+        res_txt = re.sub(reg_txt, rep_txt, res_txt, flags=re.M)
+    return res_txt
+
+
+def legacy_load_from_text(root, bmk_text_lines):
+    """load_from_text before the single-pass parser, kept for comparison"""
+
+    def _make_up_parent_root(cur_level, cur_title, node_dict):
+        prev_level = cur_level - 1
+        if prev_level not in node_dict.keys():
+            _make_up_parent_root(prev_level, cur_title, node_dict)
+            node_dict[prev_level] = BookmarkNode(title='.'*5, level=prev_level)
+            node_dict[prev_level-1].add_child(node_dict[prev_level])
+
+    config = BookmarkConfig.get()
+    offset = 0
+    node_dict = {0: root}
+    for line in bmk_text_lines:
+        if line.strip().startswith('//'):
+            try:
+                offset = int(line[2:].strip()) - 1
+            except ValueError:
+                pass
+            continue
+        res = re.match(rf'^(({config.mark_level_re})*)(.*?)({config.mark_page_re})(\d*)', line)
+        if res:
+            level_mark, _, title, _, page_num = res.groups()
+            cur_level = len(level_mark) / len(Constant.MARK_LEVEL) + 1
+            if cur_level % 1:
+                raise ValueError('Bookmark file not be formated!')
+            page_num = int(page_num) + offset if page_num != '' else None
+            cur_node = BookmarkNode(level=cur_level, title=title, page_num=page_num)
+            _make_up_parent_root(cur_level, title, node_dict)
+            node_dict[cur_level - 1].add_child(cur_node)
+            node_dict[cur_level] = cur_node
+            for i_ in list(node_dict.keys()):
+                if i_ > cur_level:
+                    node_dict.pop(i_)
+
+
+def timeit(func, repeat):
+    """Return the best wall time of repeat runs and the last result"""
+    best = None
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start_time
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def print_result(name, elapsed, count, unit='lines'):
+    print(f'{name:<28}{elapsed:>10.3f} s{count / elapsed:>14,.0f} {unit}/s')
+
+
+def bench_parse(args):
+    lines = generate_outline_lines(args.n)
+    print(f'Outline lines: {len(lines):,}')
+
+    def _legacy():
+        root = BookmarkNode(title='Root')
+        legacy_load_from_text(root, lines)
+        return root
+
+    def _current():
+        root = BookmarkNode(title='Root')
+        root.load_from_text(lines)
+        return root
+
+    legacy_time, legacy_root = timeit(_legacy, args.repeat)
+    current_time, current_root = timeit(_current, args.repeat)
+    print_result('legacy load_from_text', legacy_time, len(lines))
+    print_result('load_from_text', current_time, len(lines))
+    print(f'Speedup: {legacy_time / current_time:.2f}x')
+
+    if legacy_root.convert_to_txt() != current_root.convert_to_txt():
+        print('ERROR: parse results differ!')
+        return 1
+    return 0
+
+
+def bench_outline(args):
+    """text -> PDF -> text round trip of a large outline"""
+    from pikepdf import Pdf
+
+    lines = generate_outline_lines(args.n, max_level=args.max_level)
+    tree = BookmarkNode(title='Root')
+    tree.load_from_text(lines)
+    page_count = max(node.page_num for node, _ in tree.walk())
+    print(f'Outline nodes: {args.n:,}, depth: {tree.get_depth()}, pages: {page_count:,}')
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, 'outline.pdf')
+
+        # text -> PDF
+        start_time = time.perf_counter()
+        tree = BookmarkNode(title='Root')
+        tree.load_from_text(lines)
+        parse_time = time.perf_counter() - start_time
+
+        pdf = Pdf.new()
+        for _ in range(page_count):
+            pdf.add_blank_page()
+        start_time = time.perf_counter()
+        tree.add_to_pdf(pdf)
+        add_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        pdf.save(pdf_path)
+        save_time = time.perf_counter() - start_time
+        pdf.close()
+
+        # PDF -> text
+        start_time = time.perf_counter()
+        pdf = Pdf.open(pdf_path)
+        loaded_tree = BookmarkNode(title='Root')
+        loaded_tree.load_from_pdf(pdf)
+        load_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        bookmark_txt = loaded_tree.convert_to_txt()
+        txt_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        loaded_tree.convert_to_json()
+        json_time = time.perf_counter() - start_time
+        pdf.close()
+
+    print('text -> PDF')
+    print_result('  load_from_text', parse_time, args.n, 'nodes')
+    print_result('  add_to_pdf', add_time, args.n, 'nodes')
+    print_result('  Pdf.save', save_time, args.n, 'nodes')
+    print('PDF -> text')
+    print_result('  load_from_pdf', load_time, args.n, 'nodes')
+    print_result('  convert_to_txt', txt_time, args.n, 'nodes')
+    print_result('  convert_to_json', json_time, args.n, 'nodes')
+
+    if bookmark_txt != tree.convert_to_txt():
+        print('ERROR: round trip results differ!')
+        return 1
+    return 0
+
+
+def bench_format(args):
+    lines = generate_toc_lines(args.n)
+    size = sum(len(line.encode('utf-8')) for line in lines)
+    print(f'TOC lines: {len(lines):,}, {size / 2**20:,.1f} MB')
+
+    formatter = BookmarkFormatter.get()
+    legacy_time, legacy_txt = timeit(lambda: legacy_format_lines(lines), args.repeat)
+    current_time, current_txt = timeit(lambda: ''.join(formatter.format_lines(lines)),
+                                       args.repeat)
+    print_result('legacy format', legacy_time, len(lines))
+    print_result('BookmarkFormatter', current_time, len(lines))
+    print(f'Throughput: {size / 2**20 / legacy_time:,.1f} MB/s -> '
+          f'{size / 2**20 / current_time:,.1f} MB/s, speedup: {legacy_time / current_time:.2f}x')
+
+    # 旧实现会吃掉文件末尾的换行
+    if legacy_txt.rstrip('\n') != current_txt.rstrip('\n'):
+        print('ERROR: format results differ!')
+        return 1
+    return 0
+
+
+def bench_serve(args):
+    """Latency of export jobs: new bookmark_tool.py processes vs the bookmark service"""
+    import json
+    import socket
+    import subprocess
+    import threading
+    from pikepdf import Pdf
+    from bookmark_server import BookmarkService, BookmarkTCPServer
+
+    tool_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bookmark_tool.py')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pdf_path = os.path.join(tmp_dir, 'outline.pdf')
+        tree = BookmarkNode(title='Root')
+        tree.load_from_text(generate_outline_lines(1000))
+        pdf = Pdf.new()
+        for _ in range(max(node.page_num for node, _ in tree.walk())):
+            pdf.add_blank_page()
+        tree.add_to_pdf(pdf)
+        pdf.save(pdf_path)
+        pdf.close()
+        argv = ['-mode', 'export', '-i', pdf_path, '-o', os.path.join(tmp_dir, 'outline.txt'), '-y']
+
+        process_count = min(args.n, 10)
+        start_time = time.perf_counter()
+        for _ in range(process_count):
+            subprocess.run([sys.executable, tool_path] + argv, stdout=subprocess.DEVNULL, check=True)
+        process_time = (time.perf_counter() - start_time) / process_count
+
+        service = BookmarkService()
+        server = BookmarkTCPServer(('127.0.0.1', 0), service)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        with socket.create_connection(server.server_address) as sock, sock.makefile('rwb') as f:
+            def _request():
+                f.write(json.dumps({'argv': argv}).encode('utf-8') + b'\n')
+                f.flush()
+                return json.loads(f.readline())
+
+            _request()
+            start_time = time.perf_counter()
+            for _ in range(args.n):
+                response = _request()
+            service_time = (time.perf_counter() - start_time) / args.n
+        server.shutdown()
+        server.server_close()
+        service.pdf_pool.close()
+
+    print(f'bookmark_tool.py process     {process_time * 1000:>10.1f} ms/job')
+    print(f'bookmark service             {service_time * 1000:>10.1f} ms/job')
+    print(f'Speedup: {process_time / service_time:.1f}x')
+    return 0 if response['status'] == 0 else 1
+
+
+def bench_batch(args):
+    """Batch add on a folder of synthetic pdfs: process pool vs -pipeline (-dir: e.g. a network mount)"""
+    import shutil
+    import subprocess
+
+    tool_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bookmark_tool.py')
+    case = {'name': 'batch', 'pages': args.pages, 'nodes': args.nodes, 'max_level': 4, 'named': False}
+    tmp_dir = tempfile.mkdtemp(prefix='bookmark_batch_', dir=args.dir)
+    try:
+        in_dir = os.path.join(tmp_dir, 'in')
+        os.makedirs(in_dir)
+        lines = generate_case_lines(case['nodes'], case['pages'], case['max_level'])
+        first_pdf = os.path.join(in_dir, '0000.pdf')
+        generate_case_pdf(first_pdf, case, lines)
+        for i in range(args.n):
+            if i:
+                shutil.copyfile(first_pdf, os.path.join(in_dir, f'{i:04d}.pdf'))
+            with open(os.path.join(in_dir, f'{i:04d}.txt'), 'w', encoding='utf-8') as f:
+                f.writelines(lines)
+
+        runs = [('process pool', []), ('pipeline', ['-pipeline', '-queue-depth', str(args.queue_depth),
+                                                     '-io-workers', str(args.io_workers)])]
+        times = {}
+        for name, options in runs:
+            argv = ['-mode', 'add', '-i', in_dir, '-o', os.path.join(tmp_dir, 'out'), '-y'] + options
+            best = None
+            for _ in range(args.repeat):
+                start_time = time.perf_counter()
+                output = subprocess.run([sys.executable, tool_path] + argv, check=True,
+                                        capture_output=True, text=True).stdout
+                elapsed = time.perf_counter() - start_time
+                best = elapsed if best is None else min(best, elapsed)
+            times[name] = best
+            print(f'{name:<28}{best:>10.3f} s{args.n / best:>10.1f} files/s')
+            if options:
+                # 流水线各阶段的利用率
+                print(''.join(line + '\n' for line in output.splitlines()
+                              if line.split()[:1] in (['stage'], ['read'], ['build'], ['write'])), end='')
+        print(f'Speedup: {times["process pool"] / times["pipeline"]:.2f}x')
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+    return 0
+
+
+def bench_index(args):
+    """Outline index of a folder of synthetic pdfs: initial build, update without changes, search"""
+    import shutil
+    from bookmark_tool import OutlineIndex
+
+    case = {'name': 'index', 'pages': 200, 'nodes': args.nodes, 'max_level': 4, 'named': False}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        lib_dir = os.path.join(tmp_dir, 'lib')
+        templates = []
+        for seed in range(min(args.n, 20)):
+            # 不同的模板使用不同的标题编号, 搜索结果只来自部分文件
+            lines = [line.replace('Title ', f'Title {seed}-')
+                     for line in generate_case_lines(case['nodes'], case['pages'], case['max_level'], seed)]
+            template = os.path.join(tmp_dir, f'template{seed}.pdf')
+            generate_case_pdf(template, case, lines)
+            templates.append(template)
+        for i in range(args.n):
+            sub_dir = os.path.join(lib_dir, f'{i // 1000:03d}')
+            os.makedirs(sub_dir, exist_ok=True)
+            shutil.copyfile(templates[i % len(templates)], os.path.join(sub_dir, f'{i:06d}.pdf'))
+
+        db_path = os.path.join(tmp_dir, 'index.db')
+        index = OutlineIndex(db_path)
+        start_time = time.perf_counter()
+        index.update(lib_dir, args.jobs, args.backend, log=lambda *a, **k: None)
+        print_result('index build', time.perf_counter() - start_time, args.n, 'files')
+        start_time = time.perf_counter()
+        files, extracted, _, _ = index.update(lib_dir, args.jobs, args.backend, log=lambda *a, **k: None)
+        print_result('index update (no change)', time.perf_counter() - start_time, files, 'files')
+
+        queries = ['Title 7-12', 'itle 3-45', '标题 Title 1-', 'no such title', '标题 9-1', '标题', '无题']
+        for query in queries:
+            elapsed, rows = timeit(lambda: index.search(query, 50), args.repeat)
+            print(f'search {query!r:<22}{elapsed * 1000:>10.2f} ms{len(rows):>8} results')
+        stats = index.stats()
+        index.close()
+        print(f'{stats["files"]} files, {stats["bookmarks"]} bookmarks, '
+              f'index {os.path.getsize(db_path) / 2**20:.1f} MB')
+    return 0 if extracted == 0 else 1
+
+
+def parse_importtime(stderr):
+    """[(module, self us, cumulative us, depth)] of python -X importtime output, in output order"""
+    modules = []
+    for line in stderr.splitlines():
+        res = re.match(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)', line)
+        if res:
+            modules.append((res.group(4), int(res.group(1)), int(res.group(2)),
+                            (len(res.group(3)) + 1) // 2))
+    return modules
+
+
+def direct_imports(modules, name):
+    """Modules imported by module name itself, they are listed before it one level deeper"""
+    index = [module[0] for module in modules].index(name)
+    depth = modules[index][3]
+    children = []
+    for module in reversed(modules[:index]):
+        if module[3] <= depth:
+            break
+        if module[3] == depth + 1:
+            children.append(module)
+    return children
+
+
+def bench_startup(args):
+    """Import time of bookmark_tool and process start up time of the text only modes"""
+    import subprocess
+
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    tool_path = os.path.join(package_dir, 'bookmark_tool.py')
+
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import bookmark_tool'],
+                            cwd=package_dir, capture_output=True, text=True, check=True)
+    modules = parse_importtime(result.stderr)
+    name, self_time, total_time, _ = [module for module in modules if module[0] == 'bookmark_tool'][0]
+    print(f'import bookmark_tool: {total_time / 1000:.1f} ms, module itself {self_time / 1000:.1f} ms')
+    for name, _, total_time, _ in sorted(direct_imports(modules, 'bookmark_tool'),
+                                         key=lambda module: -module[2])[:8]:
+        print(f'  {name:<30}{total_time / 1000:>8.1f} ms')
+
+    status = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        toc_path = os.path.join(tmp_dir, 'toc.txt')
+        json_path = os.path.join(tmp_dir, 'outline.json')
+        with open(toc_path, 'w', encoding='utf-8') as f:
+            f.writelines(generate_toc_lines(200))
+        tree = BookmarkNode(title='Root')
+        tree.load_from_text(generate_outline_lines(200))
+        with open(json_path, 'w', encoding='utf-8') as f:
+            f.write(tree.convert_to_json())
+
+        commands = [
+            ('python -c pass', ['-c', 'pass']),
+            ('bookmark_tool.py -h', [tool_path, '-h']),
+            ('-m bookmark_tool -h', ['-m', 'bookmark_tool', '-h']),
+            ('-m bookmark_tool format', ['-m', 'bookmark_tool', '-mode', 'format', '-i', toc_path,
+                                         '-o', os.path.join(tmp_dir, 'out.txt'), '-y']),
+            ('-m bookmark_tool json->txt', ['-m', 'bookmark_tool', '-mode', 'export', '-i', json_path,
+                                            '-o', os.path.join(tmp_dir, 'out2.txt'), '-y']),
+        ]
+        print(f'Process start up, best of {args.n} runs:')
+        for name, argv in commands:
+            elapsed, _ = timeit(lambda: subprocess.run([sys.executable] + argv, cwd=package_dir,
+                                                       stdout=subprocess.DEVNULL, check=True), args.n)
+            print(f'  {name:<30}{elapsed * 1000:>8.1f} ms')
+
+            # 纯文本模式和 --help 不应加载 pikepdf
+            if name != 'python -c pass':
+                result = subprocess.run([sys.executable, '-X', 'importtime'] + argv, cwd=package_dir,
+                                        stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                                        text=True, check=True)
+                if any(module[0] == 'pikepdf' for module in parse_importtime(result.stderr)):
+                    print(f'ERROR: {name} imports pikepdf')
+                    status = 1
+    return status
+
+
+def bench_memory(args):
+    """Memory used by a parsed bookmark tree"""
+    lines = generate_outline_lines(args.n)
+
+    tracemalloc.start()
+    start_size = tracemalloc.get_traced_memory()[0]
+    tree = BookmarkNode(title='Root')
+    tree.load_from_text(lines)
+    tree_size = tracemalloc.get_traced_memory()[0] - start_size
+    tracemalloc.stop()
+
+    print(f'Outline nodes: {args.n:,}')
+    print(f'Tree memory: {tree_size / 2**20:,.1f} MB, {tree_size / args.n:,.1f} bytes/node')
+    return 0
+
+
+# 回归测试用例: 页数, 书签数, 最大层级, 是否使用命名目标, 未格式化书签文件的行数
+SUITE_CASES = [
+    {'name': 'small', 'pages': 200, 'nodes': 500, 'max_level': 3, 'named': False, 'toc_lines': 1000},
+    {'name': 'explicit', 'pages': 5000, 'nodes': 20000, 'max_level': 4, 'named': False,
+     'toc_lines': 20000},
+    {'name': 'named', 'pages': 5000, 'nodes': 20000, 'max_level': 4, 'named': True,
+     'toc_lines': 20000},
+    {'name': 'deep', 'pages': 1000, 'nodes': 5000, 'max_level': 1000, 'named': False,
+     'toc_lines': 5000},
+    {'name': 'large', 'pages': 20000, 'nodes': 200000, 'max_level': 5, 'named': False,
+     'toc_lines': 500000},
+]
+
+SUITE_STAGES = ('load_from_pdf', 'convert_to_txt', 'convert_to_json', 'load_from_text',
+                'format_bookmark_file', 'add_to_pdf', 'write_to_pdf')
+
+# 每个阶段至少测量的总时间和最多的次数, 几毫秒的阶段单次测量的波动会超过回归阈值
+SUITE_MIN_TIME = 0.5
+SUITE_MAX_RUNS = 200
+# 字符串哈希的随机种子改变字典的布局, 同一阶段在不同进程中的耗时可以相差一半, suite 固定种子运行
+SUITE_HASH_SEED = '0'
+
+
+def generate_case_lines(node_count, page_count, max_level, seed=0):
+    """
+    Formatted bookmark lines of node_count nodes spread over page_count pages.
+    A max_level above 10 makes chains that go down to max_level and back up
+    """
+    rnd = random.Random(seed)
+    level = 0
+    lines = []
+    for i in range(node_count):
+        if max_level > 10:
+            level = level + 1 if level < max_level else 1
+        else:
+            level = rnd.randint(1, min(level + 1, max_level))
+        page = 1 + i * page_count // node_count
+        lines.append(f'{Constant.MARK_LEVEL * (level - 1)}标题 Title {i}{Constant.MARK_PAGE}{page}\n')
+    return lines
+
+
+def generate_case_pdf(pdf_path, case, lines):
+    """Synthetic pdf of a suite case: a small content stream per page and the outline of lines"""
+    from pikepdf import Pdf, Array, Dictionary, String
+
+    pdf = Pdf.new()
+    for page_num in range(1, case['pages'] + 1):
+        pdf.add_blank_page()
+    for page_num, page in enumerate(pdf.pages, 1):
+        page.obj.Contents = pdf.make_stream(
+            f'BT /F1 12 Tf 72 720 Td (Page {page_num}) Tj ET'.encode('ascii'))
+
+    tree = BookmarkNode(title='Root')
+    tree.load_from_text(lines)
+    tree.add_to_pdf(pdf)
+
+    if case['named']:
+        # 目标改为命名目标, 放在 /Names /Dests 名称树中, 每个叶节点 64 个名称
+        dests = []
+        items = [pdf.Root.Outlines.First]
+        while items:
+            item = items.pop()
+            name = f'd{len(dests):08d}'
+            dests.append((name, item.Dest))
+            item.Dest = String(name)
+            if '/Next' in item:
+                items.append(item.Next)
+            if '/First' in item:
+                items.append(item.First)
+        dests.sort()
+        kids = []
+        for start in range(0, len(dests), 64):
+            chunk = dests[start:start + 64]
+            names = Array()
+            for name, dest in chunk:
+                names.append(String(name))
+                names.append(dest)
+            kids.append(pdf.make_indirect(Dictionary(
+                Names=names, Limits=Array([String(chunk[0][0]), String(chunk[-1][0])]))))
+        pdf.Root.Names = Dictionary(Dests=pdf.make_indirect(Dictionary(Kids=Array(kids))))
+
+    pdf.save(pdf_path)
+    pdf.close()
+
+
+def current_rss():
+    """Resident set size of this process in bytes, None if not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
+class RssSampler(object):
+    """在后台线程中定时读取 RSS, 记录一段代码运行期间的峰值"""
+
+    def __init__(self, interval=0.002):
+        import threading
+        self.interval = interval
+        self.start_rss = self.peak_rss = current_rss()
+        self.__stop = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+
+    def __run(self):
+        while not self.__stop.wait(self.interval):
+            self.__sample()
+
+    def __sample(self):
+        rss = current_rss()
+        if rss is not None and rss > self.peak_rss:
+            self.peak_rss = rss
+
+    def __enter__(self):
+        if self.start_rss is not None:
+            self.__thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.start_rss is not None:
+            self.__stop.set()
+            self.__thread.join()
+            self.__sample()
+
+
+def measure_stage(setup, func, repeat, teardown=None, min_time=0, max_runs=SUITE_MAX_RUNS):
+    """
+    Run func(setup()) at least repeat times, and until the measured runs add up to min_time
+    (at most max_runs), only func is measured. teardown(state) releases the state of each run.
+    Return {'time': median wall time, 'best', 'runs', 'peak_rss',
+    'rss_delta': median of the peak above the start, 'bytes'}, bytes is the return value of func
+    """
+    import gc
+    import statistics
+
+    result = {'time': None, 'best': None, 'runs': 0, 'peak_rss': None, 'rss_delta': None, 'bytes': None}
+    times = []
+    rss_deltas = []
+    while len(times) < repeat or (sum(times) < min_time and len(times) < max_runs):
+        state = setup()
+        gc.collect()
+        try:
+            with RssSampler() as sampler:
+                start_time = time.perf_counter()
+                bytes_written = func(state)
+                elapsed = time.perf_counter() - start_time
+        finally:
+            if teardown is not None:
+                teardown(state)
+        del state
+
+        times.append(elapsed)
+        if sampler.peak_rss is not None:
+            result['peak_rss'] = max(result['peak_rss'] or 0, sampler.peak_rss)
+            rss_deltas.append(sampler.peak_rss - sampler.start_rss)
+        result['bytes'] = bytes_written
+    result.update(time=statistics.median(times), best=min(times), runs=len(times))
+    if rss_deltas:
+        result['rss_delta'] = statistics.median(rss_deltas)
+    return result
+
+
+def run_suite_case(case, tmp_dir, repeat):
+    """Generate the files of a case, return {stage: measurement}"""
+    from pikepdf import Pdf
+    from bookmark_tool import MyPDFHandler
+
+    pdf_path = os.path.join(tmp_dir, f'{case["name"]}.pdf')
+    bmk_path = os.path.join(tmp_dir, f'{case["name"]}.txt')
+    toc_path = os.path.join(tmp_dir, f'{case["name"]}_toc.txt')
+    out_path = os.path.join(tmp_dir, f'{case["name"]}_out')
+
+    lines = generate_case_lines(case['nodes'], case['pages'], case['max_level'])
+    generate_case_pdf(pdf_path, case, lines)
+    with open(bmk_path, 'w', encoding='utf-8') as f:
+        f.writelines(lines)
+    with open(toc_path, 'w', encoding='utf-8') as f:
+        f.writelines(generate_toc_lines(case['toc_lines']))
+
+    def _open():
+        return Pdf.open(pdf_path)
+
+    def _close(pdf):
+        pdf.close()
+
+    def _load_from_pdf(pdf):
+        BookmarkNode(title='Root').load_from_pdf(pdf)
+
+    def _loaded_tree():
+        tree = BookmarkNode(title='Root')
+        tree.load_from_txt(bmk_path)
+        return tree
+
+    def _pdf_without_outline():
+        pdf = Pdf.open(pdf_path)
+        del pdf.Root.Outlines
+        return pdf, _loaded_tree()
+
+    def _add_to_pdf(state):
+        pdf, tree = state
+        tree.add_to_pdf(pdf)
+
+    def _handler_with_outline():
+        handler = MyPDFHandler(pdf_path)
+        handler.generate_bookmark_tree(bmk_path)
+        handler.remove_bookmarks()
+        handler.add_bookmarks_to_pdf()
+        return handler
+
+    # (setup, 测量的函数, teardown)
+    stages = {
+        'load_from_pdf': (_open, _load_from_pdf, _close),
+        'convert_to_txt': (_loaded_tree, lambda tree: len(tree.convert_to_txt().encode('utf-8')), None),
+        'convert_to_json': (_loaded_tree, lambda tree: len(tree.convert_to_json().encode('utf-8')), None),
+        'load_from_text': (lambda: lines, lambda lines: BookmarkNode(title='Root').load_from_text(lines),
+                           None),
+        'format_bookmark_file': (
+            lambda: None,
+            lambda _: MyPDFHandler.format_bookmark_file(toc_path, out_path + '.txt')
+            or os.path.getsize(out_path + '.txt'), None),
+        'add_to_pdf': (_pdf_without_outline, _add_to_pdf, lambda state: _close(state[0])),
+        'write_to_pdf': (_handler_with_outline,
+                         lambda handler: handler.write_to_pdf(out_path + '.pdf')[1],
+                         lambda handler: handler.close()),
+    }
+    results = {}
+    for stage in SUITE_STAGES:
+        setup, func, teardown = stages[stage]
+        results[stage] = measure_stage(setup, func, repeat, teardown, SUITE_MIN_TIME)
+    return results
+
+
+def compare_results(results, baseline, threshold, rss_threshold, min_time=0.01, min_rss=8 * 2**20):
+    """
+    Print the changes against the baseline results, return the regressions: stages whose median
+    and best time both got slower than threshold (a ratio, 0.2 for 20%), or that used more memory
+    than rss_threshold. Times below min_time and memory below min_rss are too noisy to compare
+    """
+    regressions = []
+    print(f'{"case/stage":<34}{"baseline":>10}{"current":>10}{"change":>9}'
+          f'{"base MB":>10}{"cur MB":>9}')
+    for name, stages in results['cases'].items():
+        base_case = baseline.get('cases', {}).get(name, {})
+        if base_case.get('params', stages['params']) != stages['params']:
+            print(f'{name:<34}parameters differ from the baseline, skipped')
+            continue
+        base_stages = base_case.get('stages', {})
+        for stage, current in stages['stages'].items():
+            base = base_stages.get(stage)
+            if base is None:
+                continue
+            flags = []
+            change = current['time'] / base['time'] - 1 if base['time'] else 0.0
+            best_change = current['best'] / base['best'] - 1 if base['best'] else 0.0
+            # 其他进程的干扰使中位数偏高, 最短时间也变慢才是回归
+            if max(base['time'], current['time']) >= min_time and min(change, best_change) > threshold:
+                flags.append('time')
+            base_rss, cur_rss = base.get('rss_delta'), current.get('rss_delta')
+            if base_rss is not None and cur_rss is not None and \
+                    cur_rss > max(base_rss * (1 + rss_threshold), base_rss + min_rss):
+                flags.append('memory')
+            if flags:
+                regressions.append((name, stage, flags))
+
+            base_mb = f'{base_rss / 2**20:.1f}' if base_rss is not None else '-'
+            cur_mb = f'{cur_rss / 2**20:.1f}' if cur_rss is not None else '-'
+            print(f'{name + "/" + stage:<34}{base["time"]:>10.3f}{current["time"]:>10.3f}'
+                  f'{change:>+9.0%}{base_mb:>10}{cur_mb:>9}'
+                  f'{"  REGRESSION: " + ", ".join(flags) if flags else ""}')
+    return regressions
+
+
+def bench_suite(args):
+    """Every stage on synthetic pdfs, results saved as JSON and compared with a baseline"""
+    import json
+    import platform
+    import pikepdf
+
+    if os.environ.get('PYTHONHASHSEED') != SUITE_HASH_SEED:
+        import subprocess
+        env = dict(os.environ, PYTHONHASHSEED=SUITE_HASH_SEED)
+        # orig_argv 包括 -X 等解释器选项 (Python 3.10+)
+        argv = sys.orig_argv[1:] if hasattr(sys, 'orig_argv') else sys.argv
+        return subprocess.run([sys.executable] + argv, env=env).returncode
+
+    cases = [dict(case) for case in SUITE_CASES if not args.case or case['name'] in args.case]
+    for case in cases:
+        for key in ('pages', 'nodes', 'toc_lines'):
+            case[key] = max(1, int(case[key] * args.scale))
+
+    results = {
+        # 版本 2: time 和 rss_delta 是中位数, 版本 1 是最短时间和最大值
+        'version': 2,
+        'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'pikepdf': pikepdf.__version__,
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'hash_seed': SUITE_HASH_SEED,
+        'cases': {},
+    }
+    print(f'{"case/stage":<34}{"time s":>10}{"peak MB":>10}{"+MB":>8}{"bytes":>14}')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for case in cases:
+            stages = run_suite_case(case, tmp_dir, args.repeat)
+            results['cases'][case['name']] = {'params': case, 'stages': stages}
+            for stage, result in stages.items():
+                peak = f'{result["peak_rss"] / 2**20:.1f}' if result['peak_rss'] is not None else '-'
+                delta = f'{result["rss_delta"] / 2**20:.1f}' if result['rss_delta'] is not None else '-'
+                size = f'{result["bytes"]:,}' if result['bytes'] is not None else ''
+                print(f'{case["name"] + "/" + stage:<34}{result["time"]:>10.3f}{peak:>10}{delta:>8}{size:>14}')
+
+    if args.o:
+        with open(args.o, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+        print(f'Results saved: {args.o}')
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print(f'\nBaseline: {args.baseline} ({baseline.get("time")})')
+        if baseline.get('version') != results['version']:
+            print(f'Baseline has version {baseline.get("version")}, expected {results["version"]}: '
+                  f'record it again')
+            return 1
+        regressions = compare_results(results, baseline, args.threshold, args.rss_threshold)
+        if regressions:
+            print(f'{len(regressions)} regressions above the threshold')
+            return 1
+        print('No regressions')
+    return 0
+
+
+def outline_counts(pdf):
+    """/Count of the outline root and of every outline item, in /First /Next order"""
+    outlines = pdf.Root.get('/Outlines')
+    if outlines is None:
+        return []
+    counts = [int(outlines.get('/Count', 0))]
+    stack = [outlines.get('/First')]
+    while stack:
+        item = stack.pop()
+        if item is None:
+            continue
+        counts.append(int(item.get('/Count', 0)))
+        stack.append(item.get('/Next'))
+        stack.append(item.get('/First'))
+    return counts
+
+
+def bench_backends(args):
+    """Parity and speed of the outline backends: every backend reads and writes the same trees"""
+    from pikepdf import Pdf
+    from bookmark_tool import OutlineBackend
+
+    backends = sorted(OutlineBackend.BACKENDS)
+    cases = [dict(case) for case in SUITE_CASES
+             if (args.case and case['name'] in args.case) or (not args.case and case['name'] != 'large')]
+    for case in cases:
+        for key in ('pages', 'nodes'):
+            case[key] = max(1, int(case[key] * args.scale))
+
+    mismatches = []
+    print(f'{"case/stage":<28}' + ''.join(f'{name + " s":>12}' for name in backends))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for case in cases:
+            pdf_path = os.path.join(tmp_dir, f'{case["name"]}.pdf')
+            lines = generate_case_lines(case['nodes'], case['pages'], case['max_level'])
+            generate_case_pdf(pdf_path, case, lines)
+            expected = BookmarkNode(title='Root')
+            expected.load_from_text(lines)
+            expected_txt = expected.convert_to_txt()
+            twice = BookmarkNode(title='Root')
+            twice.load_from_text(lines + lines)
+            twice_txt = twice.convert_to_txt()
+
+            def _read(pdf, backend):
+                tree = BookmarkNode(title='Root')
+                tree.load_from_pdf(pdf, backend)
+                return tree.convert_to_txt()
+
+            def _pdf_without_outline():
+                pdf = Pdf.open(pdf_path)
+                del pdf.Root.Outlines
+                return pdf
+
+            read_times, write_times = [], []
+            written = {}
+            for backend in backends:
+                with Pdf.open(pdf_path) as pdf:
+                    if _read(pdf, backend) != expected_txt:
+                        mismatches.append(f'{case["name"]}: {backend} read')
+                read_times.append(measure_stage(
+                    lambda: Pdf.open(pdf_path),
+                    lambda pdf: BookmarkNode(title='Root').load_from_pdf(pdf, backend),
+                    args.repeat, lambda pdf: pdf.close())['best'])
+                write_times.append(measure_stage(
+                    _pdf_without_outline, lambda pdf: expected.add_to_pdf(pdf, backend),
+                    args.repeat, lambda pdf: pdf.close())['best'])
+
+                # 写入两次并保存, 由每个后端重新读取, 第二次检查追加到已有大纲
+                out_path = os.path.join(tmp_dir, f'{case["name"]}_{backend}.pdf')
+                pdf = _pdf_without_outline()
+                expected.add_to_pdf(pdf, backend)
+                expected.add_to_pdf(pdf, backend)
+                pdf.save(out_path)
+                pdf.close()
+                with Pdf.open(out_path) as pdf:
+                    written[backend] = outline_counts(pdf)
+                    for reader in backends:
+                        if _read(pdf, reader) != twice_txt:
+                            mismatches.append(f'{case["name"]}: written by {backend}, read by {reader}')
+
+            for backend in backends[1:]:
+                if written[backend] != written[backends[0]]:
+                    mismatches.append(f'{case["name"]}: /Count of {backend} and {backends[0]}')
+
+            print(f'{case["name"] + "/read":<28}' + ''.join(f'{t:>12.3f}' for t in read_times))
+            print(f'{case["name"] + "/write":<28}' + ''.join(f'{t:>12.3f}' for t in write_times))
+
+    for mismatch in mismatches:
+        print(f'MISMATCH {mismatch}')
+    if mismatches:
+        return 1
+    print(f'{len(cases)} cases, backends identical')
+    return 0
+
+
+def bench_labels(args):
+    """Page label index: labels of every page and pages of every label, checked against a linear scan"""
+    import pikepdf
+    from bookmark_tool import PageLabels
+
+    styles = [('r', ''), ('D', ''), ('D', 'A-'), ('R', 'Part '), ('a', ''), ('D', '')]
+    pdf = pikepdf.new()
+    for _ in range(args.pages):
+        pdf.add_blank_page()
+    # 每 -range-pages 页一个区间, 十进制区间的编号从 1 重新开始
+    ranges = []
+    nums = pikepdf.Array()
+    for i, start in enumerate(range(0, args.pages, args.range_pages)):
+        style, prefix = styles[i % len(styles)]
+        first = 1 if style == 'D' else i + 1
+        ranges.append((start, style, prefix, first))
+        nums.extend([start, pikepdf.Dictionary(S=pikepdf.Name('/' + style),
+                                               P=pikepdf.String(prefix), St=first)])
+    # 每个叶子最多 64 个区间, 与常见的生成器相同
+    leaves = [pdf.make_indirect(pikepdf.Dictionary(Nums=pikepdf.Array(list(nums)[n:n + 128])))
+              for n in range(0, len(nums), 128)]
+    pdf.Root.PageLabels = pikepdf.Dictionary(Kids=pikepdf.Array(leaves))
+
+    def linear_label(page_index):
+        start, style, prefix, first = [r for r in ranges if r[0] <= page_index][-1]
+        return prefix + PageLabels.format_number(first + page_index - start, style)
+
+    def linear_page_index(label, near):
+        found = [i for i, other in enumerate(expected) if other == label]
+        return min((i for i in found if i >= near), default=min(found, default=None))
+
+    expected = [linear_label(i) for i in range(args.pages)]
+    page_labels = PageLabels(pdf)
+    start_time = time.perf_counter()
+    len(page_labels)
+    print_result('decode /PageLabels', time.perf_counter() - start_time, len(ranges), 'ranges')
+
+    pages = range(args.pages)
+    elapsed, labels = timeit(lambda: [page_labels.label(i) for i in pages], args.repeat)
+    print_result('page -> label', elapsed, args.pages, 'pages')
+    elapsed, indexes = timeit(lambda: [page_labels.page_index(label, i)
+                                       for i, label in enumerate(labels)], args.repeat)
+    print_result('label -> page', elapsed, args.pages, 'labels')
+
+    sample = pages[::max(1, args.pages // 200)]
+    elapsed, _ = timeit(lambda: [linear_page_index(labels[i], i) for i in sample], 1)
+    print_result('label -> page, linear scan', elapsed, len(sample), 'labels')
+
+    failed = [i for i in pages if labels[i] != expected[i] or indexes[i] != i]
+    failed += [i for i in sample if linear_page_index(labels[i], 0) != page_labels.page_index(labels[i])]
+    print(f'Parity with the linear scan: {"OK" if not failed else f"{len(failed)} pages differ"}')
+    return 1 if failed else 0
+
+
+def get_cmd_args():
+    parser = argparse.ArgumentParser(description='pdf bookmark tool benchmarks.')
+    subparsers = parser.add_subparsers(dest='bench', required=True)
+
+    parser_parse = subparsers.add_parser('parse', help='text bookmark parser')
+    parser_parse.add_argument('-n', type=int, default=1000000,
+                              help='number of outline lines.')
+    parser_parse.set_defaults(func=bench_parse)
+
+    parser_outline = subparsers.add_parser('outline', help='outline text <-> PDF round trip')
+    parser_outline.add_argument('-n', type=int, default=1000000,
+                                help='number of outline nodes.')
+    parser_outline.add_argument('-max-level', dest='max_level', type=int, default=4,
+                                help='max bookmark level of the generated outline.')
+    parser_outline.set_defaults(func=bench_outline, repeat=1)
+
+    parser_format = subparsers.add_parser('format', help='bookmark file formatter')
+    parser_format.add_argument('-n', type=int, default=1000000,
+                               help='number of table of contents lines.')
+    parser_format.set_defaults(func=bench_format)
+
+    parser_serve = subparsers.add_parser('serve', help='job latency of the bookmark service')
+    parser_serve.add_argument('-n', type=int, default=100,
+                              help='number of jobs.')
+    parser_serve.set_defaults(func=bench_serve, repeat=1)
+
+    parser_batch = subparsers.add_parser(
+        'batch', help='batch add on a folder of pdfs: process pool vs -pipeline')
+    parser_batch.add_argument('-n', type=int, default=50,
+                              help='number of pdf files.')
+    parser_batch.add_argument('-pages', type=int, default=500,
+                              help='pages of each pdf.')
+    parser_batch.add_argument('-nodes', type=int, default=2000,
+                              help='bookmarks of each pdf.')
+    parser_batch.add_argument('-dir', help='create the files in this folder (e.g. on network storage), '
+                                           'default the temp folder.')
+    parser_batch.add_argument('-queue-depth', dest='queue_depth', type=int, default=4,
+                              help='-queue-depth of the pipeline run.')
+    parser_batch.add_argument('-io-workers', dest='io_workers', type=int, default=4,
+                              help='-io-workers of the pipeline run.')
+    parser_batch.set_defaults(func=bench_batch, repeat=1)
+
+    parser_index = subparsers.add_parser(
+        'index', help='outline index: build, update and search a folder of pdfs')
+    parser_index.add_argument('-n', type=int, default=2000,
+                              help='number of pdf files.')
+    parser_index.add_argument('-nodes', type=int, default=200,
+                              help='bookmarks of each pdf.')
+    parser_index.add_argument('-j', dest='jobs', type=int, default=0,
+                              help='extraction worker processes, default cpu count.')
+    parser_index.add_argument('-backend', default=Constant.DEFAULT_BACKEND,
+                              help='outline backend of the extraction.')
+    parser_index.set_defaults(func=bench_index)
+
+    parser_startup = subparsers.add_parser(
+        'startup', help='import time (python -X importtime) and start up time of text only modes')
+    parser_startup.add_argument('-n', type=int, default=10,
+                                help='number of runs of each command.')
+    parser_startup.set_defaults(func=bench_startup, repeat=1)
+
+    parser_memory = subparsers.add_parser('memory', help='memory of a parsed bookmark tree')
+    parser_memory.add_argument('-n', type=int, default=1000000,
+                               help='number of outline nodes.')
+    parser_memory.set_defaults(func=bench_memory)
+
+    parser_suite = subparsers.add_parser(
+        'suite', help='regression suite: every stage on synthetic pdfs, compared with a baseline')
+    parser_suite.add_argument('-case', action='append',
+                              choices=[case['name'] for case in SUITE_CASES],
+                              help='run only this case, can be given several times.')
+    parser_suite.add_argument('-scale', type=float, default=1.0,
+                              help='multiply the pages, bookmarks and bookmark file lines of the cases.')
+    parser_suite.add_argument('-o', help='save the results to this JSON file.')
+    parser_suite.add_argument('-baseline', help='JSON results of an earlier run to compare with, '
+                                                'exit status 1 on regressions.')
+    parser_suite.add_argument('-threshold', type=float, default=0.25,
+                              help='allowed slowdown against the baseline, default 0.25 (25%%).')
+    parser_suite.add_argument('-rss-threshold', dest='rss_threshold', type=float, default=0.25,
+                              help='allowed growth of the peak memory of a stage, default 0.25.')
+    parser_suite.set_defaults(func=bench_suite)
+
+    parser_backends = subparsers.add_parser(
+        'backends', help='outline backends: identical trees read and written, and their speed')
+    parser_backends.add_argument('-case', action='append',
+                                 choices=[case['name'] for case in SUITE_CASES],
+                                 help='run only this case, default all but large.')
+    parser_backends.add_argument('-scale', type=float, default=1.0,
+                                 help='multiply the pages and bookmarks of the cases.')
+    parser_backends.set_defaults(func=bench_backends)
+
+    parser_labels = subparsers.add_parser(
+        'labels', help='page label index: page <-> label lookups against a linear scan')
+    parser_labels.add_argument('-pages', type=int, default=20000,
+                               help='number of pages.')
+    parser_labels.add_argument('-range-pages', dest='range_pages', type=int, default=50,
+                               help='pages of each label range.')
+    parser_labels.set_defaults(func=bench_labels)
+
+    for name, sub_parser in subparsers.choices.items():
+        if name == 'suite':
+            repeat_help = (f'measure each stage at least this many times and {SUITE_MIN_TIME:g} s, '
+                           f'keep the median.')
+        else:
+            repeat_help = 'repeat each measurement, keep the best.'
+        sub_parser.add_argument('-repeat', type=int, default=3, help=repeat_help)
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = get_cmd_args()
+    sys.exit(args.func(args))
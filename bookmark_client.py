@@ -0,0 +1,75 @@
+import sys
+import os
+import json
+import time
+import socket
+import subprocess
+
+# bookmark_server.py 的轻量客户端, 参数与 bookmark_tool.py 相同, 例如:
+#   python bookmark_client.py -mode export -i a.pdf -y
+# 服务地址: -server HOST:PORT (须为第一个参数) 或环境变量 BOOKMARK_SERVER, 默认 127.0.0.1:8765
+# 连接不上服务时, 直接运行 bookmark_tool.py
+# 只使用标准库, 不导入 pikepdf, 启动开销很小
+
+
+DEFAULT_SERVER = '127.0.0.1:8765'
+
+# 队列已满(busy)时的重试间隔, 逐次加倍
+RETRY_DELAY = 0.05
+MAX_RETRY_DELAY = 2.0
+
+
+def request(sock_file, message):
+    sock_file.write(json.dumps(message, ensure_ascii=False).encode('utf-8') + b'\n')
+    sock_file.flush()
+    line = sock_file.readline()
+    if not line:
+        raise ConnectionError('connection closed by the bookmark service')
+    return json.loads(line)
+
+
+def run_local(argv):
+    """Run bookmark_tool.py in a new process, return its exit status"""
+    tool_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bookmark_tool.py')
+    return subprocess.call([sys.executable, tool_path] + argv)
+
+
+def main(argv):
+    server = os.environ.get('BOOKMARK_SERVER', DEFAULT_SERVER)
+    if argv[:1] == ['-server'] and len(argv) > 1:
+        server, argv = argv[1], argv[2:]
+    host, _, port = server.rpartition(':')
+
+    try:
+        sock = socket.create_connection((host or '127.0.0.1', int(port)), timeout=5)
+    except OSError:
+        return run_local(argv)
+
+    with sock, sock.makefile('rwb') as sock_file:
+        sock.settimeout(None)
+        message = {'argv': argv, 'cwd': os.getcwd()}
+        delay = RETRY_DELAY
+        while True:
+            response = request(sock_file, message)
+            status = response.get('status')
+            if status == 'busy':
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+                continue
+
+            sys.stdout.write(response.get('output', ''))
+            if status == 'confirm':
+                # 与命令行相同, 询问后带 -y 重新提交
+                user_choice = input(response.get('message', 'overwrite? (y/n)'))
+                if user_choice.lower() != 'y':
+                    return 1
+                message = {'argv': argv + ['-y'], 'cwd': os.getcwd()}
+                continue
+
+            if 'message' in response:
+                print(response['message'], file=sys.stderr)
+            return status if isinstance(status, int) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
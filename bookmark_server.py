@@ -0,0 +1,350 @@
+import sys
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import traceback
+import socketserver
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future
+
+from bookmark_tool import Constant, MyPDFHandler, build_arg_parser, veryfy_args, run_job
+
+# 常驻服务: 进程保持运行, 通过本机 TCP 或 stdin 接收 JSON 行格式的任务, 例如:
+#   python bookmark_server.py -port 8765
+#   python bookmark_server.py -stdin
+# 请求:  {"id": 1, "argv": ["-mode", "export", "-i", "a.pdf", "-y"], "cwd": "/path"}
+#        {"cmd": "stats"}  /  {"cmd": "shutdown"}
+# 响应:  {"id": 1, "status": 0, "output": "..."}
+#        status 为退出码, 或 "busy"(任务队列已满) / "confirm"(需要确认覆盖, 见 message)
+# 客户端见 bookmark_client.py
+
+
+DEFAULT_PORT = 8765
+
+# argv 中相对于客户端工作目录的路径参数
+PATH_ARGS = ('i', 'o', 'bmk', 'rules', 'cache', 'bmk_out', 'report', 'profile')
+
+
+class PdfPool(object):
+    '''
+    打开的 Pdf 句柄的 LRU 池, 按路径缓存, 文件大小或修改时间变化后重新打开.
+    句柄借出期间由一个任务独占; 只读任务用完后放回, 修改过的句柄直接关闭.
+    打开方式见 MyPDFHandler.open_pdf, 原地保存须读入内存时不使用池中的句柄
+    '''
+
+    def __init__(self, max_size=16):
+        self.max_size = max_size
+        self.hits = self.misses = 0
+        self.__handles = OrderedDict()
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def file_key(path):
+        stat = os.stat(path)
+        return os.path.normcase(os.path.abspath(path)), (stat.st_size, stat.st_mtime_ns)
+
+    @contextmanager
+    def borrow(self, path, read_only=False, in_place=False, mmap=False):
+        key, version = self.file_key(path)
+        in_memory = in_place and not Constant.REPLACE_OPEN_FILES
+        stale = None
+        with self.__lock:
+            cached = None if in_memory else self.__handles.pop(key, None)
+            if cached is not None and cached[0] != version:
+                stale, cached = cached[1], None
+            if cached is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+        if stale is not None:
+            stale.close()
+
+        pdf = cached[1] if cached is not None else MyPDFHandler.open_pdf(path, in_place, mmap)
+
+        keep = False
+        try:
+            yield pdf
+            keep = read_only and self.file_key(path) == (key, version)
+        finally:
+            if keep:
+                self.__put(key, version, pdf)
+            else:
+                pdf.close()
+
+    def __put(self, key, version, pdf):
+        evicted = []
+        with self.__lock:
+            if key in self.__handles:
+                # 借出期间同一文件又被打开并放回
+                evicted.append(self.__handles.pop(key)[1])
+            self.__handles[key] = (version, pdf)
+            while len(self.__handles) > self.max_size:
+                evicted.append(self.__handles.popitem(last=False)[1][1])
+        for old_pdf in evicted:
+            old_pdf.close()
+
+    def stats(self):
+        with self.__lock:
+            return {'size': len(self.__handles), 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self.__lock:
+            handles, self.__handles = list(self.__handles.values()), OrderedDict()
+        for _, pdf in handles:
+            pdf.close()
+
+
+class ConfirmRequired(Exception):
+    '''任务需要用户确认(覆盖已存在的文件), 由客户端询问后带 -y 重新提交'''
+
+
+class JobExit(Exception):
+    '''argparse 在任务中的退出, 例如参数错误或 -h'''
+
+    def __init__(self, status):
+        super().__init__(status)
+        self.status = status
+
+
+class JobArgumentParser(argparse.ArgumentParser):
+    '''输出写入任务的 log, 退出时抛出 JobExit 而不是结束服务进程'''
+
+    log = print
+
+    def __init__(self, *args, **kwargs):
+        kwargs.setdefault('prog', 'bookmark_tool.py')
+        super().__init__(*args, **kwargs)
+
+    def _print_message(self, message, file=None):
+        if message:
+            self.log(message, end='')
+
+    def exit(self, status=0, message=None):
+        if message:
+            self.log(message, end='')
+        raise JobExit(status)
+
+
+class BookmarkService(object):
+    '''
+    任务队列 + 固定数量的工作线程: 队列有上限, 满时提交方阻塞或得到 busy (背压).
+    写同一个输出文件的任务串行执行
+    '''
+
+    def __init__(self, workers=4, queue_size=64, pool_size=16):
+        self.pdf_pool = PdfPool(pool_size)
+        self.jobs = queue.Queue(maxsize=queue_size)
+        self.done = 0
+        self.__path_locks = {}
+        self.__lock = threading.Lock()
+        self.__threads = [threading.Thread(target=self.__worker, daemon=True)
+                          for _ in range(workers)]
+        for thread in self.__threads:
+            thread.start()
+
+    def submit(self, request, block=True, timeout=None):
+        """Queue a request, return a Future of its response, raise queue.Full when busy"""
+        future = Future()
+        self.jobs.put((request, future), block=block, timeout=timeout)
+        return future
+
+    def stats(self):
+        return {'workers': len(self.__threads), 'queued': self.jobs.qsize(),
+                'queue_size': self.jobs.maxsize, 'done': self.done, 'pdf_pool': self.pdf_pool.stats()}
+
+    def __worker(self):
+        while True:
+            request, future = self.jobs.get()
+            try:
+                future.set_result(self.execute(request))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                with self.__lock:
+                    self.done += 1
+                self.jobs.task_done()
+
+    @staticmethod
+    def _lock_path(args):
+        """Path the job writes (batch: the input), resolved by veryfy_args on a copy of args"""
+        resolved = argparse.Namespace(**vars(args))
+        try:
+            veryfy_args(resolved, lambda *values, **kwargs: None, lambda question: 'y')
+        except SystemExit:
+            # 参数有错, 在锁内再次检查时报告
+            return resolved.o or resolved.i
+        return resolved.i if resolved.batch else resolved.o
+
+    @contextmanager
+    def __path_lock(self, path):
+        key = os.path.normcase(os.path.abspath(path or ''))
+        with self.__lock:
+            lock = self.__path_locks.setdefault(key, threading.Lock())
+        with lock:
+            yield
+
+    def execute(self, request):
+        """Run one command line request, return the response dict"""
+        output = []
+        start_time = time.perf_counter()
+
+        def _log(*values, sep=' ', end='\n', **kwargs):
+            output.append(sep.join(str(value) for value in values) + end)
+
+        def _ask(question):
+            raise ConfirmRequired(question)
+
+        response = {'id': request.get('id')}
+        try:
+            parser = build_arg_parser(JobArgumentParser)
+            parser.log = _log
+            args = parser.parse_args([str(arg) for arg in request.get('argv', [])])
+
+            cwd = request.get('cwd') or os.getcwd()
+            for name in PATH_ARGS:
+                value = getattr(args, name)
+                if value:
+                    setattr(args, name, os.path.join(cwd, value))
+            if not args.i:
+                _log('ERROR: Input file not be specified!')
+                raise JobExit(2)
+
+            # 覆盖确认在输出路径的锁内进行, 写同一个输出的两个任务不会都通过检查
+            with self.__path_lock(self._lock_path(args)):
+                veryfy_args(args, _log, _ask)
+                response['status'] = run_job(args, _log, _ask, self.pdf_pool)
+        except ConfirmRequired as e:
+            response['status'] = 'confirm'
+            response['message'] = str(e)
+        except JobExit as e:
+            response['status'] = e.status
+        except SystemExit as e:
+            response['status'] = e.code if isinstance(e.code, int) else (1 if e.code else 0)
+        except Exception:
+            _log(traceback.format_exc())
+            response['status'] = 1
+
+        response['output'] = ''.join(output)
+        response['time'] = round(time.perf_counter() - start_time, 6)
+        return response
+
+    def handle(self, request, block=True, timeout=None):
+        """Response of a request line, control commands are answered directly"""
+        cmd = request.get('cmd')
+        if cmd == 'stats':
+            return {'id': request.get('id'), 'status': 0, 'stats': self.stats()}
+        if cmd == 'shutdown':
+            return {'id': request.get('id'), 'status': 0, 'shutdown': True}
+        try:
+            return self.submit(request, block, timeout).result()
+        except queue.Full:
+            return {'id': request.get('id'), 'status': 'busy',
+                    'message': f'job queue is full ({self.jobs.maxsize})'}
+
+
+class _TCPHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        server = self.server
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                response = {'status': 2, 'message': f'bad request: {e}'}
+            else:
+                response = server.service.handle(request, timeout=server.submit_timeout)
+            self.wfile.write(json.dumps(response, ensure_ascii=False).encode('utf-8') + b'\n')
+            self.wfile.flush()
+            if response.get('shutdown'):
+                threading.Thread(target=server.shutdown, daemon=True).start()
+                return
+
+
+class BookmarkTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, service, submit_timeout=5.0):
+        self.service = service
+        self.submit_timeout = submit_timeout
+        super().__init__(address, _TCPHandler)
+
+
+def serve_stdin(service):
+    """JSON lines from stdin, responses to stdout in completion order"""
+    out = sys.stdout
+    # 任务中零散的 print 不能混入协议输出
+    sys.stdout = sys.stderr
+    out_lock = threading.Lock()
+
+    def _write(response):
+        with out_lock:
+            out.write(json.dumps(response, ensure_ascii=False) + '\n')
+            out.flush()
+
+    def _done(future):
+        try:
+            _write(future.result())
+        except Exception as e:
+            _write({'status': 1, 'message': repr(e)})
+
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            _write({'status': 2, 'message': f'bad request: {e}'})
+            continue
+        if request.get('cmd'):
+            response = service.handle(request)
+            _write(response)
+            if response.get('shutdown'):
+                break
+            continue
+        # 队列满时阻塞, 不再读取 stdin
+        service.submit(request).add_done_callback(_done)
+    service.jobs.join()
+
+
+def get_cmd_args():
+    parser = argparse.ArgumentParser(description='pdf bookmark tool service.')
+    parser.add_argument('-host', dest='host', default='127.0.0.1',
+                        help='listen address, default 127.0.0.1 (local only).')
+    parser.add_argument('-port', dest='port', type=int, default=DEFAULT_PORT,
+                        help=f'listen port, default {DEFAULT_PORT}.')
+    parser.add_argument('-stdin', dest='stdin', action='store_true',
+                        help='read JSON line requests from stdin instead of a socket.')
+    parser.add_argument('-workers', dest='workers', type=int, default=4,
+                        help='number of jobs run at the same time, default 4.')
+    parser.add_argument('-queue', dest='queue_size', type=int, default=64,
+                        help='max queued jobs, further requests wait or get "busy", default 64.')
+    parser.add_argument('-pool', dest='pool_size', type=int, default=16,
+                        help='max open pdf documents kept for reuse, default 16.')
+    parser.add_argument('-submit-timeout', dest='submit_timeout', type=float, default=5.0,
+                        help='socket: seconds a request waits for a queue slot before "busy".')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+
+    args = get_cmd_args()
+    service = BookmarkService(args.workers, args.queue_size, args.pool_size)
+
+    if args.stdin:
+        serve_stdin(service)
+    else:
+        with BookmarkTCPServer((args.host, args.port), service, args.submit_timeout) as server:
+            print(f'Bookmark service listening on {args.host}:{args.port}', file=sys.stderr)
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+    service.pdf_pool.close()
@@ -4,9 +4,51 @@ import argparse
 import re
 #import code
 import json
+import glob
+import hashlib
+import shutil
+import time
+import io
+import codecs
+import queue
+import threading
+import importlib
+from bisect import bisect_right
+from array import array
+from contextvars import ContextVar
+from difflib import SequenceMatcher
+from contextlib import contextmanager, ExitStack, nullcontext
+from collections import Counter, deque
+from collections.abc import MutableSequence
+from itertools import chain
 
-from pikepdf import Pdf, OutlineItem
-from pikepdf import Array, Name, Page, String
+try:
+    import resource
+except ImportError:
+    # Windows
+    resource = None
+
+
+
+class LazyModule(object):
+    '''
+    第一次访问属性时才导入的模块. format、书签文件转换和 --help 用不到 pikepdf 和进程池,
+    不必在启动时加载它们
+    '''
+
+    def __init__(self, name):
+        self.__name = name
+
+    def __getattr__(self, attr):
+        value = getattr(importlib.import_module(self.__name), attr)
+        # 之后直接从实例字典中读取, 不再经过 __getattr__
+        setattr(self, attr, value)
+        return value
+
+
+pikepdf = LazyModule('pikepdf')
+concurrent_futures = LazyModule('concurrent.futures')
+sqlite3 = LazyModule('sqlite3')
 
 if sys.version_info < ( 3, 7 ):
     raise NotImplementedError("pikepdf requires Python 3.7+")
@@ -28,7 +70,81 @@ class PublicFunc():
     def read_text_file(input_path, encoding='utf-8'):
         with open(input_path, 'r', encoding=encoding) as f:
             return f.readlines()
+
+    @staticmethod
+    def iter_text_file(input_path, encoding='utf-8'):
+        """按行惰性读取文本文件"""
+        with open(input_path, 'r', encoding=encoding) as f:
+            yield from f
+
+    @staticmethod
+    def tee_text_file(lines, output_path, encoding='utf-8'):
+        """
+        逐行转发 lines 并写入 output_path, 全部读完后才替换原文件, 输出可以是输入文件本身
+        """
+        tmp_path = output_path + '.tmp'
+        with open(tmp_path, 'w', encoding=encoding) as f:
+            for line in lines:
+                f.write(line)
+                yield line
+        os.replace(tmp_path, output_path)
+
+    @staticmethod
+    def fsync_file(path):
+        """把文件内容刷写到磁盘"""
+        with open(path, 'rb+') as f:
+            os.fsync(f.fileno())
+
+    @staticmethod
+    def safe_file_name(name, max_length=100):
+        """文件名中不能使用的字符替换为 _"""
+        name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', '_', name).strip(' .')
+        return name[:max_length] or '_'
+
+    @staticmethod
+    def natural_sort_key(path):
+        """按文件名中的数字大小排序, 例如 ch2 在 ch10 之前"""
+        return [int(part) if part.isdigit() else part.lower()
+                for part in re.split(r'(\d+)', path)]
+
+    @staticmethod
+    def list_files(path_pattern, ext):
+        """文件夹中或通配符匹配的 ext 类型文件, 按文件名自然顺序排列"""
+        if os.path.isdir(path_pattern):
+            paths = [os.path.join(path_pattern, name) for name in os.listdir(path_pattern)]
+        else:
+            paths = glob.glob(path_pattern)
+        return sorted((path for path in paths
+                       if os.path.isfile(path) and os.path.splitext(path)[1].lower() == ext),
+                      key=PublicFunc.natural_sort_key)
+
+    @staticmethod
+    def file_hash(path, chunk_size=2**20):
+        """文件内容的 sha256"""
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha256.update(chunk)
+        return sha256.hexdigest()
         
+    @staticmethod
+    def max_rss():
+        """本进程到目前为止的峰值内存(字节), 不支持时为 None"""
+        if resource is None:
+            return None
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux 的单位为 KB, macOS 为字节
+        return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+    @staticmethod
+    def current_rss():
+        """本进程当前占用的内存(字节), 没有 /proc 时为峰值内存, 都不支持时为 None"""
+        try:
+            with open('/proc/self/statm') as f:
+                return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+        except (OSError, ValueError, AttributeError):
+            return PublicFunc.max_rss()
+
     @staticmethod
     def read_json_file(path, encoding='utf8'):
         """
@@ -53,457 +169,3432 @@ class Constant():
 
     # MODE
     ADD = 'add'
+    SYNC = 'sync'
     REMOVE = 'remove'
     FORMAT = 'format'
+    FORMAT_ADD = 'format_add'
     EXPORT = 'export'
+    DETECT = 'detect'
+    MERGE = 'merge'
+    SPLIT = 'split'
+    INDEX = 'index'
+    SEARCH = 'search'
+
+    # 模式别名
+    MODE_ALIASES = {
+        'add_format': FORMAT_ADD,
+    }
 
     DICT_OUT_EXT = {
         ADD: '.pdf',
+        SYNC: '.pdf',
         REMOVE: '.pdf',
         EXPORT: '.txt',
-        FORMAT: '.txt'
+        FORMAT: '.txt',
+        FORMAT_ADD: '.pdf',
+        DETECT: '.txt',
+        MERGE: '.pdf',
+        # 输出为文件夹
+        SPLIT: '',
+        # 输出为书签目录数据库, 默认在输入文件夹中, 见 OutlineIndex
+        INDEX: '.db',
+        SEARCH: '',
+    }
+
+    # 批量模式下各模式的输入文件类型
+    DICT_IN_EXT = {
+        ADD: '.pdf',
+        SYNC: '.pdf',
+        REMOVE: '.pdf',
+        EXPORT: '.pdf',
+        FORMAT: '.txt',
+        FORMAT_ADD: '.pdf',
+        DETECT: '.pdf',
+        MERGE: '.pdf',
+        SPLIT: '.pdf',
     }
 
-    # 书签标题与页码间的分隔符, 可使用多个
-    MARK_PAGE = '\t'
+    # pikepdf.ObjectStreamMode 的取值, 供命令行参数使用而不必导入 pikepdf
+    OBJECT_STREAM_MODES = ('disable', 'preserve', 'generate')
+
+    # 批量 add/sync 时按顺序查找的同名书签文件
+    BOOKMARK_EXTS = ('.txt', '.json')
+
+    # 默认的大纲读写后端, 见 OutlineBackend
+    DEFAULT_BACKEND = 'pikepdf'
+
+    # 能否替换(重命名覆盖)仍然打开着的文件; Windows 不能, 原地保存前须把输入整个读入内存
+    REPLACE_OPEN_FILES = os.name != 'nt'
+
+    # 读取PDF大纲时的最大层级, 超过部分会被忽略
+    MAX_OUTLINE_DEPTH = 100000
+
+    # pikepdf 按层级递归读写大纲, 在默认的递归深度限制内能处理的层级;
+    # 更深的大纲改用没有递归的 objects 后端, 不修改进程全局的递归深度限制(工作线程中不安全)
+    PIKEPDF_MAX_DEPTH = 400
+
+    # 每次遍历大纲、名称树或数字树时最多读取的项数, 超过时保留已读取的部分, 见 OutlineBudget
+    MAX_OUTLINE_NODES = 2000000
+
+    # 书签标题与页码间的分隔符的默认值, 可使用多个字符, 任务的设置见 BookmarkConfig
+    MARK_PAGE = '\t'
+
+    # 代表书签标题级别的符号的默认值, 可使用多个字符
+    MARK_LEVEL = '\t'
+
+    # 书签文件中的 //labels 行: 之后的页码为印刷页码标签 (见 PageLabels), 直到下一个 //N 行
+    PAGE_LABELS_LINE = 'labels'
+
+
+class BookmarkConfig(object):
+    '''
+    一个任务的书签文本设置: 分隔符及预编译的正则、页码偏移、书签文件的编码.
+    创建后不可修改, 通过 get() 按设置缓存; 同一进程中不同设置的任务可以同时运行, 互不影响
+    '''
+
+    __slots__ = ('mark_page', 'mark_level', 'page_offset', 'in_encoding', 'out_encoding',
+                 'page_labels', 'mark_page_re', 'mark_level_re', 'bookmark_line_re', 'page_offset_re')
+
+    __re_special_chars = r'+-*\()[]{}^|.?$'
+
+    __cache = {}
+    __cache_lock = threading.Lock()
+
+    def __init__(self, mark_page, mark_level, page_offset=0, in_encoding='utf-8', out_encoding='utf-8',
+                 page_labels=False):
+        if not mark_page or not mark_level:
+            raise ValueError('The page and level separators must not be empty')
+
+        def _escape_mark(mark_str):
+            # 分隔符中的正则表达式特殊字符须转义
+            return ''.join('\\' + char if char in self.__re_special_chars else char
+                           for char in mark_str)
+
+        mark_page_re = _escape_mark(mark_page)
+        mark_level_re = _escape_mark(mark_level)
+        values = {
+            'mark_page': mark_page,
+            'mark_level': mark_level,
+            # 书签文件中的页码加上的偏移, 文件中的 // 行会覆盖它
+            'page_offset': page_offset,
+            'in_encoding': in_encoding,
+            'out_encoding': out_encoding,
+            # 书签文件中的页码为印刷页码标签, 如同文件以 //labels 行开头; 导出时也写标签
+            'page_labels': page_labels,
+            'mark_page_re': mark_page_re,
+            'mark_level_re': mark_level_re,
+            # 书签行: 级别符号 + 标题 + 页码分隔符 + 页码 + 页码标签中数字之后的部分
+            'bookmark_line_re': re.compile(
+                rf'^((?:{mark_level_re})*)(.*?)(?:{mark_page_re})(\d*)(\S*)'),
+            'page_offset_re': re.compile(r'^\s*//(.*)'),
+        }
+        for name, value in values.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    @property
+    def key(self):
+        return (self.mark_page, self.mark_level, self.page_offset, self.in_encoding, self.out_encoding,
+                self.page_labels)
+
+    def __eq__(self, other):
+        return isinstance(other, BookmarkConfig) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __repr__(self):
+        return f'BookmarkConfig{self.key!r}'
+
+    def __reduce__(self):
+        # 传给工作进程时只传设置, 在工作进程中取缓存的实例
+        return (type(self).get, self.key)
+
+    @classmethod
+    def get(cls, mark_page=None, mark_level=None, page_offset=0,
+            in_encoding='utf-8', out_encoding=None, page_labels=False):
+        """Cached config, the separators default to Constant.MARK_PAGE / MARK_LEVEL"""
+        key = (mark_page or Constant.MARK_PAGE, mark_level or Constant.MARK_LEVEL,
+               page_offset or 0, in_encoding or 'utf-8', out_encoding or in_encoding or 'utf-8',
+               bool(page_labels))
+        config = cls.__cache.get(key)
+        if config is None:
+            config = cls(*key)
+            with cls.__cache_lock:
+                config = cls.__cache.setdefault(key, config)
+        return config
+
+    @classmethod
+    def from_args(cls, args):
+        """Config of the command line args"""
+        return cls.get(args.mark_page, args.mark_level, args.page_offset,
+                       args.encoding, args.out_encoding, args.page_labels)
+
+
+class RunMetrics(object):
+    '''
+    一次任务各阶段的耗时、计数(书签数、页数、命名目标查找次数等)、内存和读写字节数.
+    每个阶段记录结束时的进程内存 rss 及阶段内的变化 rss_delta (多线程时包含其它线程的分配);
+    进程的峰值内存只在整个任务的记录中, 为 process_max_rss.
+    处理代码通过 metrics_stage() 记录, 没有正在收集的 RunMetrics 时不记录
+    '''
+
+    # 写报告文件的锁, 服务模式下多个线程可能写同一个文件
+    __report_lock = threading.Lock()
+
+    def __init__(self):
+        self.stages = []
+        self.start_time = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, **counts):
+        """Record a stage, counts can also be added to the yielded record"""
+        record = {'stage': name}
+        record.update(counts)
+        start_rss = PublicFunc.current_rss()
+        start_time = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record['time'] = round(time.perf_counter() - start_time, 6)
+            rss = PublicFunc.current_rss()
+            record['rss'] = rss
+            if rss is not None and start_rss is not None:
+                record['rss_delta'] = rss - start_rss
+            self.stages.append(record)
+
+    @contextmanager
+    def current(self):
+        """Make this the current RunMetrics of this thread while in the with block"""
+        token = _current_metrics.set(self)
+        try:
+            yield self
+        finally:
+            _current_metrics.reset(token)
+
+    @classmethod
+    @contextmanager
+    def collect(cls):
+        """Make a new RunMetrics the current one of this thread while in the with block"""
+        with cls().current() as metrics:
+            yield metrics
+
+    def report(self, job, status, note=None):
+        """JSON line record of job, status is ok / skipped / failed"""
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'mode': job.mode,
+            'input': job.i,
+            'bookmark': job.bmk,
+            'output': job.o,
+            'status': status,
+            'note': note,
+            'total_time': round(time.perf_counter() - self.start_time, 6),
+            'process_max_rss': PublicFunc.max_rss(),
+            'pid': os.getpid(),
+            'stages': self.stages,
+        }
+
+    @classmethod
+    def write_report(cls, report_path, records):
+        """Append records to the JSON lines file report_path"""
+        lines = ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+        with cls.__report_lock, open(report_path, 'a', encoding='utf-8') as f:
+            f.write(lines)
+
+
+_current_metrics = ContextVar('metrics', default=None)
+
+
+@contextmanager
+def metrics_stage(name, **counts):
+    """RunMetrics.stage of the current metrics, the record is dropped if there is none"""
+    metrics = _current_metrics.get()
+    if metrics is None:
+        yield dict(counts)
+        return
+    with metrics.stage(name, **counts) as record:
+        yield record
+
+
+class OutlineLimitError(Exception):
+    '''遍历大纲等 PDF 结构时超出了 OutlineBudget 的限制'''
+
+
+class OutlineBudget(object):
+    '''
+    处理一个文件时遍历大纲、名称树、数字树的限制: 每次遍历的项数和层级, 以及整个文件的耗时和内存增长.
+    遍历代码通过 OutlineBudget.current() 取得当前文件的预算, 每读取一项调用 step();
+    超出限制或遇到循环引用时停止遍历, 保留已读取的部分, 问题记录在 problems 中
+    '''
+
+    # 每读取多少项检查一次耗时和内存
+    CHECK_EVERY = 256
+
+    def __init__(self, max_nodes=0, max_depth=0, time_limit=0, memory_limit=0):
+        """time_limit: seconds, memory_limit: bytes of memory growth, 0 for no limit"""
+        self.max_nodes = max_nodes or Constant.MAX_OUTLINE_NODES
+        self.max_depth = max_depth or Constant.MAX_OUTLINE_DEPTH
+        self.time_limit = time_limit
+        self.memory_limit = memory_limit
+        self.start()
+
+    @classmethod
+    def from_args(cls, args):
+        """Budget of the command line args, -memory-limit is in MB"""
+        return cls(args.max_nodes, args.max_outline_depth, args.time_limit,
+                   int(args.memory_limit * 2**20))
+
+    def start(self):
+        """Start the time and memory budget from now and clear the problems"""
+        self.problems = []
+        self.deadline = time.perf_counter() + self.time_limit if self.time_limit else None
+        base_rss = PublicFunc.current_rss() if self.memory_limit else None
+        self.rss_limit = base_rss + self.memory_limit if base_rss is not None else None
+
+    @contextmanager
+    def activate(self):
+        """Start this budget and make it the current one of this thread while in the with block"""
+        self.start()
+        token = _current_budget.set(self)
+        try:
+            yield self
+        finally:
+            _current_budget.reset(token)
+
+    @classmethod
+    def current(cls):
+        """Budget of the file being processed, a new one with the default limits if none is active"""
+        budget = _current_budget.get()
+        return budget if budget is not None else cls()
+
+    def step(self, count):
+        """Called with the number of items a traversal has read, raise OutlineLimitError over a limit"""
+        if count > self.max_nodes:
+            raise OutlineLimitError(f'more than {self.max_nodes} items')
+        if count % self.CHECK_EVERY == 0:
+            self.check()
+
+    def check(self):
+        """Raise OutlineLimitError once the time or memory budget of the file is used up"""
+        if self.deadline is not None and time.perf_counter() > self.deadline:
+            raise OutlineLimitError(f'time limit of {self.time_limit:g} s exceeded')
+        if self.rss_limit is not None and PublicFunc.current_rss() > self.rss_limit:
+            raise OutlineLimitError(f'memory limit of {self.memory_limit / 2**20:g} MB exceeded')
+
+    def report(self, problem):
+        """Record a problem of the file, each one once"""
+        if problem not in self.problems:
+            self.problems.append(problem)
+
+    @staticmethod
+    def repeated(obj):
+        return f'object {obj.objgen[0]} {obj.objgen[1]} R repeated, cycle broken'
+
+    def note(self, note=None):
+        """Result note with the problems appended, None if there is neither"""
+        if not self.problems:
+            return note
+        problems = 'partial outline: ' + '; '.join(self.problems)
+        return f'{note}, {problems}' if note else problems
+
+
+_current_budget = ContextVar('outline_budget', default=None)
+
+
+class BookmarkTree(object):
+    """
+    列式存储的书签树: 每个节点为各个数组中的一行,
+    标题统一保存在去重的字符串表中, BookmarkNode 只是某一行的视图
+    """
+
+    NO_NODE = -1
+    # page_num 为 None 时存储的值
+    NO_PAGE = -2**31
+
+    def __init__(self):
+        self.level = array('i')
+        self.page_num = array('i')
+        self.title_id = array('i')
+        self.parent = array('i')
+        self.first_child = array('i')
+        self.last_child = array('i')
+        self.next_sibling = array('i')
+        self.prev_sibling = array('i')
+        self.titles = []
+        self.__title_ids = {}
+
+    def __len__(self):
+        return len(self.level)
+
+    def intern_title(self, title):
+        """Return the id of title in the string table, adding it if needed"""
+        title_id = self.__title_ids.get(title)
+        if title_id is None:
+            title_id = self.__title_ids[title] = len(self.titles)
+            self.titles.append(title)
+        return title_id
+
+    def add_node(self, level, title, page_num):
+        """Append an unlinked node, return its index"""
+        self.level.append(int(level))
+        self.page_num.append(int(page_num) if page_num != None else self.NO_PAGE)
+        self.title_id.append(self.intern_title(title))
+        for column in (self.parent, self.first_child, self.last_child,
+                       self.next_sibling, self.prev_sibling):
+            column.append(self.NO_NODE)
+        return len(self.level) - 1
+
+    def get_page_num(self, index):
+        page_num = self.page_num[index]
+        return page_num if page_num != self.NO_PAGE else None
+
+    def children(self, index):
+        """Indexes of the children of node index"""
+        result = []
+        child = self.first_child[index]
+        while child != self.NO_NODE:
+            result.append(child)
+            child = self.next_sibling[child]
+        return result
+
+    def append_child(self, index, child):
+        """Link unlinked node child as the last child of node index"""
+        last = self.last_child[index]
+        self.parent[child] = index
+        self.prev_sibling[child] = last
+        self.next_sibling[child] = self.NO_NODE
+        if last == self.NO_NODE:
+            self.first_child[index] = child
+        else:
+            self.next_sibling[last] = child
+        self.last_child[index] = child
+
+    def insert_before(self, sibling, child):
+        """Link unlinked node child in front of node sibling"""
+        index = self.parent[sibling]
+        prev = self.prev_sibling[sibling]
+        self.parent[child] = index
+        self.prev_sibling[child] = prev
+        self.next_sibling[child] = sibling
+        self.prev_sibling[sibling] = child
+        if prev == self.NO_NODE:
+            self.first_child[index] = child
+        else:
+            self.next_sibling[prev] = child
+
+    def unlink(self, index):
+        """Detach node index (with its subtree) from its parent, O(1)"""
+        parent = self.parent[index]
+        if parent == self.NO_NODE:
+            return
+        prev, next_ = self.prev_sibling[index], self.next_sibling[index]
+        if prev == self.NO_NODE:
+            self.first_child[parent] = next_
+        else:
+            self.next_sibling[prev] = next_
+        if next_ == self.NO_NODE:
+            self.last_child[parent] = prev
+        else:
+            self.prev_sibling[next_] = prev
+        self.parent[index] = self.prev_sibling[index] = self.next_sibling[index] = self.NO_NODE
+
+    def iter_rows(self, index):
+        """Iterate over (index, depth) of all descendants of node index in pre-order"""
+        NO_NODE = self.NO_NODE
+        first_child, next_sibling, parent = self.first_child, self.next_sibling, self.parent
+        node, depth = first_child[index], 1
+        while node != NO_NODE:
+            yield node, depth
+            if first_child[node] != NO_NODE:
+                node, depth = first_child[node], depth + 1
+                continue
+            # 没有子节点时, 找自身或祖先的下一个兄弟节点
+            while node != index and next_sibling[node] == NO_NODE:
+                node, depth = parent[node], depth - 1
+            if node == index:
+                return
+            node = next_sibling[node]
+
+    def copy_subtree(self, other, other_index):
+        """Copy node other_index of tree other with its subtree into this tree, return the new index"""
+        def _copy_node(i):
+            return self.add_node(other.level[i], other.titles[other.title_id[i]],
+                                 other.get_page_num(i))
+
+        new_index = _copy_node(other_index)
+        # 原树中的节点 -> 本树中新节点
+        new_nodes = {other_index: new_index}
+        for i, _ in other.iter_rows(other_index):
+            new_nodes[i] = _copy_node(i)
+            self.append_child(new_nodes[other.parent[i]], new_nodes[i])
+        return new_index
+
+
+class OutlineDestResolver(object):
+    """Resolve outline item destinations of a pdf to page indexes"""
+
+    def __init__(self, pdf):
+        self.named_dests = self.get_named_dests(pdf)
+        # 页面对象 objgen -> 页码索引, 避免逐个书签调用 Page(...).index
+        self.page_index = {page.objgen: i for i, page in enumerate(pdf.pages)}
+        self.named_lookups = 0
+
+    @staticmethod
+    def get_named_dests(pdf):
+        """
+        一次性解析命名目标: /Root /Names /Dests 名称树(含嵌套 /Kids)
+        以及 PDF 1.1 的 /Root /Dests 字典, 返回 {目标名: 目标}
+        """
+        named_dests = {}
+        root = pdf.Root
+
+        if '/Dests' in root and isinstance(root.Dests, pikepdf.Dictionary):
+            # 12.3.2.3 name object destinations, key is the name itself
+            for key, value in root.Dests.items():
+                named_dests[key] = value
+
+        if '/Names' in root and '/Dests' in root.Names:
+            # 7.9.6 name tree, leaf nodes have /Names, intermediate nodes have /Kids
+            budget = OutlineBudget.current()
+            visited = set()
+            tree_nodes = [root.Names.Dests]
+            # 读取的树节点和名称数, 每项加一, 使 step() 定期检查耗时和内存
+            count = 0
+            try:
+                while tree_nodes:
+                    tree_node = tree_nodes.pop()
+                    if not isinstance(tree_node, pikepdf.Dictionary):
+                        continue
+                    if tree_node.is_indirect:
+                        # 损坏的文件中 /Kids 可能指向自身或祖先
+                        if tree_node.objgen in visited:
+                            budget.report(f'named destinations: {budget.repeated(tree_node)}')
+                            continue
+                        visited.add(tree_node.objgen)
+                    count += 1
+                    budget.step(count)
+                    names = tree_node.get('/Names')
+                    if isinstance(names, pikepdf.Array):
+                        for n in range(0, len(names) - 1, 2):
+                            count += 1
+                            budget.step(count)
+                            named_dests.setdefault(str(names[n]), names[n+1])
+                    kids = tree_node.get('/Kids')
+                    if isinstance(kids, pikepdf.Array):
+                        tree_nodes.extend(reversed(list(kids)))
+            except OutlineLimitError as e:
+                budget.report(f'named destinations: {e}')
+        return named_dests
+
+    def find_dest(self, dest):
+        """Resolve an explicit or named destination to a page index"""
+        if isinstance(dest, (pikepdf.String, pikepdf.Name)):
+            self.named_lookups += 1
+            dest = self.named_dests.get(str(dest))
+        if isinstance(dest, pikepdf.Dictionary):
+            # named destination may be a dictionary with /D entry
+            dest = dest.get('/D')
+        if not isinstance(dest, pikepdf.Array) or len(dest) == 0:
+            return None
+
+        # 12.3.2.2 Explicit destination
+        # [raw_page, /PageLocation.SomeThing, integer parameters for viewport]
+        raw_page = dest[0]
+        if isinstance(raw_page, int):
+            return raw_page
+        try:
+            return self.page_index.get(raw_page.objgen)
+        except AttributeError:
+            return None
+
+    def item_page_number(self, item):
+        """Page index of a raw outline item dictionary, None if it has no page"""
+        dest = item.get('/Dest')
+        if dest is not None:
+            return self.find_dest(dest)
+        action = item.get('/A')
+        if action is not None and action.get('/S') == pikepdf.Name.GoTo:
+            return self.find_dest(action.get('/D'))
+        return None
+
+    def page_number(self, outline):
+        """Page index of an OutlineItem, None if it has no page"""
+        if outline.destination is not None:
+            if isinstance(outline.destination, int):
+                # Page number
+                return outline.destination
+            return self.find_dest(outline.destination)
+        action = outline.action
+        if action is not None and action.get('/S') == pikepdf.Name.GoTo:
+            return self.find_dest(action.get('/D'))
+        return None
+
+
+class PageLabels(object):
+    '''
+    PDF 的印刷页码标签 (12.4.2 /Root /PageLabels 数字树), 第一次查找时一次性解析为
+    按起始页排序的区间, 页码索引 -> 标签、标签 -> 页码索引都用二分查找.
+    没有 /PageLabels 时标签为 1, 2, 3 ...
+    '''
+
+    # 区间的编号样式: 十进制, 大/小写罗马数字, 大/小写字母 (A..Z, AA..ZZ, ...)
+    STYLES = ('D', 'R', 'r', 'A', 'a')
+
+    __roman_digits = ((1000, 'M'), (900, 'CM'), (500, 'D'), (400, 'CD'), (100, 'C'), (90, 'XC'),
+                      (50, 'L'), (40, 'XL'), (10, 'X'), (9, 'IX'), (5, 'V'), (4, 'IV'), (1, 'I'))
+    __roman_values = {'I': 1, 'V': 5, 'X': 10, 'L': 50, 'C': 100, 'D': 500, 'M': 1000}
+
+    def __init__(self, pdf):
+        self.__pdf = pdf
+        self.__ranges = None
+
+    @staticmethod
+    def read_number_tree(tree):
+        """Yield the (key, value) pairs of a number tree (7.9.7), /Nums of leaves and /Kids"""
+        budget = OutlineBudget.current()
+        nodes = [tree]
+        visited = set()
+        count = 0
+        try:
+            while nodes:
+                node = nodes.pop()
+                if not isinstance(node, pikepdf.Dictionary):
+                    continue
+                if node.is_indirect:
+                    if node.objgen in visited:
+                        budget.report(f'page labels: {budget.repeated(node)}')
+                        continue
+                    visited.add(node.objgen)
+                count += 1
+                budget.step(count)
+                nums = node.get('/Nums')
+                if isinstance(nums, pikepdf.Array):
+                    for n in range(0, len(nums) - 1, 2):
+                        count += 1
+                        budget.step(count)
+                        yield nums[n], nums[n+1]
+                kids = node.get('/Kids')
+                if isinstance(kids, pikepdf.Array):
+                    nodes.extend(reversed(list(kids)))
+        except OutlineLimitError as e:
+            budget.report(f'page labels: {e}')
+
+    def __load(self):
+        pdf = self.__pdf
+        page_count = len(pdf.pages)
+        starts = {}
+        tree = pdf.Root.get('/PageLabels')
+        if tree is not None:
+            for key, value in self.read_number_tree(tree):
+                if not isinstance(value, pikepdf.Dictionary):
+                    continue
+                try:
+                    start = int(key)
+                except (TypeError, ValueError):
+                    continue
+                if 0 <= start < page_count:
+                    style = value.get('/S')
+                    style = str(style)[1:] if style is not None else None
+                    starts.setdefault(start, (
+                        style if style in self.STYLES else None,
+                        str(value.get('/P', '')),
+                        max(int(value.get('/St', 1)), 1)))
+        # 第一页之前没有区间时, 按默认的十进制页码
+        starts.setdefault(0, ('D', '', 1))
+
+        # [起始页索引, 样式, 前缀, 起始编号, 末页索引]
+        ranges = [[start, *starts[start], 0] for start in sorted(starts)]
+        for this, next_range in zip(ranges, ranges[1:] + [[page_count]]):
+            this[4] = next_range[0] - 1
+        self.__ranges = ranges
+        self.__starts = [r[0] for r in ranges]
+
+        # 标签 -> 页码索引: 按 (前缀, 样式) 分组, 组内按起始编号排序以便二分查找
+        groups = {}
+        for start, style, prefix, first, end in ranges:
+            groups.setdefault((prefix, style), []).append((first, start, end))
+        self.__groups = {key: ([span[0] for span in sorted(spans)], sorted(spans))
+                         for key, spans in groups.items()}
+
+    def __ensure_loaded(self):
+        if self.__ranges is None:
+            with metrics_stage('page_labels') as record:
+                self.__load()
+                record['ranges'] = len(self.__ranges)
+
+    @classmethod
+    def format_number(cls, number, style):
+        """Text of number in a label style, see STYLES"""
+        if style in ('R', 'r') and number > 0:
+            digits = []
+            for value, digit in cls.__roman_digits:
+                count, number = divmod(number, value)
+                digits.append(digit * count)
+            text = ''.join(digits)
+            return text if style == 'R' else text.lower()
+        if style in ('A', 'a') and number > 0:
+            letter = chr(ord(style) + (number - 1) % 26)
+            return letter * ((number - 1) // 26 + 1)
+        return str(number)
+
+    @classmethod
+    def parse_number(cls, text, style):
+        """Number of the text in a label style, None if it is not written in that style"""
+        if not text:
+            return None
+        if style == 'D':
+            if not text.isdecimal():
+                return None
+            number = int(text)
+        elif style in ('R', 'r'):
+            values = [cls.__roman_values.get(char) for char in text.upper()]
+            if None in values:
+                return None
+            number = sum(-value if value < next_value else value
+                         for value, next_value in zip(values, values[1:] + [0]))
+        else:
+            number = (len(text) - 1) * 26 + ord(text[0]) - ord(style) + 1
+        # 只接受规范写法, 例如不接受 007 或 IIII
+        return number if number > 0 and cls.format_number(number, style) == text else None
+
+    def __len__(self):
+        self.__ensure_loaded()
+        return len(self.__ranges)
+
+    def label(self, page_index):
+        """Printed label of the page at page_index"""
+        self.__ensure_loaded()
+        start, style, prefix, first, _ = self.__ranges[bisect_right(self.__starts, page_index) - 1]
+        if style is None:
+            return prefix
+        return prefix + self.format_number(first + page_index - start, style)
+
+    def page_index(self, label, near=0):
+        """
+        Index of the page with the printed label, None if no page has it. When several pages
+        have it (numbering restarted), the first one at or after page index near, else the first one
+        """
+        self.__ensure_loaded()
+        found = []
+        for (prefix, style), (firsts, spans) in self.__groups.items():
+            if not label.startswith(prefix):
+                continue
+            if style is None:
+                if label == prefix:
+                    found.extend(span[1] for span in spans)
+                continue
+            number = self.parse_number(label[len(prefix):], style)
+            if number is None:
+                continue
+            # 起始编号不大于 number 的区间, 编号重新开始的区间可能有多个
+            for first, start, end in spans[:bisect_right(firsts, number)]:
+                if number - first <= end - start:
+                    found.append(start + number - first)
+        if not found:
+            return None
+        return min((i for i in found if i >= near), default=min(found))
+
+
+class BookmarkChildren(MutableSequence):
+    """
+    一个节点的子节点列表的视图, 用法与列表相同 (append/insert/remove/del/下标和切片),
+    修改直接作用于 BookmarkTree 中的链接
+    """
+
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, tree, index):
+        self._tree = tree
+        self._index = index
+
+    def __iter__(self):
+        tree, NO_NODE = self._tree, BookmarkTree.NO_NODE
+        child = tree.first_child[self._index]
+        while child != NO_NODE:
+            yield BookmarkNode._view(tree, child)
+            child = tree.next_sibling[child]
+
+    def __reversed__(self):
+        tree, NO_NODE = self._tree, BookmarkTree.NO_NODE
+        child = tree.last_child[self._index]
+        while child != NO_NODE:
+            yield BookmarkNode._view(tree, child)
+            child = tree.prev_sibling[child]
+
+    def __len__(self):
+        return len(self._tree.children(self._index))
+
+    def __bool__(self):
+        return self._tree.first_child[self._index] != BookmarkTree.NO_NODE
+
+    def __getitem__(self, i):
+        rows = self._tree.children(self._index)
+        if isinstance(i, slice):
+            return [BookmarkNode._view(self._tree, row) for row in rows[i]]
+        return BookmarkNode._view(self._tree, rows[i])
+
+    def __setitem__(self, i, node):
+        if isinstance(i, slice):
+            positions = range(len(self))[i]
+            if i.step not in (None, 1):
+                raise ValueError('extended slice assignment of children is not supported')
+            del self[i]
+            for offset, new_node in enumerate(list(node)):
+                self.insert(positions.start + offset, new_node)
+            return
+        old = self._tree.children(self._index)[i]
+        self.insert(i if i >= 0 else i + len(self), node)
+        # 来自其它树的节点已复制到本树, node 指向副本
+        if node._index != old:
+            self._tree.unlink(old)
+
+    def __delitem__(self, i):
+        rows = self._tree.children(self._index)
+        for row in (rows[i] if isinstance(i, slice) else [rows[i]]):
+            self._tree.unlink(row)
+
+    def insert(self, i, node):
+        """Insert node before position i, a node of another tree is copied with its subtree"""
+        rows = self._tree.children(self._index)
+        if i < 0:
+            i = max(0, i + len(rows))
+        sibling = rows[i] if i < len(rows) else None
+        if node._tree is self._tree and node._index == sibling:
+            return
+        BookmarkNode._view(self._tree, self._index).add_child(node)
+        if sibling is not None:
+            self._tree.unlink(node._index)
+            self._tree.insert_before(sibling, node._index)
+
+    def __eq__(self, other):
+        if isinstance(other, (BookmarkChildren, list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __repr__(self):
+        return repr(list(self))
+
+
+class BookmarkNode(object):
+    """
+    书签节点, 为 BookmarkTree 中一行的轻量视图.
+    同一节点的多个视图相等; 节点被添加到另一棵树时会复制到那棵树中
+    """
+
+    __slots__ = ('_tree', '_index')
+
+    def __init__(self, level=1, title=None, page_num=0, tree=None):
+        self._tree = tree if tree is not None else BookmarkTree()
+        self._index = self._tree.add_node(level, title, page_num)
+
+    @classmethod
+    def _view(cls, tree, index):
+        node = cls.__new__(cls)
+        node._tree = tree
+        node._index = index
+        return node
+
+    def __eq__(self, other):
+        return (isinstance(other, BookmarkNode)
+                and self._tree is other._tree and self._index == other._index)
+
+    def __hash__(self):
+        return hash((id(self._tree), self._index))
+
+    @property
+    def title(self):
+        return self._tree.titles[self._tree.title_id[self._index]]
+
+    @title.setter
+    def title(self, value):
+        self._tree.title_id[self._index] = self._tree.intern_title(value)
+
+    @property
+    def page_num(self):
+        return self._tree.get_page_num(self._index)
+
+    @page_num.setter
+    def page_num(self, value):
+        self._tree.page_num[self._index] = int(value) if value != None else BookmarkTree.NO_PAGE
+
+    @property
+    def level(self):
+        return self._tree.level[self._index]
+
+    @level.setter
+    def level(self, value):
+        self._tree.level[self._index] = int(value)
+
+    @property
+    def parent(self):
+        parent = self._tree.parent[self._index]
+        return self._view(self._tree, parent) if parent != BookmarkTree.NO_NODE else None
+
+    @property
+    def child(self):
+        """The children, a list-like view, changes to it change the tree (see BookmarkChildren)"""
+        return BookmarkChildren(self._tree, self._index)
+
+    @child.setter
+    def child(self, new_children):
+        for i in self._tree.children(self._index):
+            self._tree.unlink(i)
+        for child in new_children:
+            self.add_child(child)
+
+    def new_child(self, level=1, title=None, page_num=0):
+        """Create a node in this tree and add it as the last child"""
+        index = self._tree.add_node(level, title, page_num)
+        self._tree.append_child(self._index, index)
+        return self._view(self._tree, index)
+
+    def add_child(self, child):
+        """Add a child node of type BookmarkNode"""
+        if child._tree is not self._tree:
+            # 来自其它树的节点, 连同子树复制到本树
+            child._index = self._tree.copy_subtree(child._tree, child._index)
+            child._tree = self._tree
+        else:
+            self._tree.unlink(child._index)
+        self._tree.append_child(self._index, child._index)
+
+    def set_parent(self, new_parent):
+        """Set the parent of this node to a new one"""
+        new_parent.add_child(self)
+
+    def move_to(self, new_index):
+        """Move this node to a new location in the list of children"""
+        tree = self._tree
+        if tree.parent[self._index] == BookmarkTree.NO_NODE:
+            print("Cannot move the root node")
+            return
+
+        parent = tree.parent[self._index]
+        tree.unlink(self._index)
+        siblings = tree.children(parent)
+        siblings.insert(new_index, self._index)
+        pos = siblings.index(self._index)
+        if pos + 1 < len(siblings):
+            tree.insert_before(siblings[pos + 1], self._index)
+        else:
+            tree.append_child(parent, self._index)
+
+    def remove(self):
+        """
+        Remove/Delete the Node. Its row stays in the tree (views of it stay valid),
+        copy_to() a new tree to drop removed rows
+        """
+        if self._tree.parent[self._index] == BookmarkTree.NO_NODE:
+            print("Cannot remove the root node")
+            return
+
+        self._tree.unlink(self._index)
+
+    def load_from_pdf(self, pdfreader, backend=None):
+        """Load bookmarks from pikepdf Pdf, backend: name of the OutlineBackend, default pikepdf"""
+        OutlineBackend.get(backend).read_outline(self, pdfreader)
+
+    @staticmethod
+    def _make_dest(node, page_objs):
+        """Explicit destination array of node, page_objs is the list of page objects"""
+        if node.page_num == None:
+            return None
+        page_num = node.page_num - 1
+        if page_num >= len(page_objs):
+            raise IndexError(f'Title "{node.title}": page {node.page_num} '
+                             f'out of range, pdf has {len(page_objs)} pages')
+        # same destination as OutlineItem(title, page_num) creates
+        return pikepdf.Array([page_objs[page_num], pikepdf.Name.Fit])
+
+    @staticmethod
+    def _append_outline_items(nodes, outline_list, page_objs):
+        """Create OutlineItems for nodes and their subtrees, append them to outline_list"""
+        # (书签节点, 所属的大纲项列表) 栈
+        stack = [(node, outline_list) for node in reversed(nodes)]
+        while stack:
+            cur_node, outline_list = stack.pop()
+            cur_outline = pikepdf.OutlineItem(cur_node.title,
+                                      BookmarkNode._make_dest(cur_node, page_objs))
+            outline_list.append(cur_outline)
+            stack.extend((child_node, cur_outline.children)
+                         for child_node in reversed(cur_node.child))
+
+    def add_to_pdf(self, pdf_obj, backend=None):
+        """Append the bookmarks to the outline of pdf_obj, backend: see load_from_pdf"""
+        backend = OutlineBackend.get(backend)
+        with metrics_stage('add_to_pdf', nodes=len(self._tree) - 1, backend=backend.name):
+            backend.write_outline(self, pdf_obj)
+
+    def sync_to_pdf(self, pdf_obj, backend=None):
+        """
+        Update the pdf outline to match this tree. Sibling lists are diffed by title,
+        only outline items that differ are changed, inserted or removed.
+        backend: see load_from_pdf. Return the edit script as a list of lines.
+        """
+        return OutlineBackend.get(backend).sync_outline(self, pdf_obj)
+
+    def load_from_txt(self, txt_file_path, config=None, page_labels=None):
+        config = config or BookmarkConfig.get()
+        bmk_text_lines = PublicFunc.iter_text_file(txt_file_path, encoding=config.in_encoding)
+        self.load_from_text(bmk_text_lines, config, page_labels)
+        
+    def load_from_text(self, bmk_text_lines, config=None, page_labels=None):
+        """
+        Parse bookmark lines in a single pass, bmk_text_lines can be a str
+        or any iterable of lines (e.g. an open file).
+        config: BookmarkConfig of the separators and page offset, default BookmarkConfig.get()
+        page_labels: PageLabels of the pdf, to resolve printed page labels after a //labels line
+        """
+        config = config or BookmarkConfig.get()
+
+        # 如果直接输入的是文字,则按行转为list
+        if type(bmk_text_lines) is str:
+            bmk_text_lines = bmk_text_lines.split('\n')
+
+        match_line = config.bookmark_line_re.match
+        match_offset = config.page_offset_re.match
+        len_mark_level = len(config.mark_level)
+
+        with metrics_stage('load_from_text') as record:
+            node_count = len(self._tree)
+            offset = config.page_offset
+            use_labels = config.page_labels
+            # 上一个页码, 重复的页码标签取其后的第一个
+            last_page = 1
+            # node_stack[i] 为当前路径上第 i 级的节点, node_stack[0] 为根节点
+            node_stack = [self]
+
+            for line in bmk_text_lines:
+                # / / 后面填上 页码中的第一页对应PDF的第几个页面, 或 //labels: 之后的页码为页码标签
+                res = match_offset(line)
+                if res:
+                    directive = res.group(1).strip()
+                    if directive == Constant.PAGE_LABELS_LINE:
+                        use_labels = True
+                        continue
+                    try:
+                        offset = int(directive) - 1
+                        use_labels = False
+                    except ValueError:
+                        pass
+                    continue
+                res = match_line(line)
+                if res:
+                    level_mark, title, page_num, label_tail = res.groups()
+                    # \t count stands for level
+                    cur_level, remainder = divmod(len(level_mark), len_mark_level)
+                    if remainder: # if title level is not int
+                        raise ValueError('Bookmark file not be formated!')
+                    cur_level += 1
+                    if use_labels:
+                        page_num = self._label_page_num(
+                            title, page_num + label_tail, page_labels, last_page)
+                        last_page = page_num or last_page
+                    else:
+                        page_num = int(page_num) + offset if page_num != '' else None
+
+                    # 缺少上级标题时, 补上占位的上级节点
+                    while len(node_stack) < cur_level:
+                        print(f'Warning: Title "{title}": missing {len(node_stack)} level title')
+                        node_stack.append(node_stack[-1].new_child(title='.'*5, level=len(node_stack)))
+
+                    del node_stack[cur_level:]
+                    node_stack.append(node_stack[-1].new_child(
+                        level=cur_level, title=title, page_num=page_num))
+            record['nodes'] = len(self._tree) - node_count
+
+    @staticmethod
+    def _label_page_num(title, label, page_labels, near_page=1):
+        """Page number (from 1) of a printed page label, None for an empty label"""
+        if label == '':
+            return None
+        if page_labels is None:
+            raise ValueError(f'Title "{title}": page label "{label}" can only be resolved '
+                             f'with the pdf (add/sync/format_add)')
+        page_index = page_labels.page_index(label, near_page - 1)
+        if page_index is None:
+            raise ValueError(f'Title "{title}": page label "{label}" not found in the pdf')
+        return page_index + 1
+
+    def walk(self):
+        """Iterate over (node, depth) of all descendants in pre-order, without recursion"""
+        tree = self._tree
+        for index, depth in tree.iter_rows(self._index):
+            yield self._view(tree, index), depth
+
+    def get_depth(self):
+        """Depth of the deepest descendant, 0 for a leaf node"""
+        return max((depth for _, depth in self._tree.iter_rows(self._index)), default=0)
+
+    def copy_to(self, parent, page_shift=0, page_range=None):
+        """
+        Copy the descendants of this node as children of parent, page numbers shifted by page_shift.
+        page_range: (first, last) page, only copy the nodes whose pages overlap the range, pages
+        before first are moved to first. The pages of a node are from its own page (without one,
+        the page of the previous sibling that has one, or the first page of the parent) to the
+        page before the next sibling that has one, or to the last page of the parent
+        """
+        first_page, last_page = page_range or (1, sys.maxsize)
+        level = parent.level + 1 if parent.parent is not None else 1
+        # (源节点的子节点, 目标父节点, 级别, 父节点范围的首页, 末页) 栈
+        stack = [(list(self.child), parent, level, 1, sys.maxsize)]
+        while stack:
+            children, dst_parent, level, start_page, parent_end = stack.pop()
+
+            # 每个节点之后第一个有页码的兄弟的页码
+            next_pages = [None] * len(children)
+            next_page = None
+            for i in range(len(children) - 1, -1, -1):
+                next_pages[i] = next_page
+                if children[i].page_num is not None:
+                    next_page = children[i].page_num
+
+            for node, next_page in zip(children, next_pages):
+                page_num = node.page_num
+                if page_num is not None:
+                    start_page = page_num
+                end_page = max(next_page - 1 if next_page is not None else parent_end, start_page)
+                if page_range and (start_page > last_page or end_page < first_page):
+                    continue
+                if page_num is not None:
+                    page_num = max(page_num, first_page) + page_shift
+                copy = dst_parent.new_child(level=level, title=node.title, page_num=page_num)
+                stack.append((list(node.child), copy, level + 1, start_page, end_page))
+
+    def load_from_items(self, items):
+        """Build the tree from (level, title, page number or None) items in pre-order"""
+        node_stack = [self]
+        for level, title, page_num in items:
+            del node_stack[level:]
+            node_stack.append(node_stack[-1].new_child(level=level, title=title, page_num=page_num))
+
+    def convert_to_txt(self, config=None):
+        """Format all the nodes of this tree as bookmark text with the separators of config"""
+        config = config or BookmarkConfig.get()
+        mark_level = config.mark_level
+        mark_page = config.mark_page
+        tree = self._tree
+        titles, title_ids = tree.titles, tree.title_id
+        levels, page_nums = tree.level, tree.page_num
+
+        bookmark_list = []
+        for index, _ in tree.iter_rows(self._index):
+            level_mark = mark_level * (levels[index] - 1)
+            page_num = page_nums[index] if page_nums[index] != BookmarkTree.NO_PAGE else ''
+            bookmark_list.append(f'{level_mark}{titles[title_ids[index]]}{mark_page}{page_num}')
+
+        return '\n'.join(bookmark_list)
+
+    def load_from_dict(self, bookmarks_dict, level=0):
+
+        def _page_num(node_dict):
+            page_num = node_dict['page_num']
+            return page_num - 1 if page_num != '' else None
+
+        self.title = bookmarks_dict['title']
+        self.page_num = _page_num(bookmarks_dict)
+        self.child = []
+        self.level = level
+        #self.level = bookmarks_dict['level']
+        stack = [(self, bookmarks_dict)]
+        while stack:
+            parent, parent_dict = stack.pop()
+            for child_dict in parent_dict['child']:
+                child = parent.new_child(level=parent.level + 1, title=child_dict['title'],
+                                         page_num=_page_num(child_dict))
+                stack.append((child, child_dict))
+
+    def convert_to_dict(self):
+
+        def _node_dict(node):
+            return {
+                'title': node.title,
+                'page_num': node.page_num + 1 if node.page_num != None else '',
+                'child': [],
+                'level': node.level
+            }
+
+        root_dict = _node_dict(self)
+        stack = [(self, root_dict)]
+        while stack:
+            node, node_dict = stack.pop()
+            for child in node.child:
+                child_dict = _node_dict(child)
+                node_dict['child'].append(child_dict)
+                stack.append((child, child_dict))
+        return root_dict
+
+    def load_from_json(self, json_file_path, config=None):
+        config = config or BookmarkConfig.get()
+        bookmarks_dict = PublicFunc.read_json_file(json_file_path, encoding=config.in_encoding)
+        self.load_from_dict(bookmarks_dict)
+
+    def iter_json(self):
+        """
+        Yield the json text of convert_to_dict() piece by piece, same layout as
+        json.dumps(indent=4), without recursion (json.dumps overflows the C stack on deep trees)
+        """
+        tree = self._tree
+        titles, title_ids = tree.titles, tree.title_id
+        levels, page_nums = tree.level, tree.page_num
+
+        def _page_num(page_num):
+            return page_num + 1 if page_num != BookmarkTree.NO_PAGE else ''
+
+        items = [(0, self.title, _page_num(page_nums[self._index]), self.level)]
+        items = chain(items, ((depth, titles[title_ids[index]], _page_num(page_nums[index]), levels[index])
+                              for index, depth in tree.iter_rows(self._index)))
+        return self.iter_json_items(items)
+
+    @staticmethod
+    def iter_json_items(items):
+        """
+        Yield the json text of nested node dicts like convert_to_dict(), items are
+        (depth, title, page_num, level) in pre-order, starting with the root at depth 0
+        """
+        dumps = json.dumps
+        indent = ' ' * 4
+        # 尚未闭合的节点: [深度, 结尾文本, 是否已有子节点]
+        open_nodes = []
+
+        def _close(node):
+            depth, tail, has_child = node
+            return f'\n{indent * (2*depth + 1)}]{tail}' if has_child else '[]' + tail
+
+        for depth, title, page_num, level in items:
+            while open_nodes and open_nodes[-1][0] >= depth:
+                yield _close(open_nodes.pop())
+            if open_nodes:
+                parent = open_nodes[-1]
+                yield ('[' if not parent[2] else ',') + '\n' + indent * (2*depth)
+                parent[2] = True
+
+            key_indent = '\n' + indent * (2*depth + 1)
+            yield (f'{{{key_indent}"title": {dumps(title, ensure_ascii=False)},'
+                   f'{key_indent}"page_num": {dumps(page_num)},'
+                   f'{key_indent}"child": ')
+            open_nodes.append([depth, f',{key_indent}"level": {dumps(level)}\n{indent * (2*depth)}}}', False])
+
+        while open_nodes:
+            yield _close(open_nodes.pop())
+
+    @staticmethod
+    def iter_txt_items(items, config=None):
+        """Yield the bookmark text of (level, title, page_num) items, same as convert_to_txt()"""
+        config = config or BookmarkConfig.get()
+        mark_level = config.mark_level
+        mark_page = config.mark_page
+        line_break = ''
+        for level, title, page_num in items:
+            yield f'{line_break}{mark_level * (level - 1)}{title}{mark_page}{"" if page_num is None else page_num}'
+            line_break = '\n'
+
+    def convert_to_json(self):
+        return ''.join(self.iter_json())
+
+    def print_tree(self):
+        """Print all the nodes of this tree"""
+        stack = [(num, child, 1) for num, child in reversed(list(enumerate(self.child)))]
+        while stack:
+            num, node, depth = stack.pop()
+            print("{}[{}] {}".format("   " * depth, num, node))
+            stack.extend((num, child, depth + 1)
+                         for num, child in reversed(list(enumerate(node.child))))
+    
+    def print_tree2(self):
+        print(self.convert_to_txt())
+        
+    def print_child(self):
+        """Print all the children of this node"""
+        for num, child in enumerate(self.child):
+            print("[{}] {}".format(num, child))
+
+    def __repr__(self):
+        """String representation of object"""
+        child_count = len(self._tree.children(self._index))
+        return "{} -> p{}{}".format(
+            self.title,
+            self.page_num,
+            ", c{}".format(child_count) if child_count else "")
+
+
+class OutlineBackend(object):
+    '''
+    PDF 大纲的读写后端, 按名称注册, OutlineBackend.get(name) 取得实例.
+    read_outline 把大纲读入书签树, write_outline 把书签树追加到大纲, remove_outline 删除大纲,
+    sync_outline 按书签树逐项修改大纲
+    '''
+
+    name = None
+    BACKENDS = {}
+
+    @classmethod
+    def register(cls, backend_class):
+        cls.BACKENDS[backend_class.name] = backend_class()
+        return backend_class
+
+    @classmethod
+    def get(cls, name=None):
+        return cls.BACKENDS[name or Constant.DEFAULT_BACKEND]
+
+    @staticmethod
+    def _dest_resolver(pdf):
+        with metrics_stage('dest_index') as record:
+            resolver = OutlineDestResolver(pdf)
+            record['pages'] = len(resolver.page_index)
+            record['named_dests'] = len(resolver.named_dests)
+        return resolver
+
+    @staticmethod
+    def outline_depth(pdf, limit, budget=None):
+        """
+        Number of levels of the outline of pdf, without recursion, counted up to limit + 1.
+        budget: OutlineBudget each item is counted against (OutlineLimitError over a limit),
+        a repeated item then also returns limit + 1
+        """
+        outlines = pdf.Root.get('/Outlines')
+        if not isinstance(outlines, pikepdf.Dictionary):
+            return 0
+        Dictionary = pikepdf.Dictionary
+        depth = count = 0
+        visited = set()
+        stack = [(outlines.get('/First'), 1)]
+        while stack:
+            item, level = stack.pop()
+            while isinstance(item, Dictionary):
+                if item.is_indirect:
+                    if item.objgen in visited:
+                        if budget is not None:
+                            return limit + 1
+                        break
+                    visited.add(item.objgen)
+                if budget is not None:
+                    count += 1
+                    budget.step(count)
+                if level > depth:
+                    depth = level
+                    if depth > limit:
+                        return depth
+                first_child = item.get('/First')
+                if isinstance(first_child, Dictionary):
+                    stack.append((first_child, level + 1))
+                item = item.get('/Next')
+        return depth
+
+    @staticmethod
+    def _diff_siblings(titles, nodes):
+        """
+        Match a sibling list of outline items, titles are their titles, with nodes by title.
+        Yield (item index or None, node index or None) in the new order: None for a node to
+        insert or an item to remove, the items and nodes of a replaced run are paired by position
+        """
+        matcher = SequenceMatcher(None, titles, [node.title for node in nodes], autojunk=False)
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            paired = min(i2 - i1, j2 - j1)
+            for k in range(paired):
+                yield i1 + k, j1 + k
+            for i in range(i1 + paired, i2):
+                yield i, None
+            for j in range(j1 + paired, j2):
+                yield None, j
+
+    @staticmethod
+    def _edit_path(path, title):
+        return ' > '.join(path + (title,))
+
+    def read_outline(self, root, pdf):
+        raise NotImplementedError
+
+    def write_outline(self, root, pdf):
+        raise NotImplementedError
+
+    def remove_outline(self, pdf):
+        raise NotImplementedError
+
+    def sync_outline(self, root, pdf):
+        raise NotImplementedError
+
+
+@OutlineBackend.register
+class PikepdfOutlineBackend(OutlineBackend):
+    '''经由 pikepdf 的 open_outline() 和 OutlineItem 读写大纲'''
+
+    name = 'pikepdf'
+
+    def read_outline(self, root, pdf):
+        budget = OutlineBudget.current()
+
+        def _generate_tree(root_outlines):
+            # (父节点, 大纲项, 级别) 栈, 逆序入栈以保持原有顺序
+            stack = [(root, outline, 1) for outline in reversed(root_outlines)]
+            count = 0
+            while stack:
+                parent_node, cur_outline, level = stack.pop()
+                count += 1
+                budget.step(count)
+
+                page_num = resolver.page_number(cur_outline)
+                page_num = int(page_num + 1) if page_num != None else None # 如果有页码,则 + 1
+                current_node = parent_node.new_child(
+                    level=level, title=cur_outline.title.strip(), page_num=page_num)
+
+                stack.extend((current_node, child_outline, level + 1)
+                             for child_outline in reversed(cur_outline.children))
+
+        # pikepdf 一次读入整个大纲, 读入期间不能检查限制: 太深、有循环引用或超出限制
+        # (包括 -max-outline-depth) 的大纲由 objects 后端逐项读取, 保留限制内的部分并报告
+        max_depth = min(Constant.PIKEPDF_MAX_DEPTH, budget.max_depth)
+        if not self.fits(pdf, max_depth):
+            return OutlineBackend.get(ObjectOutlineBackend.name).read_outline(root, pdf)
+
+        resolver = self._dest_resolver(pdf)
+        # 只读, 不使用 with open_outline(), 避免退出时重写整个大纲
+        with metrics_stage('open_outline'):
+            outline_obj = self.open_outline(pdf, max_depth)
+        with metrics_stage('load_from_pdf', backend=self.name) as record:
+            node_count = len(root._tree)
+            try:
+                _generate_tree(outline_obj.root)
+            except OutlineLimitError as e:
+                budget.report(f'outline: {e}')
+                record['truncated'] = str(e)
+            record['nodes'] = len(root._tree) - node_count
+            record['named_lookups'] = resolver.named_lookups
+
+    @staticmethod
+    def fits(pdf, max_depth):
+        """Whether pikepdf can load the outline of pdf: no cycle, max_depth levels, within the budget"""
+        try:
+            return OutlineBackend.outline_depth(pdf, max_depth, OutlineBudget.current()) <= max_depth
+        except OutlineLimitError:
+            return False
+
+    @staticmethod
+    def open_outline(pdf, max_depth):
+        """pdf.open_outline(), cycles of a damaged outline are broken and reported"""
+        outline_obj = pdf.open_outline(max_depth=max_depth, strict=True)
+        try:
+            # 大纲在第一次访问 root 时读取
+            outline_obj.root
+        except pikepdf.OutlineStructureError as e:
+            # 不严格模式下重复出现的项及其后的兄弟被忽略
+            OutlineBudget.current().report(f'outline: {e}, cycle broken')
+            outline_obj = pdf.open_outline(max_depth=max_depth)
+        return outline_obj
+
+    def write_outline(self, root, pdf):
+        # 追加时 pikepdf 会读出并重写已有的大纲, 两者都须在递归能处理的层级内, 已有的大纲也须完好
+        max_depth = Constant.PIKEPDF_MAX_DEPTH
+        if root.get_depth() > max_depth or not self.fits(pdf, max_depth):
+            return OutlineBackend.get(ObjectOutlineBackend.name).write_outline(root, pdf)
+
+        # pdf.pages[i] 每次访问都是 O(n), 预先取出所有页面对象
+        page_objs = [page.obj for page in pdf.pages]
+        with pdf.open_outline(max_depth=max_depth) as outline_obj:
+            BookmarkNode._append_outline_items(root.child, outline_obj.root, page_objs)
+
+    def remove_outline(self, pdf):
+        with pdf.open_outline() as outline_obj:
+            outline_obj.root.clear()
+
+    def sync_outline(self, root, pdf):
+        # 超出 pikepdf 递归能处理的层级, 或已有的大纲损坏、超出限制: 由 objects 后端修改
+        max_depth = Constant.PIKEPDF_MAX_DEPTH
+        if root.get_depth() > max_depth or not self.fits(pdf, max_depth):
+            return OutlineBackend.get(ObjectOutlineBackend.name).sync_outline(root, pdf)
+
+        resolver = self._dest_resolver(pdf)
+        page_objs = [page.obj for page in pdf.pages]
+        edit_path = self._edit_path
+        edits = []
+
+        def _update_item(item, node, path):
+            old_title = item.title.strip()
+            if old_title != node.title:
+                edits.append(f'~ {edit_path(path, old_title)}: title -> "{node.title}"')
+                item.title = node.title
+
+            old_page = resolver.page_number(item)
+            old_page = old_page + 1 if old_page != None else None
+            if old_page != node.page_num:
+                edits.append(f'~ {edit_path(path, node.title)}: page {old_page} -> {node.page_num}')
+                item.destination = BookmarkNode._make_dest(node, page_objs)
+                item.action = None
+                if item.obj is not None and item.destination is None:
+                    for key in ('/Dest', '/A'):
+                        if key in item.obj:
+                            del item.obj[key]
+
+        with self.open_outline(pdf, max_depth) as outline_obj:
+            # (大纲项列表, 对应的书签节点列表, 路径) 栈
+            stack = [(outline_obj.root, list(root.child), ())]
+            while stack:
+                items, nodes, path = stack.pop()
+                new_items = []
+                sub_lists = []
+                for i, j in self._diff_siblings([item.title.strip() for item in items], nodes):
+                    if j is None:
+                        edits.append(f'- {edit_path(path, items[i].title.strip())}')
+                        continue
+                    node = nodes[j]
+                    if i is None:
+                        edits.append(f'+ {edit_path(path, node.title)}: page {node.page_num}')
+                        BookmarkNode._append_outline_items([node], new_items, page_objs)
+                        continue
+                    _update_item(items[i], node, path)
+                    new_items.append(items[i])
+                    sub_lists.append((items[i].children, list(node.child), path + (node.title,)))
+                items[:] = new_items
+                stack.extend(reversed(sub_lists))
+
+        return edits
+
+
+@OutlineBackend.register
+class ObjectOutlineBackend(OutlineBackend):
+    '''
+    直接读写大纲字典: 沿 /First /Next 链读取, 写入时逐项生成字典并链接
+    /Parent /First /Last /Prev /Next /Count, 不经过 OutlineItem, 也没有递归
+    '''
+
+    name = 'objects'
+
+    def read_outline(self, root, pdf):
+        resolver = self._dest_resolver(pdf)
+        outlines = pdf.Root.get('/Outlines')
+        if not isinstance(outlines, pikepdf.Dictionary):
+            return
+
+        Dictionary = pikepdf.Dictionary
+        item_page_number = resolver.item_page_number
+        budget = OutlineBudget.current()
+        with metrics_stage('load_from_pdf', backend=self.name) as record:
+            node_count = len(root._tree)
+            # 与 pikepdf 相同, 重复出现的大纲项及其后的兄弟被忽略
+            visited = set()
+            # (父节点, 第一个子大纲项, 级别) 栈, 兄弟节点在同一帧内按 /Next 顺序读取
+            stack = [(root, outlines.get('/First'), 1)]
+            try:
+                while stack:
+                    parent_node, item, level = stack.pop()
+                    while isinstance(item, Dictionary):
+                        if item.is_indirect:
+                            if item.objgen in visited:
+                                budget.report(f'outline: {budget.repeated(item)}')
+                                break
+                            visited.add(item.objgen)
+                        budget.step(len(root._tree) - node_count + 1)
+
+                        title = item.get('/Title')
+                        page_num = item_page_number(item)
+                        node = parent_node.new_child(
+                            level=level, title=str(title).strip() if title is not None else '',
+                            page_num=page_num + 1 if page_num is not None else None)
+
+                        first_child = item.get('/First')
+                        if isinstance(first_child, Dictionary):
+                            if level < budget.max_depth:
+                                stack.append((node, first_child, level + 1))
+                            else:
+                                budget.report(f'outline: items deeper than {budget.max_depth} levels skipped')
+                        item = item.get('/Next')
+            except OutlineLimitError as e:
+                budget.report(f'outline: {e}')
+                record['truncated'] = str(e)
+            record['nodes'] = len(root._tree) - node_count
+            record['named_lookups'] = resolver.named_lookups
+
+    @staticmethod
+    def _make_items(nodes, parent_obj, pdf, page_objs):
+        """
+        Outline dictionaries of nodes and their subtrees, with /Count of all items expanded.
+        The top level ones are linked to each other under parent_obj and returned in a list,
+        the caller links them into the sibling list. Return (top level dictionaries, items created)
+        """
+        Dictionary, String = pikepdf.Dictionary, pikepdf.String
+        make_indirect = pdf.make_indirect
+        make_dest = BookmarkNode._make_dest
+
+        # 按创建顺序记录 (大纲字典, 父项序号), 父项总在子项之前创建
+        items = []
+        parents = []
+        top = []
+        stack = [(nodes, parent_obj, -1)]
+        while stack:
+            children, parent, parent_index = stack.pop()
+            prev = first = None
+            for child in children:
+                fields = {'/Title': String(child.title), '/Parent': parent}
+                dest = make_dest(child, page_objs)
+                if dest is not None:
+                    fields['/Dest'] = dest
+                if prev is not None:
+                    fields['/Prev'] = prev
+                obj = make_indirect(Dictionary(fields))
+                if prev is not None:
+                    prev.Next = obj
+                if first is None:
+                    first = obj
+                prev = obj
+                items.append(obj)
+                parents.append(parent_index)
+                if parent_index < 0:
+                    top.append(obj)
+                stack.append((child.child, obj, len(items) - 1))
+            if first is not None and parent_index >= 0:
+                parent.First = first
+                parent.Last = prev
+
+        # /Count: 全部展开时为子孙项的个数, 自底向上累加
+        counts = [0] * len(items)
+        for i in range(len(items) - 1, -1, -1):
+            items[i].Count = counts[i]
+            if parents[i] >= 0:
+                counts[parents[i]] += counts[i] + 1
+        return top, len(items)
+
+    @staticmethod
+    def _outlines(pdf):
+        outlines = pdf.Root.get('/Outlines')
+        if outlines is None:
+            pdf.Root.Outlines = pdf.make_indirect(pikepdf.Dictionary(Type=pikepdf.Name.Outlines))
+            outlines = pdf.Root.Outlines
+        return outlines
+
+    def write_outline(self, root, pdf):
+        page_objs = [page.obj for page in pdf.pages]
+        outlines = self._outlines(pdf)
+        top, created = self._make_items(root.child, outlines, pdf, page_objs)
+        if top:
+            # 追加到已有大纲的末尾
+            last = outlines.get('/Last')
+            if last is not None:
+                last.Next = top[0]
+                top[0].Prev = last
+            if '/First' not in outlines:
+                outlines.First = top[0]
+            outlines.Last = top[-1]
+            outlines.Count = int(outlines.get('/Count', 0)) + created
+
+    def remove_outline(self, pdf):
+        if '/Outlines' in pdf.Root:
+            del pdf.Root.Outlines
+
+    @staticmethod
+    def _link(obj, key, target):
+        """Set obj[key] to target, delete it for None; unchanged links are not written"""
+        current = obj.get(key)
+        if target is None:
+            if current is not None:
+                del obj[key]
+        elif (current is None or not target.is_indirect
+              or not current.is_indirect or current.objgen != target.objgen):
+            obj[key] = target
+
+    @staticmethod
+    def _update_counts(outlines):
+        """Recount /Count of the whole outline bottom up, closed items (negative /Count) stay closed"""
+        Dictionary = pikepdf.Dictionary
+        # 先序记录 (大纲字典, 父项序号), 子项总在父项之后
+        order = []
+        parents = []
+        stack = [(outlines, -1)]
+        while stack:
+            obj, parent_index = stack.pop()
+            order.append(obj)
+            parents.append(parent_index)
+            index = len(order) - 1
+            child = obj.get('/First')
+            while isinstance(child, Dictionary):
+                stack.append((child, index))
+                child = child.get('/Next')
+
+        # 展开时可见的子孙项数
+        visible = [0] * len(order)
+        for i in range(len(order) - 1, -1, -1):
+            obj = order[i]
+            closed = i > 0 and int(obj.get('/Count', 0)) < 0
+            count = -visible[i] if closed else visible[i]
+            if int(obj.get('/Count', 0)) != count or (count == 0 and i > 0 and '/Count' not in obj):
+                obj.Count = count
+            if parents[i] >= 0:
+                visible[parents[i]] += 1 + (0 if closed else visible[i])
+
+    def sync_outline(self, root, pdf):
+        budget = OutlineBudget.current()
+        # 先检查已有的大纲, 有循环引用或超出限制时整个重写, 不会只改了一部分
+        try:
+            damaged = self.outline_depth(pdf, budget.max_depth, budget) > budget.max_depth
+        except OutlineLimitError:
+            damaged = True
+        if damaged:
+            self.remove_outline(pdf)
+            self.write_outline(root, pdf)
+            return ['* outline damaged or over the limits: rewritten']
+
+        Dictionary, String = pikepdf.Dictionary, pikepdf.String
+        resolver = self._dest_resolver(pdf)
+        page_objs = [page.obj for page in pdf.pages]
+        outlines = self._outlines(pdf)
+        link = self._link
+        edit_path = self._edit_path
+        edits = []
+
+        def _title(item):
+            title = item.get('/Title')
+            return str(title).strip() if title is not None else ''
+
+        def _update_item(item, node, path):
+            old_title = _title(item)
+            if old_title != node.title:
+                edits.append(f'~ {edit_path(path, old_title)}: title -> "{node.title}"')
+                item.Title = String(node.title)
+
+            old_page = resolver.item_page_number(item)
+            old_page = old_page + 1 if old_page is not None else None
+            if old_page != node.page_num:
+                edits.append(f'~ {edit_path(path, node.title)}: page {old_page} -> {node.page_num}')
+                for key in ('/Dest', '/A'):
+                    if key in item:
+                        del item[key]
+                dest = BookmarkNode._make_dest(node, page_objs)
+                if dest is not None:
+                    item.Dest = dest
+
+        # (父大纲字典, 对应的书签节点列表, 路径) 栈
+        stack = [(outlines, list(root.child), ())]
+        while stack:
+            parent_obj, nodes, path = stack.pop()
+            items = []
+            item = parent_obj.get('/First')
+            while isinstance(item, Dictionary):
+                items.append(item)
+                item = item.get('/Next')
+
+            new_items = []
+            sub_lists = []
+            for i, j in self._diff_siblings([_title(item) for item in items], nodes):
+                if j is None:
+                    edits.append(f'- {edit_path(path, _title(items[i]))}')
+                    continue
+                node = nodes[j]
+                if i is None:
+                    edits.append(f'+ {edit_path(path, node.title)}: page {node.page_num}')
+                    new_items.extend(self._make_items([node], parent_obj, pdf, page_objs)[0])
+                    continue
+                _update_item(items[i], node, path)
+                new_items.append(items[i])
+                sub_lists.append((items[i], list(node.child), path + (node.title,)))
+
+            # 重新链接兄弟列表, 删除的项不再被引用
+            prev = None
+            for item in new_items:
+                link(item, '/Prev', prev)
+                if prev is not None:
+                    link(prev, '/Next', item)
+                prev = item
+            if prev is not None:
+                link(prev, '/Next', None)
+            link(parent_obj, '/First', new_items[0] if new_items else None)
+            link(parent_obj, '/Last', prev)
+            stack.extend(reversed(sub_lists))
+
+        self._update_counts(outlines)
+        return edits
+
+
+class MyPDFHandler(object):
+    '''
+    封装的PDF文件处理类
+    '''
+
+    def __init__(self, in_pdf_path, incremental=False, pdf=None, backend=None,
+                 in_place=False, mmap=False, config=None):
+        """
+        incremental: 保存时只把修改过的书签相关对象追加到原文件末尾(增量更新),
+        为此在修改前记录书签对象的原始内容
+        pdf: 已经打开的 in_pdf_path (例如服务模式的文档池中的句柄)
+        backend: 读写大纲的 OutlineBackend 名称, 默认 Constant.DEFAULT_BACKEND
+        in_place, mmap: 输出会覆盖 in_pdf_path / 只读取大纲, 见 open_pdf
+        config: 读写书签文件的 BookmarkConfig, 默认 BookmarkConfig.get()
+        """
+        self.__in_pdf_path = in_pdf_path
+        self.__backend = backend
+        self.__config = config or BookmarkConfig.get()
+        with metrics_stage('open', pooled=pdf is not None) as record:
+            self.__pdf_reader = pdf if pdf is not None else self.open_pdf(
+                in_pdf_path, in_place, mmap)
+            self.__original_objects = self.__outline_objects() if incremental else None
+            # 惰性打开或内存映射时只读取用到的部分, 这里是文件大小而不是读取的字节数
+            record['file_size'] = os.path.getsize(in_pdf_path)
+            record['pages'] = len(self.__pdf_reader.pages)
+        # 印刷页码标签, 第一次使用时才解析
+        self.page_labels = PageLabels(self.__pdf_reader)
+
+    @staticmethod
+    def open_pdf(pdf_path, in_place=False, mmap=False):
+        """
+        Open pdf_path lazily, objects are read when first used, so memory does not grow with
+        the file size. The file is copied into memory only for an in place save on systems
+        that can not replace an open file (see write_to_pdf).
+        mmap: memory map the file, for jobs that only read a few objects such as the outline;
+        saving reads every stream, the mapped pages would then all count as resident memory
+        """
+        if in_place and not Constant.REPLACE_OPEN_FILES:
+            return pikepdf.Pdf.open(pdf_path, allow_overwriting_input=True)
+        access_mode = pikepdf.AccessMode.mmap if mmap else pikepdf.AccessMode.stream
+        return pikepdf.Pdf.open(pdf_path, access_mode=access_mode)
+
+    def generate_bookmark_tree(self, input=''):
+        self.bookmark_tree = BookmarkNode(title='Root')
+
+        if input == '':
+            self.bookmark_tree.load_from_pdf(self.__pdf_reader, self.__backend)
+            return
+
+        if type(input) is dict:
+            self.bookmark_tree.load_from_dict(input)
+            return
+
+        name_parts = os.path.splitext(input.lower())
+        if name_parts[1] == '.txt':
+            self.bookmark_tree.load_from_txt(input, self.__config, self.page_labels)
+        elif name_parts[1] == '.json':
+            self.bookmark_tree.load_from_json(input, self.__config)
+        else:
+            raise Exception(f'Invalid input file: {input}')
+
+    def generate_formatted_bookmark_tree(self, input_bmk_path, formatted_bmk_path=None,
+                                         rules_path=None):
+        """
+        Format a txt bookmark file and parse it in one pass without writing it to disk,
+        the formatted text is also saved to formatted_bmk_path if given
+        """
+        config = self.__config
+        lines = PublicFunc.iter_text_file(input_bmk_path, config.in_encoding)
+        lines = BookmarkFormatter.get(rules_path, config).format_lines(lines)
+        if formatted_bmk_path:
+            lines = PublicFunc.tee_text_file(lines, formatted_bmk_path, config.out_encoding)
+
+        self.bookmark_tree = BookmarkNode(title='Root')
+        self.bookmark_tree.load_from_text(lines, config, self.page_labels)
+
+    def iter_outline(self, max_depth=0, page_range=None):
+        """
+        Walk the outline dictionaries of the pdf in pre-order without building a tree,
+        yield (level, title, page number or None). Destinations are resolved by the
+        resolver of the handler's backend.
+        max_depth: skip items deeper than this level, 0 for no limit.
+        page_range: (first, last) page, skip items whose pages are outside the range, together
+        with their subtrees; the pages of an item are the same as in BookmarkNode.copy_to.
+        Destinations of skipped subtrees are not resolved.
+        """
+        outlines = self.__pdf_reader.Root.get('/Outlines')
+        if outlines is None or '/First' not in outlines:
+            return
+
+        resolver = OutlineBackend.get(self.__backend)._dest_resolver(self.__pdf_reader)
+        budget = OutlineBudget.current()
+        visited = set()
+
+        def _enter(item):
+            # 每个大纲项只读取一次, 损坏的文件中 /Next 或 /First 可能指向已读取的项
+            if not isinstance(item, pikepdf.Dictionary):
+                return None
+            if item.is_indirect:
+                if item.objgen in visited:
+                    budget.report(f'outline: {budget.repeated(item)}')
+                    return None
+                visited.add(item.objgen)
+            budget.step(len(visited))
+            return item
+
+        def _page(item):
+            if item is None:
+                return None
+            page_num = resolver.item_page_number(item)
+            return page_num + 1 if page_num is not None else None
+
+        def _next_page(item):
+            # item 之后第一个有页码的兄弟的页码, 只向后查看, 不标记为已读取
+            seen = set()
+            item = item.get('/Next')
+            while isinstance(item, pikepdf.Dictionary):
+                if item.is_indirect:
+                    if item.objgen in visited or item.objgen in seen:
+                        return None
+                    seen.add(item.objgen)
+                page_num = _page(item)
+                if page_num is not None:
+                    return page_num
+                item = item.get('/Next')
+            return None
+
+        UNKNOWN = object()
+        page_count = len(resolver.page_index)
+        first_page, last_page = page_range or (1, page_count)
+        try:
+            # 每层一个栈帧: [级别, 当前页(上一个有页码的兄弟或父节点的首页), 父节点范围的末页,
+            #               下一个大纲项, 其页码, 其后第一个有页码的兄弟的页码(连续没有页码的项共用)]
+            first = _enter(outlines.get('/First'))
+            stack = [[1, 1, page_count, first, _page(first), UNKNOWN]]
+            while stack:
+                frame = stack[-1]
+                level, start_page, parent_end, item, page_num, following = frame
+                if item is None:
+                    stack.pop()
+                    continue
+
+                next_item = _enter(item.get('/Next'))
+                next_page = _page(next_item)
+                if next_page is not None or next_item is None:
+                    following = next_page
+                elif following is UNKNOWN:
+                    following = _next_page(next_item)
+                frame[3], frame[4] = next_item, next_page
+                # 下一项有页码时, 其后的兄弟须重新查找
+                frame[5] = following if next_page is None else UNKNOWN
+
+                # 本项的范围: 自身页码(没有时为当前页)到下一个有页码的兄弟的前一页,
+                # 没有这样的兄弟时到父节点范围的末页
+                if page_num is not None:
+                    start_page = frame[1] = page_num
+                end_page = max(following - 1 if following is not None else parent_end, start_page)
+                if page_range and (start_page > last_page or end_page < first_page):
+                    continue
+
+                yield level, str(item.get('/Title', '')).strip(), page_num
+                if (not max_depth or level < max_depth) and '/First' in item:
+                    if level >= budget.max_depth:
+                        budget.report(f'outline: items deeper than {budget.max_depth} levels skipped')
+                        continue
+                    child = _enter(item.First)
+                    stack.append([level + 1, start_page, end_page, child, _page(child), UNKNOWN])
+        except OutlineLimitError as e:
+            # 保留已经输出的部分
+            budget.report(f'outline: {e}')
+
+    def export_bookmarks(self, out_bookmark_path, max_depth=0, page_range=None):
+        """
+        Stream the outline of the pdf to a txt or json file, see iter_outline for the filters.
+        With config.page_labels, a txt file gets printed page labels after a //labels line
+        """
+        node_count = 0
+
+        def _count(items):
+            nonlocal node_count
+            for item in items:
+                node_count += 1
+                yield item
+
+        items = _count(self.iter_outline(max_depth, page_range))
+        if os.path.splitext(out_bookmark_path)[1].lower() == '.json':
+            # 与 convert_to_json 相同: 根节点 Root, json 中的页码为书签页码 + 1
+            items = chain([(0, 'Root', 1, 1)],
+                          ((level, title, page_num + 1 if page_num is not None else '', level)
+                           for level, title, page_num in items))
+            pieces = BookmarkNode.iter_json_items(items)
+        elif self.__config.page_labels:
+            label = self.page_labels.label
+            items = ((level, title, label(page_num - 1) if page_num is not None else None)
+                     for level, title, page_num in items)
+            pieces = chain([f'//{Constant.PAGE_LABELS_LINE}\n'],
+                           BookmarkNode.iter_txt_items(items, self.__config))
+        else:
+            pieces = BookmarkNode.iter_txt_items(items, self.__config)
+
+        with metrics_stage('export') as record, \
+                open(out_bookmark_path, 'w', encoding=self.__config.out_encoding) as f:
+            f.writelines(pieces)
+            record['nodes'] = node_count
+        record['bytes_written'] = os.path.getsize(out_bookmark_path)
+
+    def bookmark_tree_to_text_file(self, out_bookmark_path):
+        name_parts = os.path.splitext(out_bookmark_path)
+
+        if name_parts[1].lower() == '.json':
+            bookmark_txt = self.bookmark_tree.convert_to_json()
+        elif self.__config.page_labels:
+            # 与 export_bookmarks 相同, 写页码标签
+            label = self.page_labels.label
+            items = ((node.level, node.title, label(node.page_num - 1) if node.page_num is not None else None)
+                     for node, _ in self.bookmark_tree.walk())
+            bookmark_txt = ''.join(chain([f'//{Constant.PAGE_LABELS_LINE}\n'],
+                                         BookmarkNode.iter_txt_items(items, self.__config)))
+        else:
+            bookmark_txt = self.bookmark_tree.convert_to_txt(self.__config)
+
+        PublicFunc.write_text_file(bookmark_txt, out_bookmark_path, self.__config.out_encoding)
+
+    def detect_bookmarks(self, workers=0, toc_max_pages=40, rules_path=None, chunk_size=8):
+        """
+        Build bookmark_tree from the text of the pages: the printed table of contents
+        with its page offset if one is found, otherwise the heading lines of all pages.
+        Pages are scanned in order by a process pool, scanning stops once the table of
+        contents and its offset are found. Return the OutlineDetector.
+        """
+        page_count = len(self.__pdf_reader.pages)
+        detector = OutlineDetector(BookmarkFormatter.get(rules_path, self.__config),
+                                   page_count, toc_max_pages)
+        ranges = [(start, min(start + chunk_size, page_count))
+                  for start in range(0, page_count, chunk_size)]
+        workers = max(1, min(workers or os.cpu_count() or 1, len(ranges)))
+        budget = OutlineBudget.current()
+
+        def _feed(pages):
+            for page_num, lines in pages:
+                if detector.feed(page_num, lines):
+                    return True
+                budget.check()
+            return False
+
+        def _scan():
+            # 按页码顺序把页面交给 detector, 找到目录及其偏移后停止
+            if workers == 1:
+                extractor = PageTextExtractor(self.__pdf_reader)
+                for start, end in ranges:
+                    if _feed(extractor.extract_range(start, end)):
+                        break
+            else:
+                executor = concurrent_futures.ProcessPoolExecutor(
+                    max_workers=workers, initializer=_init_page_text_worker,
+                    initargs=(self.__in_pdf_path,))
+                # 按页码顺序消费结果, 最多 2*workers 个任务在途
+                queued = deque(ranges)
+                pending = deque()
+                try:
+                    while queued or pending:
+                        while queued and len(pending) < workers * 2:
+                            pending.append(executor.submit(_page_text_lines, *queued.popleft()))
+                        if _feed(pending.popleft().result()):
+                            break
+                finally:
+                    # 提前结束时取消还未开始的任务 (shutdown 的 cancel_futures 要求 Python 3.9)
+                    for future in pending:
+                        future.cancel()
+                    executor.shutdown(wait=True)
+
+        with metrics_stage('detect', pages=page_count, workers=workers) as record:
+            try:
+                _scan()
+            except OutlineLimitError as e:
+                # 保留已扫描的页面中找到的书签
+                budget.report(f'detect: {e}')
+                record['truncated'] = str(e)
+            record['pages_scanned'] = detector.pages_scanned
+
+        self.bookmark_tree = BookmarkNode(title='Root')
+        self.bookmark_tree.load_from_text(detector.outline_lines(), self.__config, self.page_labels)
+        return detector
+
+    @staticmethod
+    def merge_pdfs(in_pdf_paths, out_pdf_path, object_streams='preserve',
+                   recompress=False, linearize=False, backend=None):
+        """
+        Concatenate the pdfs into out_pdf_path, the outline of each part is nested under
+        a new top level bookmark named after its file, with page numbers shifted by the
+        offset of the part. Pages are copied with their streams unchanged.
+        Return the number of pages.
+        """
+        merged = pikepdf.Pdf.new()
+        tree = BookmarkNode(title='Root')
+        # 复制的页面在保存时才读取源文件中的流数据, 保存前源文件须保持打开
+        with ExitStack() as stack:
+            for path in in_pdf_paths:
+                part = stack.enter_context(MyPDFHandler.open_pdf(path))
+                offset = len(merged.pages)
+                part_tree = BookmarkNode(title='Root')
+                part_tree.load_from_pdf(part, backend)
+                with metrics_stage('copy_pages', pages=len(part.pages),
+                                   file_size=os.path.getsize(path)):
+                    merged.pages.extend(part.pages)
+
+                title = os.path.splitext(os.path.basename(path))[0]
+                part_node = tree.new_child(level=1, title=title,
+                                           page_num=offset + 1 if len(part.pages) else None)
+                part_tree.copy_to(part_node, page_shift=offset)
+
+            tree.add_to_pdf(merged, backend)
+            with metrics_stage('save', save_mode='full') as record:
+                merged.save(out_pdf_path,
+                            object_stream_mode=pikepdf.ObjectStreamMode[object_streams],
+                            recompress_flate=recompress,
+                            linearize=linearize)
+                record['bytes_written'] = os.path.getsize(out_pdf_path)
+            return len(merged.pages)
+
+    def split_parts(self, ranges=None):
+        """
+        [(first page, last page, name)] of the parts to split into: the page ranges, or by
+        default one part per top level bookmark of bookmark_tree (pages before the first
+        top level bookmark are a part of their own)
+        """
+        page_count = len(self.__pdf_reader.pages)
+        stem = os.path.splitext(os.path.basename(self.__in_pdf_path))[0]
+        if ranges:
+            parts = []
+            for first, last in ranges:
+                if first > page_count:
+                    raise ValueError(f'Page range {first}-{last} out of range, '
+                                     f'pdf has {page_count} pages')
+                last = min(last, page_count)
+                parts.append((first, last, f'{stem}_{first}-{last}'))
+            return parts
+
+        starts = []
+        for node in self.bookmark_tree.child:
+            page_num = node.page_num
+            if page_num is None or not 1 <= page_num <= page_count:
+                continue
+            # 与前一个书签同页或页码倒退的书签, 归入前一部分
+            if starts and page_num <= starts[-1][0]:
+                continue
+            starts.append((page_num, node.title))
+        if not starts or starts[0][0] > 1:
+            starts.insert(0, (1, stem))
+
+        width = len(str(len(starts)))
+        parts = []
+        for i, (first, title) in enumerate(starts):
+            last = starts[i + 1][0] - 1 if i + 1 < len(starts) else page_count
+            parts.append((first, last, f'{i + 1:0{width}d}_{title}'))
+        return parts
+
+    def split_pdf(self, out_dir, ranges=None, workers=0, object_streams='preserve',
+                  recompress=False, linearize=False):
+        """
+        Split the pdf into out_dir by split_parts(ranges), the outline of each part is the
+        outline of the pdf pruned to its pages. Parts are written at the same time by a
+        process pool. Return [(output path, first page, last page)].
+        """
+        self.generate_bookmark_tree()
+        os.makedirs(out_dir, exist_ok=True)
+
+        jobs = []
+        for first, last, name in self.split_parts(ranges):
+            part_tree = BookmarkNode(title='Root')
+            self.bookmark_tree.copy_to(part_tree, page_shift=1 - first, page_range=(first, last))
+            # 以 (级别, 标题, 页码) 列表传给工作进程
+            items = [(depth, node.title, node.page_num) for node, depth in part_tree.walk()]
+            out_path = os.path.join(out_dir, PublicFunc.safe_file_name(name) + '.pdf')
+            jobs.append((out_path, first, last, items, object_streams, recompress, linearize,
+                         self.__backend))
+
+        workers = max(1, min(workers or os.cpu_count() or 1, len(jobs)))
+        with metrics_stage('split_write', files=len(jobs), workers=workers) as record:
+            if workers == 1:
+                for job in jobs:
+                    _write_pdf_part(self.__pdf_reader, *job)
+            else:
+                with concurrent_futures.ProcessPoolExecutor(
+                        max_workers=workers, initializer=_init_split_worker,
+                        initargs=(self.__in_pdf_path,)) as executor:
+                    for future in [executor.submit(_split_worker_part, *job) for job in jobs]:
+                        future.result()
+            record['bytes_written'] = sum(os.path.getsize(job[0]) for job in jobs)
+        return [job[:3] for job in jobs]
+
+    def remove_bookmarks(self):
+        with metrics_stage('remove_bookmarks'):
+            OutlineBackend.get(self.__backend).remove_outline(self.__pdf_reader)
+        
+    def add_bookmarks_to_pdf(self):
+        self.bookmark_tree.add_to_pdf(self.__pdf_reader, self.__backend)
+
+    def sync_bookmarks(self):
+        """Patch the pdf outline to match bookmark_tree, return the edit script"""
+        backend = OutlineBackend.get(self.__backend)
+        with metrics_stage('sync_to_pdf', backend=backend.name) as record:
+            edits = self.bookmark_tree.sync_to_pdf(self.__pdf_reader, backend.name)
+            record['edits'] = len(edits)
+        return edits
+
+    def write_to_pdf(self, out_pdf_path, object_streams='preserve',
+                     recompress=False, linearize=False, fsync=False):
+        """
+        Save the pdf, as an incremental update if the handler was opened with
+        incremental=True (falls back to a full rewrite when not possible).
+        A full save streams into a temporary file next to out_pdf_path that then replaces it,
+        the input pdf is still read from while saving, also when it is out_pdf_path.
+        fsync: flush the output to the disk before returning.
+        Return (save mode, bytes written, seconds).
+        """
+        start_time = time.perf_counter()
+
+        with metrics_stage('save') as record:
+            if self.__original_objects is not None and not linearize:
+                bytes_written = self.__write_incremental(out_pdf_path, fsync)
+                if bytes_written is not None:
+                    record.update(save_mode='incremental', bytes_written=bytes_written)
+                    return 'incremental', bytes_written, time.perf_counter() - start_time
+
+            tmp_path = out_pdf_path + '.tmp'
+            try:
+                self.__pdf_reader.save(tmp_path,
+                                       object_stream_mode=pikepdf.ObjectStreamMode[object_streams],
+                                       recompress_flate=recompress,
+                                       linearize=linearize)
+                if fsync:
+                    PublicFunc.fsync_file(tmp_path)
+                os.replace(tmp_path, out_pdf_path)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            bytes_written = os.path.getsize(out_pdf_path)
+            record.update(save_mode='full', bytes_written=bytes_written)
+            return 'full', bytes_written, time.perf_counter() - start_time
+
+    def close(self):
+        """Close the pdf, also when it was opened by the caller"""
+        self.__pdf_reader.close()
+
+    def __outline_objects(self):
+        """
+        {objgen: 序列化内容} of the catalog and every indirect object of the outline,
+        i.e. all objects that add/sync/remove may change
+        """
+        pdf = self.__pdf_reader
+        objects = {}
+        pending = [pdf.Root]
+        while pending:
+            obj = pending.pop()
+            if not obj.is_indirect or obj.objgen in objects:
+                continue
+            objects[obj.objgen] = (obj, obj.unparse(resolved=True))
+            if obj.objgen == pdf.Root.objgen:
+                if '/Outlines' in obj:
+                    pending.append(obj.Outlines)
+                continue
+            for key in ('/First', '/Next'):
+                if key in obj:
+                    pending.append(obj[key])
+        return objects
+
+    def __write_incremental(self, out_pdf_path, fsync=False):
+        """
+        7.5.6 Incremental updates: append the changed objects, a new cross-reference
+        section and trailer to the original file. Return bytes written, or None if
+        the file is not suitable (encrypted, unknown cross-reference section).
+        """
+        pdf = self.__pdf_reader
+        if pdf.is_encrypted:
+            return None
+
+        with open(self.__in_pdf_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            file_size = f.tell()
+            f.seek(max(0, file_size - 1024))
+            tail = f.read()
+            res = re.search(rb'startxref\s+(\d+)\s+%%EOF\s*$', tail)
+            if res is None:
+                return None
+            prev_xref = int(res.group(1))
+            f.seek(prev_xref)
+            xref_head = f.read(64)
+            f.seek(file_size - 1)
+            ends_with_newline = f.read(1) in b'\r\n'
+
+        if xref_head.startswith(b'xref'):
+            xref_stream = False
+        elif re.match(rb'\d+\s+\d+\s+obj', xref_head):
+            xref_stream = True
+        else:
+            return None
+
+        # 只写入新增或内容有变化的对象
+        changed = []
+        for objgen, (obj, data) in sorted(self.__outline_objects().items()):
+            original = self.__original_objects.get(objgen)
+            if original is None or original[1] != data:
+                changed.append((objgen, data))
+
+        if os.path.abspath(out_pdf_path) != os.path.abspath(self.__in_pdf_path):
+            shutil.copyfile(self.__in_pdf_path, out_pdf_path)
+            bytes_written = file_size
+        else:
+            bytes_written = 0
+
+        separator = b'' if ends_with_newline else b'\n'
+        body = [separator]
+        offset = file_size + len(separator)
+        xref_entries = {}
+        for (num, gen), data in changed:
+            xref_entries[num] = (offset, gen)
+            chunk = b'%d %d obj\n%s\nendobj\n' % (num, gen, data)
+            body.append(chunk)
+            offset += len(chunk)
+
+        size = max(int(pdf.trailer.Size), max(xref_entries, default=0) + 1)
+        trailer = pikepdf.Dictionary(Size=size, Prev=prev_xref)
+        for key in ('/Root', '/Info', '/ID'):
+            if key in pdf.trailer:
+                trailer[key] = pdf.trailer[key]
+
+        if xref_stream:
+            # 原文件使用交叉引用流, 更新部分同样使用交叉引用流
+            xref_num = size
+            xref_entries[xref_num] = (offset, 0)
+            trailer.Size = xref_num + 1
+            trailer.Type = pikepdf.Name.XRef
+            offset_width = 4 if offset < 2**32 else 8
+            trailer.W = pikepdf.Array([1, offset_width, 2])
+            index, data = [], []
+            for num in sorted(xref_entries):
+                if index and index[-2] + index[-1] == num:
+                    index[-1] += 1
+                else:
+                    index += [num, 1]
+                entry_offset, gen = xref_entries[num]
+                data.append(b'\x01' + entry_offset.to_bytes(offset_width, 'big')
+                            + gen.to_bytes(2, 'big'))
+            data = b''.join(data)
+            trailer.Index = pikepdf.Array(index)
+            trailer.Length = len(data)
+            body.append(b'%d 0 obj\n%s\nstream\n%s\nendstream\nendobj\n'
+                        % (xref_num, trailer.unparse(), data))
+        else:
+            body.append(b'xref\n')
+            nums = sorted(xref_entries)
+            start = 0
+            while start < len(nums):
+                end = start + 1
+                while end < len(nums) and nums[end] == nums[end - 1] + 1:
+                    end += 1
+                body.append(b'%d %d\n' % (nums[start], end - start))
+                for num in nums[start:end]:
+                    entry_offset, gen = xref_entries[num]
+                    body.append(b'%010d %05d n\r\n' % (entry_offset, gen))
+                start = end
+            body.append(b'trailer\n%s\n' % trailer.unparse())
+        body.append(b'startxref\n%d\n%%%%EOF\n' % offset)
+
+        update = b''.join(body)
+        with open(out_pdf_path, 'ab') as f:
+            f.write(update)
+            if fsync:
+                f.flush()
+                os.fsync(f.fileno())
+        return bytes_written + len(update)
+
+    @staticmethod
+    def format_bookmark_file(input_bmk_path,
+                             output_bmk_path,
+                             rules_path=None,
+                             config=None):
+        """Format a txt bookmark file with the separators and encodings of config"""
+        config = config or BookmarkConfig.get()
+        formatter = BookmarkFormatter.get(rules_path, config)
+        lines = PublicFunc.iter_text_file(input_bmk_path, config.in_encoding)
+
+        # 逐行写入临时文件再替换, 输入输出可以是同一个文件
+        tmp_path = output_bmk_path + '.tmp'
+        with metrics_stage('format', bytes_read=os.path.getsize(input_bmk_path)) as record:
+            with open(tmp_path, 'w', encoding=config.out_encoding) as f:
+                f.writelines(formatter.format_lines(lines))
+            os.replace(tmp_path, output_bmk_path)
+            record['bytes_written'] = os.path.getsize(output_bmk_path)
+
+    @staticmethod
+    def convert_bookmark_file(input_bmk_path, output_bmk_path, config=None):
+        """Convert a txt / json bookmark file to the format of the extension of output_bmk_path"""
+        config = config or BookmarkConfig.get()
+        tree = BookmarkNode(title='Root')
+        if os.path.splitext(input_bmk_path)[1].lower() == '.json':
+            tree.load_from_json(input_bmk_path, config)
+        else:
+            tree.load_from_txt(input_bmk_path, config)
+
+        with metrics_stage('convert', bytes_read=os.path.getsize(input_bmk_path)) as record:
+            if os.path.splitext(output_bmk_path)[1].lower() == '.json':
+                bookmark_txt = tree.convert_to_json()
+            else:
+                bookmark_txt = tree.convert_to_txt(config)
+            PublicFunc.write_text_file(bookmark_txt, output_bmk_path, config.out_encoding)
+            record['bytes_written'] = os.path.getsize(output_bmk_path)
+
+
+def _write_pdf_part(src_pdf, out_path, first, last, items,
+                    object_streams='preserve', recompress=False, linearize=False, backend=None):
+    """Save pages first..last of src_pdf with the outline items to out_path"""
+    part = pikepdf.Pdf.new()
+    part.pages.extend(src_pdf.pages[first - 1:last])
+    part_tree = BookmarkNode(title='Root')
+    part_tree.load_from_items(items)
+    part_tree.add_to_pdf(part, backend)
+    part.save(out_path,
+              object_stream_mode=pikepdf.ObjectStreamMode[object_streams],
+              recompress_flate=recompress,
+              linearize=linearize)
+
+
+# split 模式工作进程中打开的 PDF
+_split_worker_pdf = None
+
+
+def _init_split_worker(pdf_path):
+    global _split_worker_pdf
+    _split_worker_pdf = MyPDFHandler.open_pdf(pdf_path)
+
+
+def _split_worker_part(*job):
+    return _write_pdf_part(_split_worker_pdf, *job)
+
+
+class BookmarkFormatter(object):
+    '''
+    书签文件格式化: 所有标题规则合并为一个预编译的正则, 每行只匹配一次标题和一次页码,
+    按行流式处理
+    '''
+
+    # 内置标题规则 (正则, 层级), 靠前的优先; 标题后的空白统一为一个空格
+    HEADING_RULES = [
+        # 四级标题 1.1.1.1
+        (r'\d+\.\d+\.\d+\.\d+(?![\d.])', 4),
+        # 三级标题 1.1.1
+        (r'\d+\.\d+\.\d+(?![\d.])', 3),
+        # 二级标题：第x节
+        (r'第[一二三四五六七八九十IV]+节(?!\.)', 2),
+        # 二级标题：1.1标题
+        (r'\d+\.\d+(?![\d.])', 2),
+        # 一级标题：1标题  或  1. 标题
+        (r'\d+\.?(?![\d.])', 1),
+        # 一级标题 Chapter 1
+        (r'(?:[Cc]hapter|CHAPTER)\s*[\dIV]+(?!\.)', 1),
+        # 一级标题：第x章
+        (r'第[一二三四五六七八九十〇IV]+章(?!\.)', 1),
+        (r'第\d+章(?!\.)', 1),
+    ]
+
+    # 已编译的格式化器, 按分隔符、页码标签模式和规则文件缓存
+    __cache = {}
+
+    def __init__(self, user_rules=(), config=None):
+        self.config = config = config or BookmarkConfig.get()
+        rules = list(user_rules) + self.HEADING_RULES
+
+        def _blank_re(mark, mark_re):
+            # 分隔符是空白时不写成 (mark|\s)*, 避免匹配失败时指数级回溯
+            return r'\s*' if mark.isspace() else rf'(?:{mark_re}|\s)*'
+
+        self.levels = [level for _, level in rules]
+        alternatives = [f'(?P<h{i}>{pattern})' for i, (pattern, _) in enumerate(rules)]
+        # 不以数字开头的行，例如：前言, 只去掉缩进
+        alternatives.append(f'(?=[^\\d{config.mark_level_re}第])')
+        self.heading_re = re.compile(
+            rf'{_blank_re(config.mark_level, config.mark_level_re)}'
+            rf'(?:{"|".join(alternatives)})\s*')
+
+        # 页码规则在反转的行上从行首匹配, 不必在每个位置尝试行尾的模式
+        page_blank = _blank_re(config.mark_page, re.escape(config.mark_page[::-1]))
+        # 标题与页码间:  18   或  18-25
+        self.page_re = re.compile(rf'\s*(?:\d*-)?(\d+){page_blank}')
+        # 没有页码的标题, 末尾加上页码分隔符
+        self.no_page_re = re.compile(rf'{page_blank}([^\d])')
+
+    @classmethod
+    def get(cls, rules_path=None, config=None):
+        """Compiled formatter of the separators of config (a BookmarkConfig) and the rule file"""
+        config = config or BookmarkConfig.get()
+        # format_lines 按 config.page_labels 决定初始的页码模式, 须在键中
+        key = (config.mark_page, config.mark_level, config.page_labels, rules_path,
+               rules_path and os.stat(rules_path).st_mtime_ns)
+        formatter = cls.__cache.get(key)
+        if formatter is None:
+            formatter = cls.__cache.setdefault(
+                key, cls(cls.load_rules(rules_path) if rules_path else (), config))
+        return formatter
+
+    @staticmethod
+    def load_rules(rules_path):
+        """
+        读取用户标题规则, json 列表, 例如:
+        [{"pattern": "第\\d+部分", "level": 1},
+         {"pattern": "part\\s*[ivx]+", "level": 1, "ignore_case": true}]
+        """
+        rules = []
+        for i, rule in enumerate(PublicFunc.read_json_file(rules_path)):
+            try:
+                pattern, level = rule['pattern'], int(rule['level'])
+                re.compile(pattern)
+            except (KeyError, TypeError, ValueError, re.error) as e:
+                raise ValueError(f'Bad format rule {i + 1} in {rules_path}: {e}')
+            if level < 1:
+                raise ValueError(f'Bad format rule {i + 1} in {rules_path}: level must be >= 1')
+            if rule.get('ignore_case'):
+                pattern = f'(?i:{pattern})'
+            rules.append((pattern, level))
+        return rules
+
+    def format_line(self, line, labels=False):
+        """
+        Formatted line without line break, None for a blank line.
+        labels: the page numbers are page labels, a label after the page separator is kept as is
+        """
+        line = line.rstrip('\r\n')
+        if not line.strip():
+            return None
+
+        res = self.heading_re.match(line)
+        if res:
+            heading = res.group(res.lastgroup) if res.lastgroup else ''
+            if heading:
+                level = self.levels[int(res.lastgroup[1:])]
+                line = f'{self.config.mark_level * (level - 1)}{heading} {line[res.end():]}'
+            else:
+                line = line[res.end():]
+
+        if labels:
+            # 页码标签 (如 xii, A-3) 不能按数字识别, 须已用页码分隔符与标题隔开
+            title, mark, label = line.rpartition(self.config.mark_page)
+            label = label.strip()
+            if title.strip() and mark and label and len(label.split()) == 1:
+                return f'{title.rstrip()}{mark}{label}'
+
+        reversed_line = line[::-1]
+        res = self.page_re.match(reversed_line)
+        if res:
+            return f'{line[:len(line) - res.end()]}{self.config.mark_page}{res.group(1)[::-1]}'
+        res = self.no_page_re.match(reversed_line)
+        if res:
+            return f'{line[:len(line) - res.end()]}{res.group(1)}{self.config.mark_page}'
+        return line
+
+    def format_lines(self, lines):
+        """Format lines one by one, blank lines are dropped"""
+        format_line = self.format_line
+        match_directive = self.config.page_offset_re.match
+        # 与 BookmarkNode.load_from_text 相同, //labels 与 //N 行切换页码是否为页码标签
+        labels = self.config.page_labels
+        for line in lines:
+            res = '//' in line and match_directive(line)
+            if res:
+                directive = res.group(1).strip()
+                if directive == Constant.PAGE_LABELS_LINE:
+                    labels = True
+                elif directive.isdecimal():
+                    labels = False
+            line = format_line(line, labels)
+            if line is not None:
+                yield line + '\n'
+
+
+class PageTextExtractor(object):
+    '''
+    从页面内容流中提取文本行及其字号, 字体编码按 /ToUnicode 解析, 没有时按单字节编码
+    '''
+
+    HEX_PAIR_RE = re.compile(rb'<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]+)>')
+    HEX_RANGE_RE = re.compile(rb'<([0-9A-Fa-f]+)>\s*<([0-9A-Fa-f]+)>\s*(<[0-9A-Fa-f]+>|\[[^\]]*\])')
+    HEX_RE = re.compile(rb'<([0-9A-Fa-f]+)>')
+    BFCHAR_RE = re.compile(rb'beginbfchar(.*?)endbfchar', re.S)
+    BFRANGE_RE = re.compile(rb'beginbfrange(.*?)endbfrange', re.S)
+
+    # TJ 中小于该值的间距视为空格, 单位为千分之一字号
+    SPACE_KERNING = -250
+
+    def __init__(self, pdf):
+        self.pdf = pdf
+        self.__decoders = {}
+
+    @classmethod
+    def parse_to_unicode(cls, data):
+        """{code: text} of a ToUnicode CMap"""
+
+        def _text(hex_str):
+            return bytes.fromhex(hex_str.decode()).decode('utf-16-be', errors='ignore')
+
+        cmap = {}
+        for block in cls.BFCHAR_RE.findall(data):
+            for src, dst in cls.HEX_PAIR_RE.findall(block):
+                cmap[int(src, 16)] = _text(dst)
+        for block in cls.BFRANGE_RE.findall(data):
+            for low, high, dst in cls.HEX_RANGE_RE.findall(block):
+                low, high = int(low, 16), int(high, 16)
+                if dst.startswith(b'['):
+                    for code, item in zip(range(low, high + 1), cls.HEX_RE.findall(dst)):
+                        cmap[code] = _text(item)
+                else:
+                    text = _text(dst[1:-1])
+                    if not text:
+                        continue
+                    for i, code in enumerate(range(low, high + 1)):
+                        cmap[code] = text[:-1] + chr(ord(text[-1]) + i)
+        return cmap
+
+    def decoder(self, font):
+        """bytes -> str function of a font dictionary"""
+        if font is None:
+            return lambda data: data.decode('latin-1')
+        key = font.objgen if font.is_indirect else id(font)
+        if key in self.__decoders:
+            return self.__decoders[key]
+
+        width = 2 if font.get('/Subtype') == pikepdf.Name.Type0 else 1
+        to_unicode = font.get('/ToUnicode')
+        cmap = None
+        if to_unicode is not None:
+            try:
+                cmap = self.parse_to_unicode(to_unicode.read_bytes())
+            except pikepdf.PdfError:
+                pass
+
+        if cmap:
+            def _decode(data):
+                return ''.join(cmap.get(int.from_bytes(data[i:i + width], 'big'), '')
+                               for i in range(0, len(data), width))
+        elif width == 1:
+            def _decode(data):
+                return data.decode('cp1252', errors='replace')
+        else:
+            # 没有 ToUnicode 的 CID 字体无法还原文字
+            def _decode(data):
+                return ''
+
+        self.__decoders[key] = _decode
+        return _decode
+
+    def page_lines(self, page):
+        """[(text, font size)] of the text lines of a page in content stream order"""
+        try:
+            resources = page.obj.get('/Resources')
+            fonts = resources.get('/Font') if resources is not None else None
+            instructions = pikepdf.parse_content_stream(page)
+        except pikepdf.PdfError:
+            return []
+
+        lines = []
+        parts = []
+        line_size = 0.0
+        decode = self.decoder(None)
+        font_size = scale = 1.0
+        y = None
+
+        def _new_line():
+            nonlocal line_size
+            text = ''.join(parts).strip()
+            if text:
+                lines.append((text, round(line_size, 1)))
+            parts.clear()
+            line_size = 0.0
+
+        def _add(data):
+            nonlocal line_size
+            parts.append(decode(bytes(data)))
+            line_size = max(line_size, font_size * scale)
+
+        def _space():
+            if parts and not parts[-1].endswith(' '):
+                parts.append(' ')
+
+        for instruction in instructions:
+            operator = str(instruction.operator)
+            operands = instruction.operands
+            try:
+                if operator == 'Tf':
+                    font = fonts.get(str(operands[0])) if fonts is not None else None
+                    decode = self.decoder(font)
+                    font_size = abs(float(operands[1]))
+                elif operator == 'Tm':
+                    scale = abs(float(operands[3])) or abs(float(operands[1])) or 1.0
+                    new_y = float(operands[5])
+                    if y is None or abs(new_y - y) > 1:
+                        _new_line()
+                    else:
+                        _space()
+                    y = new_y
+                elif operator in ('Td', 'TD'):
+                    if float(operands[1]):
+                        _new_line()
+                        y = None if y is None else y + float(operands[1]) * scale
+                    elif float(operands[0]) > 0:
+                        _space()
+                elif operator == 'T*':
+                    _new_line()
+                elif operator == 'Tj':
+                    _add(operands[0])
+                elif operator == "'":
+                    _new_line()
+                    _add(operands[0])
+                elif operator == '"':
+                    _new_line()
+                    _add(operands[2])
+                elif operator == 'TJ':
+                    for item in operands[0]:
+                        if isinstance(item, pikepdf.String):
+                            _add(item)
+                        elif float(item) < self.SPACE_KERNING:
+                            _space()
+            except (IndexError, TypeError, ValueError, AttributeError):
+                continue
+        _new_line()
+        return lines
+
+    def extract_range(self, start, end):
+        """[(page number, lines)] of pages start..end-1, page number starts at 1"""
+        pages = self.pdf.pages
+        return [(i + 1, self.page_lines(pages[i])) for i in range(start, end)]
+
+
+# detect 模式工作进程中打开的 PDF
+_page_text_worker = None
+
+
+def _init_page_text_worker(pdf_path):
+    global _page_text_worker
+    _page_text_worker = PageTextExtractor(MyPDFHandler.open_pdf(pdf_path))
+
+
+def _page_text_lines(start, end):
+    return _page_text_worker.extract_range(start, end)
+
+
+class OutlineDetector(object):
+    '''
+    按页码顺序接收页面文本行, 查找印刷的目录页并计算页码偏移;
+    找不到目录时, 用 BookmarkFormatter 的标题规则从正文中找标题
+    '''
+
+    TOC_TITLE_RE = re.compile(r'^\s*(目\s*录|contents|table\s+of\s+contents)\s*$', re.I)
+    # 目录行: 标题 + 引导符/空白 + 页码(或页码范围)
+    TOC_LINE_RE = re.compile(r'^(.*?[^\s.·…_])[\s.·…_]+(\d+)(?:-\d+)?\s*$')
+    TITLE_CHAR_RE = re.compile(r'[^\W\d_]')
+    SENTENCE_END = ('。', '.', ',', '，', ';', '；', ':', '：')
+
+    MAX_HEADING_LENGTH = 60
+    # 目录结束后在这么多页内找不到第一个目录项时, 放弃目录
+    MAX_FRONT_PAGES = 100
+
+    def __init__(self, formatter, page_count, toc_max_pages=40):
+        self.formatter = formatter
+        self.page_count = page_count
+        self.toc_max_pages = toc_max_pages
+        self.state = 'toc'
+        self.pages_scanned = 0
+        self.toc_pages = []
+        self.toc_entries = []
+        self.offset = None
+        self.headings = []
+        self.__seen_headings = set()
+
+    @staticmethod
+    def normalize(text):
+        return re.sub(r'\s+', '', text).lower()
+
+    def toc_entries_of(self, lines):
+        """[(title, printed page)] if lines look like a table of contents page, else None"""
+        has_title = False
+        entries = []
+        for text, _ in lines:
+            if self.TOC_TITLE_RE.match(text):
+                has_title = True
+                continue
+            res = self.TOC_LINE_RE.match(text)
+            if (res and len(res.group(1)) <= 2 * self.MAX_HEADING_LENGTH
+                    and int(res.group(2)) <= self.page_count
+                    and self.TITLE_CHAR_RE.search(res.group(1))):
+                entries.append((res.group(1).strip(), int(res.group(2))))
+
+        if not entries or not (has_title or (len(entries) >= 3 and len(entries) >= 0.4 * len(lines))):
+            return None
+        # 目录页中的页码基本递增
+        pages = [page for _, page in entries]
+        ascending = sum(1 for a, b in zip(pages, pages[1:]) if a <= b)
+        if ascending < 0.8 * (len(pages) - 1):
+            return None
+        return entries
+
+    def collect_headings(self, page_num, lines):
+        """Heading lines of a page: match a heading rule, not smaller than the body text"""
+        sizes = Counter()
+        for text, size in lines:
+            sizes[size] += len(text)
+        body_size = sizes.most_common(1)[0][0] if sizes else 0
+
+        heading_match = self.formatter.heading_re.match
+        for text, size in lines:
+            if len(text) > self.MAX_HEADING_LENGTH or text.endswith(self.SENTENCE_END):
+                continue
+            res = heading_match(text)
+            if not res or not res.lastgroup or size < body_size:
+                continue
+            # 纯数字编号的标题(1.1)须比正文字号大, 第x章/Chapter 等不要求
+            if res.group(res.lastgroup).replace('.', '').isdigit() and size <= body_size:
+                continue
+            key = self.normalize(text)
+            # 页眉中重复出现的标题只保留第一次
+            if key in self.__seen_headings:
+                continue
+            self.__seen_headings.add(key)
+            self.headings.append((text, page_num))
+
+    def feed(self, page_num, lines):
+        """Process the next page, return True when no more pages are needed"""
+        self.pages_scanned = page_num
+        toc_entries = self.toc_entries_of(lines) if self.state in ('toc', 'in_toc') else None
+
+        if self.state == 'toc':
+            if toc_entries:
+                self.state = 'in_toc'
+            elif page_num >= self.toc_max_pages:
+                self.state = 'headings'
+
+        if self.state == 'in_toc':
+            if toc_entries:
+                self.toc_pages.append(page_num)
+                self.toc_entries.extend(toc_entries)
+                return False
+            self.state = 'offset'
+
+        if self.state == 'offset':
+            if self.find_offset(page_num, lines):
+                return True
+            if page_num > self.toc_pages[-1] + self.MAX_FRONT_PAGES:
+                self.state = 'headings'
+
+        if not toc_entries:
+            self.collect_headings(page_num, lines)
+        return False
+
+    def find_offset(self, page_num, lines):
+        """Whether page_num is the page of one of the first toc entries, sets offset"""
+        page_texts = [self.normalize(text) for text, _ in lines]
+        for title, printed_page in self.toc_entries[:10]:
+            key = self.normalize(title)
+            if any(text.startswith(key) for text in page_texts):
+                self.offset = page_num - printed_page
+                return True
+        return False
+
+    def outline_lines(self):
+        """Bookmark text lines of the detected outline, for BookmarkNode.load_from_text"""
+        format_line = self.formatter.format_line
+        if self.offset is not None:
+            yield f'//{self.offset + 1}\n'
+            for title, page in self.toc_entries:
+                yield format_line(f'{title} {page}') + '\n'
+        else:
+            # 标题所在的是pdf页码, 不是页码标签 (-page-labels 时也是)
+            yield '//1\n'
+            for title, page in self.headings:
+                yield format_line(f'{title} {page}') + '\n'
+
+
+class ResultCache(object):
+    '''
+    任务结果缓存: 输出目录下的 JSON 清单, 按输出文件记录输入PDF、书签文件、模式、
+    设置以及输出文件的状态(大小、修改时间、sha256), 全部未变化时跳过该任务
+    '''
+
+    FILE_NAME = '.bookmark_cache.json'
+    VERSION = 1
+
+    def __init__(self, path, max_age_days=30):
+        self.path = path
+        self.max_age = max_age_days * 24 * 3600
+        self.entries = self.__load()
+        self.__updated = {}
+
+    def __load(self):
+        try:
+            data = PublicFunc.read_json_file(self.path)
+        except (OSError, ValueError):
+            return {}
+        if not isinstance(data, dict) or data.get('version') != self.VERSION:
+            return {}
+        return data.get('entries', {})
+
+    @staticmethod
+    def key(job):
+        return os.path.normcase(os.path.abspath(job.o))
+
+    def get(self, job):
+        return self.entries.get(self.key(job))
+
+    def put(self, job, entry):
+        if entry is not None:
+            self.entries[self.key(job)] = self.__updated[self.key(job)] = entry
+
+    def save(self):
+        """
+        Merge the updated entries into the cache file, drop the entries not used
+        for max_age_days or whose output file no longer exists
+        """
+        entries = self.__load()
+        entries.update(self.__updated)
+        now = time.time()
+        entries = {key: entry for key, entry in entries.items()
+                   if now - entry.get('time', 0) <= self.max_age and os.path.exists(key)}
+
+        # 先写临时文件再替换, 中断时不会留下损坏的缓存
+        tmp_path = f'{self.path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        PublicFunc.write_json_file(tmp_path, {'version': self.VERSION, 'entries': entries})
+        os.replace(tmp_path, self.path)
+        self.entries = entries
+
+    @staticmethod
+    def file_state(path, known=None):
+        """size, mtime and sha256 of path, the hash of known is reused if size and mtime match"""
+        stat = os.stat(path)
+        state = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if known and known['size'] == stat.st_size and known['mtime_ns'] == stat.st_mtime_ns:
+            state['sha256'] = known['sha256']
+        else:
+            state['sha256'] = PublicFunc.file_hash(path)
+        return state
+
+    @staticmethod
+    def settings(job):
+        """Settings besides the input files that change the output"""
+        return {
+            'config': list(job.config.key),
+            'incremental': job.incremental,
+            'object_streams': job.object_streams,
+            'recompress': job.recompress,
+            'linearize': job.linearize,
+            'backend': job.backend,
+            'limits': [job.max_nodes, job.max_outline_depth],
+            'rules': PublicFunc.file_hash(job.rules) if job.rules else None,
+            'bmk_out': job.bmk_out,
+            'max_depth': job.max_depth,
+            'pages': list(job.pages) if job.pages else None,
+            'toc_pages': job.toc_pages,
+        }
+
+    @classmethod
+    def is_fresh(cls, job, entry):
+        """Whether the output recorded in entry is still the result of job"""
+        if (entry is None or entry['mode'] != job.mode
+                or entry['settings'] != cls.settings(job)
+                or not os.path.exists(job.o)):
+            return False
+
+        if cls.file_state(job.o, entry['output'])['sha256'] != entry['output']['sha256']:
+            return False
 
-    # 代表书签标题级别的符号, 可使用多个
-    MARK_LEVEL = '\t'
+        # 原地输出时输入文件就是上次的输出文件, 上面已经检查过
+        if os.path.abspath(job.i) != os.path.abspath(job.o):
+            if cls.file_state(job.i, entry['input'])['sha256'] != entry['input']['sha256']:
+                return False
 
-    __re_special_chars = r'+-*\()[]{}^|'
+        if bool(job.bmk) != bool(entry['bookmark']):
+            return False
+        if job.bmk:
+            if (not os.path.exists(job.bmk) or cls.file_state(job.bmk, entry['bookmark'])['sha256']
+                    != entry['bookmark']['sha256']):
+                return False
+        return True
 
-    @classmethod
-    def mark_process(cls):
-        '''若MARK_PAGE、MARK_LEVEL为正则表达式的特殊字符，'''
 
-        def _escape_mark(mark_str):
-            char_list = list(mark_str)
-            for i, char in enumerate(char_list):
-                if char in cls.__re_special_chars:
-                    char_list[i] = '\\' + char
-            return ''.join(char_list)
+class OutlineIndex(object):
+    '''
+    书签目录: 文件夹(含子文件夹)中所有 PDF 的书签保存在一个 SQLite 数据库中,
+    标题建立 FTS5 全文索引 (trigram 分词, 可以匹配中文等没有空格分隔的标题中的任意子串).
+    trigram 索引不能查找 1, 2 个字符的词, 另建一个只有索引的 FTS5 表 bookmarks_grams,
+    内容是标题中所有 1, 2 个字符的子串 (十六进制编码, 每个子串是一个 ascii 词).
+    按文件大小和修改时间增量更新, 只重新提取变化了的文件
+    '''
 
-        cls.MARK_PAGE_RE = _escape_mark(cls.MARK_PAGE)
-        cls.MARK_LEVEL_RE = _escape_mark(cls.MARK_LEVEL)
+    FILE_NAME = '.bookmark_index.db'
+    VERSION = 2
 
+    # 每个事务写入的文件数
+    COMMIT_EVERY = 500
 
-Constant.mark_process()
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self.__create()
 
-class BookmarkNode(object):
-    def __init__(self, level=1, title=None, page_num=0):
-        self.parent = None
-        self.child = []
-        self.title = title
-        self.page_num = int(page_num) if page_num != None else None
-        self.level = int(level)
-        return
+    def __create(self):
+        db = self.db
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        if version not in (0, 1, self.VERSION):
+            raise ValueError(f'Index {self.path} has version {version}, expected {self.VERSION}')
+        db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                id INTEGER PRIMARY KEY,
+                path TEXT UNIQUE NOT NULL,
+                size INTEGER,
+                mtime_ns INTEGER,
+                nodes INTEGER,
+                error TEXT
+            );
+            CREATE TABLE IF NOT EXISTS bookmarks (
+                id INTEGER PRIMARY KEY,
+                file_id INTEGER NOT NULL,
+                level INTEGER,
+                page INTEGER,
+                title TEXT
+            );
+            CREATE INDEX IF NOT EXISTS bookmarks_file ON bookmarks (file_id);
+            CREATE VIRTUAL TABLE IF NOT EXISTS bookmarks_fts USING fts5 (
+                title, content='bookmarks', content_rowid='id', tokenize='trigram'
+            );
+            CREATE VIRTUAL TABLE IF NOT EXISTS bookmarks_grams USING fts5 (
+                grams, content='', tokenize='ascii'
+            );
+        ''')
+        if version == 1:
+            # 版本 1 没有 bookmarks_grams, 用已有的标题补建
+            with db:
+                self.__put_grams(db.execute('SELECT id, title FROM bookmarks'))
+        db.execute(f'PRAGMA user_version={self.VERSION}')
 
-    def add_child(self, child):
-        """Add a child node of type BookmarkNode"""
-        self.child.append(child)
-        child.parent = self
+    def close(self):
+        self.db.close()
 
-    def set_parent(self, new_parent):
-        """Set the parent of this node to a new one"""
-        old_parent = self.parent
-        new_parent.add_child(self)
-        if old_parent is not None:
-            old_parent.child.remove(self)
+    @staticmethod
+    def scan(folder):
+        """{path: (size, mtime_ns)} of the pdf files in folder and its sub folders"""
+        files = {}
+        pending = [folder]
+        while pending:
+            with os.scandir(pending.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+                    elif entry.name.lower().endswith('.pdf') and entry.is_file():
+                        stat = entry.stat()
+                        files[os.path.abspath(entry.path)] = (stat.st_size, stat.st_mtime_ns)
+        return files
 
-    def move_to(self, new_index):
-        """Move this node to a new location in the list of children"""
-        if self.parent is None:
-            print("Cannot move the root node")
-            return
+    @staticmethod
+    def short_grams(text):
+        """Tokens of bookmarks_grams: the 1 and 2 character substrings of the words of text"""
+        grams = set()
+        for word in text.casefold().split():
+            grams.update(word)
+            grams.update(word[i:i + 2] for i in range(len(word) - 1))
+        # 十六进制编码后 ascii 分词器不会再拆分或改写
+        return ' '.join(gram.encode('utf-8').hex() for gram in grams)
 
-        self.parent.child.insert(
-            new_index,
-            self.parent.child.pop(self.parent.child.index(self)))
+    def __put_grams(self, rows, delete=False):
+        # 只有索引(content='')的 FTS 表, 删除时须给出原来的内容
+        if delete:
+            sql = "INSERT INTO bookmarks_grams (bookmarks_grams, rowid, grams) VALUES ('delete', ?, ?)"
+        else:
+            sql = 'INSERT INTO bookmarks_grams (rowid, grams) VALUES (?, ?)'
+        self.db.executemany(sql, ((bookmark_id, self.short_grams(title)) for bookmark_id, title in rows))
 
-    def remove(self):
-        """Remove/Delete the Node"""
-        if self.parent is None:
-            print("Cannot remove the root node")
+    def __delete_file(self, file_id):
+        # 外部内容的 FTS 表须用原来的内容删除索引项
+        self.db.execute(
+            "INSERT INTO bookmarks_fts (bookmarks_fts, rowid, title) "
+            "SELECT 'delete', id, title FROM bookmarks WHERE file_id = ?", (file_id,))
+        self.__put_grams(self.db.execute('SELECT id, title FROM bookmarks WHERE file_id = ?',
+                                         (file_id,)).fetchall(), delete=True)
+        self.db.execute('DELETE FROM bookmarks WHERE file_id = ?', (file_id,))
 
-        self.parent.child.remove(self)
+    def __put_file(self, path, size, mtime_ns, items, error):
+        db = self.db
+        row = db.execute('SELECT id FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None:
+            file_id = row[0]
+            self.__delete_file(file_id)
+            db.execute('UPDATE files SET size = ?, mtime_ns = ?, nodes = ?, error = ? WHERE id = ?',
+                       (size, mtime_ns, len(items), error, file_id))
+        else:
+            file_id = db.execute(
+                'INSERT INTO files (path, size, mtime_ns, nodes, error) VALUES (?, ?, ?, ?, ?)',
+                (path, size, mtime_ns, len(items), error)).lastrowid
 
-    def load_from_pdf(self, pdfreader):
-        """Load bookmarks from PyPDF2 PdfFileReader"""
-        
-        def find_dest(ref, names):
-            resolved = None
-            if isinstance(ref, Array):
-                resolved = ref[0]
-            else:
-                if names is None:
-                    resolved = None
-                else:
-                    for n in range(0, len(names) - 1, 2):
-                        if names[n] == ref:
-                            if names[n+1]._type_name == 'array':
-                                named_page = names[n+1][0]
-                            elif names[n+1]._type_name == 'dictionary':
-                                named_page = names[n+1].D[0]
-                            else:
-                                raise TypeError("Unknown type: %s" % type(names[n+1]))
-                            resolved = named_page
-                            break
-            if resolved is not None:
-                return Page(resolved).index
-            else:
-                return None
-                
-        def _getDestinationPageNumber(outline, names):
-            if outline.destination is not None:
-                if isinstance(outline.destination, Array):
-                    # 12.3.2.2 Explicit destination
-                    # [raw_page, /PageLocation.SomeThing, integer parameters for viewport]
-                    raw_page = outline.destination[0]
-                    try:
-                        page = Page(raw_page)
-                        dest = page.index
-                    except:
-                        dest = find_dest(outline.destination, names)
-                elif isinstance(outline.destination, String):
-                    # 12.3.2.2 Named destination, byte string reference to Names
-                    # dest = f'<Named Destination in document .Root.Names dictionary: {outline.destination}>'
-                    assert names is not None
-                    dest = find_dest(outline.destination, names)
-                elif isinstance(outline.destination, Name):
-                    # 12.3.2.2 Named desintation, name object (PDF 1.1)
-                    # dest = f'<Named Destination in document .Root.Dests dictionary: {outline.destination}>'
-                    dest = find_dest(outline.destination, names)
-                elif isinstance(outline.destination, int):
-                    # Page number
-                    dest = outline.destination
-                else:
-                    dest = outline.destination
-                return dest
-            else:
-                try:
-                    return find_dest(outline.action.D, names)
-                except AttributeError:
-                    return None
+        db.executemany('INSERT INTO bookmarks (file_id, level, page, title) VALUES (?, ?, ?, ?)',
+                       ((file_id, level, page, title) for level, title, page in items))
+        db.execute('INSERT INTO bookmarks_fts (rowid, title) '
+                   'SELECT id, title FROM bookmarks WHERE file_id = ?', (file_id,))
+        self.__put_grams(db.execute('SELECT id, title FROM bookmarks WHERE file_id = ?',
+                                    (file_id,)).fetchall())
 
-        def get_names(pdf):
-            # https://github.com/pikepdf/pikepdf/issues/149#issuecomment-860073511
-            def has_nested_key(obj, keys):
-                ok = True
-                to_check = obj
-                for key in keys:
-                    if key in to_check.keys():
-                        to_check = to_check[key]
-                    else:
-                        ok = False
-                        break
-                return ok   
-        
-            if has_nested_key(pdf.Root, ['/Names', '/Dests']):
-                obj = pdf.Root.Names.Dests
-                names = []
-                ks = obj.keys()
-                if '/Names' in ks:
-                    names.extend(obj.Names)
-                elif '/Kids' in ks:
-                    for k in obj.Kids:
-                        names.extend(get_names(k))
-                else:
-                    assert False
-                return names
-            else:
-                return None
-            
-        def _generate_tree(parent_node, cur_outline, level):
-            
-            current_node = BookmarkNode()
-            current_node.title = cur_outline.title.strip()
-            #current_node.page_num = int(cur_outline.destination._type_code)
-            page_num = _getDestinationPageNumber(cur_outline, names)
-            page_num = int(page_num + 1) if page_num != None else None # 如果有页码,则 + 1
-            current_node.page_num = page_num
-            current_node.level = int(level)
-            parent_node.add_child(current_node)
-
-            for child_outline in cur_outline.children:
-                _generate_tree(current_node, child_outline, level+1)
-        
-        try: 
-            names = get_names(pdfreader)
-        except AttributeError:
-            names = None
-        
-        with pdfreader.open_outline() as outline_obj:
-            for root_outline in outline_obj.root:
-                _generate_tree(self, root_outline, level=1)
+    def update(self, folder, workers=0, backend=None, log=print, budget=None):
+        """
+        Index the pdf files of folder: extract new and changed files on a process pool,
+        drop the files that no longer exist. Return (files, extracted, removed, failed).
+        budget: OutlineBudget of each file, the partial outline of a damaged file is indexed
+        """
+        db = self.db
+        with metrics_stage('index_scan') as record:
+            files = self.scan(folder)
+            # 只处理 folder 下的文件, 同一数据库可以索引多个文件夹
+            prefix = os.path.join(os.path.abspath(folder), '')
+            known = {path: (file_id, size, mtime_ns) for file_id, path, size, mtime_ns
+                     in db.execute('SELECT id, path, size, mtime_ns FROM files')
+                     if path.startswith(prefix)}
+            changed = sorted(path for path, state in files.items()
+                             if path not in known or known[path][1:] != state)
+            removed = [known[path][0] for path in known if path not in files]
+            record.update(files=len(files), changed=len(changed), removed=len(removed))
 
-    def add_to_pdf(self, pdf_obj):
-        
-        def _add_bookmark(cur_node, parent_outline):
-            page_num = cur_node.page_num - 1 if cur_node.page_num != None else None
-            cur_outline = OutlineItem(cur_node.title, page_num)
-            if cur_node.level == 1:
-                parent_outline.append(cur_outline)
-            else:
-                parent_outline.children.append(cur_outline)
-                
-            for child_node in cur_node.child:
-                _add_bookmark(child_node, cur_outline)
-                
-        with pdf_obj.open_outline() as outline_obj:
-            for child_node in self.child:
-                _add_bookmark(child_node, outline_obj.root)    
-
-    def load_from_txt(self, txt_file_path, encoding='utf-8'):
-        bmk_text_lines = PublicFunc.read_text_file(txt_file_path, encoding=encoding)
-        self.load_from_text(bmk_text_lines)
-        
-    def load_from_text(self, bmk_text_lines):
-
-        def _make_up_parent_root(cur_level, cur_title, node_dict):
-            prev_level = cur_level - 1
-            if prev_level not in node_dict.keys():
-                print(f'Warning: Title "{cur_title}": missing {prev_level:.0f} level title')
-                _make_up_parent_root(prev_level, cur_title, node_dict)
-                node_dict[prev_level] = BookmarkNode(title='.'*5, level=prev_level)
-                node_dict[prev_level-1].add_child(node_dict[prev_level])
+        with metrics_stage('index_extract') as record:
+            with db:
+                for file_id in removed:
+                    self.__delete_file(file_id)
+                    db.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+            workers = max(1, min(workers or os.cpu_count() or 1, len(changed)))
+            failed = nodes = 0
+            if workers == 1:
+                results = (_index_outline(path, backend, budget) for path in changed)
+                executor = None
             else:
-                return
+                executor = concurrent_futures.ProcessPoolExecutor(max_workers=workers)
+                results = executor.map(_index_outline, changed, [backend] * len(changed),
+                                       [budget] * len(changed),
+                                       chunksize=max(1, min(64, len(changed) // (workers * 8))))
+            try:
+                for done, (path, items, error, problems) in enumerate(results, 1):
+                    size, mtime_ns = files[path]
+                    if error:
+                        failed += 1
+                        log(f'[FAIL] {path}: {error}')
+                    elif problems:
+                        log(f'[WARN] {path}: {problems}')
+                        error = problems
+                    nodes += len(items)
+                    self.__put_file(path, size, mtime_ns, items, error)
+                    if done % self.COMMIT_EVERY == 0:
+                        db.commit()
+                        log(f'Indexed {done}/{len(changed)} files...')
+                db.commit()
+            finally:
+                if executor is not None:
+                    executor.shutdown()
+            record.update(files=len(changed), nodes=nodes, failed=failed, workers=workers)
+        return len(files), len(changed), len(removed), failed
 
-        # 如果直接输入的是文字,则按行转为list
-        if type(bmk_text_lines) is str:
-            bmk_text_lines = bmk_text_lines.split('\n')
-            
-        offset = 0
-        node_dict = {0: self}
-
-        for line in bmk_text_lines:
-            #line = line.strip(' ')
-            # / / 后面填上 页码中的第一页对应PDF的第几个页面
-            if line.strip().startswith('//'):
-                try:
-                    offset = int(line[2:].strip()) - 1
-                except ValueError:
-                    pass
-                continue
-            res = re.match(rf'^(({Constant.MARK_LEVEL_RE})*)(.*?)({Constant.MARK_PAGE_RE})(\d*)', line)
-            if res:
-                level_mark, _, title, _, page_num = res.groups()
-                cur_level = len(level_mark) / len(Constant.MARK_LEVEL) + 1  # \t count stands for level
-                if cur_level % 1: # if title level is not int
-                    raise ValueError('Bookmark file not be formated!')
-                page_num = int(page_num) + offset if page_num != '' else None
-                cur_node = BookmarkNode(level=cur_level, title=title, page_num=page_num)
-
-                _make_up_parent_root(cur_level, title, node_dict)
-
-                node_dict[cur_level - 1].add_child(cur_node)
-                node_dict[cur_level] = cur_node
-                for i_ in list(node_dict.keys()):
-                    if i_ > cur_level:
-                        node_dict.pop(i_)
-
-    def convert_to_txt(self):
-        """Recursively print all the nodes of this tree"""
-
-        def _outline_format(bookmark_list, node=None):
-            if node is None:
-                node = self
+    @staticmethod
+    def __match_query(terms):
+        """FTS5 query of terms of at least 3 characters (trigram), each quoted as a phrase"""
+        return ' '.join('"' + term.replace('"', '""') + '"' for term in terms)
+
+    def search(self, query, limit=50):
+        """
+        [(path, page, level, title)] of the bookmarks whose titles contain every word of query,
+        in the order they were indexed. Words shorter than 3 characters can not use the trigram
+        index: alone they are looked up in bookmarks_grams, with longer words they are matched
+        with LIKE on the rows found by the longer words
+        """
+        terms = query.split()
+        if not terms:
+            return []
+        long_terms = [term for term in terms if len(term.casefold()) >= 3]
+        short_terms = [term for term in terms if len(term.casefold()) < 3]
+
+        where, params = [], []
+        if long_terms:
+            where.append('bookmarks_fts MATCH ?')
+            params.append(self.__match_query(long_terms))
+        for term in short_terms:
+            where.append("b.title LIKE ? ESCAPE '\\'")
+            params.append('%' + re.sub(r'([%_\\])', r'\\\1', term) + '%')
+
+        # 按相关度(rank)排序须先对所有匹配项打分, 按 rowid 的顺序可以在 LIMIT 处停止
+        with metrics_stage('search') as record:
+            if long_terms:
+                sql = ('SELECT f.path, b.page, b.level, b.title FROM bookmarks_fts '
+                       'JOIN bookmarks b ON b.id = bookmarks_fts.rowid '
+                       'JOIN files f ON f.id = b.file_id '
+                       f'WHERE {" AND ".join(where)} ORDER BY bookmarks_fts.rowid LIMIT ?')
             else:
-                level_mark = Constant.MARK_LEVEL * (node.level - 1)
-                page_num = node.page_num if node.page_num != None else ''
-                bookmark_txt = f'{level_mark}{node.title}{Constant.MARK_PAGE}{page_num}'
-                bookmark_list.append(bookmark_txt)
+                # 词的 casefold 不超过 2 个字符, 就是 bookmarks_grams 中的一个词
+                sql = ('SELECT f.path, b.page, b.level, b.title FROM bookmarks_grams '
+                       'JOIN bookmarks b ON b.id = bookmarks_grams.rowid '
+                       'JOIN files f ON f.id = b.file_id '
+                       'WHERE bookmarks_grams MATCH ? ORDER BY bookmarks_grams.rowid LIMIT ?')
+                params = [' '.join(term.casefold().encode('utf-8').hex() for term in short_terms)]
+            rows = self.db.execute(sql, params + [limit]).fetchall()
+            record['results'] = len(rows)
+        return rows
 
-            for num, child in enumerate(node.child):
-                _outline_format(bookmark_list, node=child)
+    def stats(self):
+        files, nodes = self.db.execute('SELECT count(*), sum(nodes) FROM files').fetchone()
+        return {'files': files, 'bookmarks': nodes or 0}
 
-        bookmark_list = []
-        _outline_format(bookmark_list)
 
-        return '\n'.join(bookmark_list)
+def _index_outline(pdf_path, backend=None, budget=None):
+    """
+    Worker of OutlineIndex.update:
+    (path, [(level, title, page)], error message or None, problems of a partial outline or None)
+    """
+    budget = budget or OutlineBudget()
+    try:
+        with budget.activate(), MyPDFHandler.open_pdf(pdf_path, mmap=True) as pdf:
+            tree = BookmarkNode(title='Root')
+            tree.load_from_pdf(pdf, backend)
+            items = [(depth, node.title, node.page_num) for node, depth in tree.walk()]
+        return pdf_path, items, None, budget.note()
+    except Exception as e:
+        return pdf_path, [], f'{type(e).__name__}: {e}', None
 
-    def load_from_dict(self, bookmarks_dict, level=0):
-        self.title = bookmarks_dict['title']
-        page_num = bookmarks_dict['page_num']
-        self.page_num =  page_num - 1 if page_num != '' else None
-        self.child = []
-        self.level = level
-        #self.level = bookmarks_dict['level']
-        for child_dict in bookmarks_dict['child']:
-            child = BookmarkNode()
-            self.add_child(child)
-            child.load_from_dict(child_dict, level+1)
 
-    def convert_to_dict(self):
-        return {
-            'title': self.title,
-            'page_num': self.page_num + 1 if self.page_num != None else '',
-            'child': [child.convert_to_dict() for child in self.child],
-            'level': self.level
-        }
+def run_cached_job(job, entry, verbose=True, log=None, pdf_pool=None):
+    """
+    Run job unless the cache entry shows its output is up to date,
+    return (result note, new cache entry)
+    """
+    log = log or (print if verbose else (lambda *a, **k: None))
 
-    def load_from_json(self, json_file_path, encoding='utf-8'):
-        bookmarks_dict = PublicFunc.read_json_file(json_file_path, encoding=encoding)
-        self.load_from_dict(bookmarks_dict)
+    with metrics_stage('cache_check') as record:
+        record['fresh'] = fresh = not job.force and ResultCache.is_fresh(job, entry)
+    if fresh:
+        log("Output is up to date, skip...")
+        entry['time'] = time.time()
+        return 'up to date, skipped', entry
 
-    def convert_to_json(self):
-        return json.dumps(self.convert_to_dict(), ensure_ascii=False, indent=4)
+    # 原地输出会覆盖输入文件, 先记录输入状态
+    input_state = ResultCache.file_state(job.i, entry and entry['input'])
+    bookmark_state = ResultCache.file_state(job.bmk, entry and entry['bookmark']) if job.bmk else None
+    budget = OutlineBudget.from_args(job)
+    note = process_file(job, verbose, log, pdf_pool, budget)
+    if budget.problems:
+        # 只保留了部分大纲的结果不缓存, 每次运行都会重新处理并报告
+        return note, None
+    if job.bmk and job.bmk_out and os.path.abspath(job.bmk_out) == os.path.abspath(job.bmk):
+        # 书签文件被格式化后的内容覆盖
+        bookmark_state = ResultCache.file_state(job.bmk)
 
-    def print_tree(self, num=0, node=None, depth=0):
-        """Recursively print all the nodes of this tree"""
-        if node is None:
-            node = self
-        else:
-            print("{}[{}] {}".format("   " * depth, num, node))
-        for num, child in enumerate(node.child):
-            self.print_tree(num, child, depth + 1)
-    
-    def print_tree2(self):
-        print(self.convert_to_txt())
-        
-    def print_child(self):
-        """Print all the children of this node"""
-        for num, child in enumerate(self.child):
-            print("[{}] {}".format(num, child))
+    entry = {
+        'mode': job.mode,
+        'input': input_state,
+        'bookmark': bookmark_state,
+        'settings': ResultCache.settings(job),
+        'output': ResultCache.file_state(job.o),
+        'time': time.time(),
+    }
+    return note, entry
 
-    def __repr__(self):
-        """String representation of object"""
-        return "{} -> p{}{}".format(
-            self.title,
-            self.page_num,
-            ", c{}".format(len(self.child)) if self.child else "")
 
+def run_measured(job, func):
+    """
+    Call func(), which returns (result note, cache entry), with the stages recorded in a
+    new RunMetrics if job.report is set. Return (result of func, report record or None).
+    The report record of a failed job is attached to the exception as its report attribute
+    """
+    if not job.report:
+        return func(), None
 
-class MyPDFHandler(object):
-    '''
-    封装的PDF文件处理类
-    '''
+    with RunMetrics.collect() as metrics:
+        try:
+            result = func()
+        except Exception as e:
+            e.report = metrics.report(job, 'failed', f'{type(e).__name__}: {e}')
+            raise
+    return result, metrics.report(job, 'ok', result[0])
 
-    def __init__(self, in_pdf_path):
-        self.__pdf_reader = Pdf.open(in_pdf_path, allow_overwriting_input=True)
 
-    def generate_bookmark_tree(self, input=''):
-        self.bookmark_tree = BookmarkNode(title='Root')
+def run_profiled(profile_path, profiler_name, func, log=print):
+    """Run func() under cProfile or pyinstrument, save the profile to profile_path"""
+    if profiler_name == 'pyinstrument':
+        from pyinstrument import Profiler
+        profiler = Profiler()
+        profiler.start()
+        try:
+            return func()
+        finally:
+            profiler.stop()
+            PublicFunc.write_text_file(profiler.output_html(), profile_path)
+            log(f'Profile saved: {profile_path}')
 
-        if input == '':
-            self.bookmark_tree.load_from_pdf(self.__pdf_reader)
-            return
+    import cProfile
+    import pstats
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func)
+    finally:
+        profiler.dump_stats(profile_path)
+        stream = io.StringIO()
+        pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(15)
+        log(stream.getvalue())
+        log(f'Profile saved: {profile_path}')
 
-        if type(input) is dict:
-            self.bookmark_tree.load_from_dict(input)
-            return
 
-        name_parts = os.path.splitext(input.lower())
-        if name_parts[1] == '.txt':
-            self.bookmark_tree.load_from_txt(input)
-        elif name_parts[1] == '.json':
-            self.bookmark_tree.load_from_json(input)
-        else:
-            raise Exception(f'Invalid input file: {input}')
+def open_cache(args, out_path):
+    """ResultCache of the -cache option, default cache file is in the folder of out_path"""
+    cache_path = args.cache or os.path.join(os.path.dirname(os.path.abspath(out_path)),
+                                            ResultCache.FILE_NAME)
+    return ResultCache(cache_path, args.cache_max_age)
 
-    def bookmark_tree_to_text_file(self, out_bookmark_path, encoding='utf-8'):
-        name_parts = os.path.splitext(out_bookmark_path)
 
-        if name_parts[1].lower() == '.json':
-            bookmark_txt = self.bookmark_tree.convert_to_json()
-        else:
-            bookmark_txt = self.bookmark_tree.convert_to_txt()
+def parse_page_range(text):
+    """'A-B', 'A-', '-B' or 'A' -> (A, B), page numbers start at 1"""
+    res = re.match(r'^\s*(\d*)\s*(-?)\s*(\d*)\s*$', text)
+    if not res or not (res.group(1) or res.group(3)):
+        raise argparse.ArgumentTypeError(f'invalid page range: {text}')
+    first = int(res.group(1)) if res.group(1) else 1
+    if res.group(2):
+        last = int(res.group(3)) if res.group(3) else sys.maxsize
+    else:
+        last = first
+    if first > last:
+        raise argparse.ArgumentTypeError(f'invalid page range: {text}')
+    return first, last
 
-        PublicFunc.write_text_file(bookmark_txt, out_bookmark_path, encoding)
 
-    def remove_bookmarks(self):
-        with self.__pdf_reader.open_outline() as outline_obj:
-            outline_obj.root.clear()
-        
-    def add_bookmarks_to_pdf(self):
-        self.bookmark_tree.add_to_pdf(self.__pdf_reader)
+def parse_page_ranges(text):
+    """'A-B,C-D,...' -> [(A, B), (C, D), ...], see parse_page_range"""
+    ranges = [parse_page_range(part) for part in text.split(',') if part.strip()]
+    if not ranges:
+        raise argparse.ArgumentTypeError(f'invalid page ranges: {text}')
+    return ranges
 
-    def write_to_pdf(self, out_pdf_path):
-        self.__pdf_reader.save(out_pdf_path)
 
-    @staticmethod
-    def format_bookmark_file(input_bmk_path,
-                             output_bmk_path,
-                             in_encoding='utf-8',
-                             out_encoding='utf-8'):
-
-        # 读取书签文件, 每行为列表的一个元素
-        bmk_text_lines = PublicFunc.read_text_file(input_bmk_path, in_encoding)
-
-        list_reg_patern = [
-            
-            # 不以数字开头的行，例如：前言
-            (r'^(%s|\s)*([^\d%s第])' % (Constant.MARK_LEVEL_RE, Constant.MARK_LEVEL_RE),
-             Constant.MARK_LEVEL*0 + r'\2'),
-            
-            # 一级标题：第x章
-            (r'^(%s|\s)*(第\d{1,}章)\s*(?=[^.])' % Constant.MARK_LEVEL_RE,
-             r'\2 '),
-
-            # 一级标题：第x章
-            (r'^(%s|\s)*(第[一二三四五六七八九十〇IV]+章)\s*(?=[^.])' % Constant.MARK_LEVEL_RE,
-             r'\2 '),
-            
-            # 一级标题 Chapter 1
-            (r'^(%s|\s)*(chapter\s*[\dIV]+)\s*(?=[^.])' % Constant.MARK_LEVEL_RE,
-             r'\2 '),
-            
-
-            # 一级标题：1标题  或  1. 标题
-            (r'^(%s|\s)*(\d{1,}\.?)\s*(?=[^\d.])' % Constant.MARK_LEVEL_RE,
-             r'\2 '),
-            
-            # 二级标题：1.1标题
-            (r'^(%s|\s)*(\d{1,}\.\d{1,})\s*(?=[^\d.])' % Constant.MARK_LEVEL_RE,
-             Constant.MARK_LEVEL + r'\2 '),
-
-            # 二级标题：第x节
-            (r'^(%s|\s)*(第[一二三四五六七八九十IV]+节)\s*(?=[^.])' % Constant.MARK_LEVEL_RE,
-             Constant.MARK_LEVEL + r'\2 '),
-
-            # 三级标题 1.1.1
-            (r'^(%s|\s)*(\d{1,}\.\d{1,}\.\d{1,})\s*(?=[^\d.])' % Constant.MARK_LEVEL_RE,
-             Constant.MARK_LEVEL*2 + r'\2 '),
-
-            # 四级标题 1.1.1.1
-            (r'^(%s|\s)*(\d{1,}\.\d{1,}\.\d{1,}.\d{1,})\s*(?=[^\d.])' % Constant.MARK_LEVEL_RE,
-             Constant.MARK_LEVEL*3 + r'\2 '),
-
-            # 标题与页码间:  18   或  18-25
-            (r'(%s|\s)*(\d{1,})-?\d{0,}\s*\r?$' % Constant.MARK_PAGE_RE,
-             Constant.MARK_PAGE + r'\2'),    # 页码
-            
-            # 没有页码的标题, 末尾加上页码分隔符
-            (r'([^\d])(%s|\s)*$' % Constant.MARK_PAGE,
-             r'\1' + Constant.MARK_PAGE),    # 页码
-        ]
-
-        res_txt = ''.join(bmk_text_lines)
-        for reg_txt, rep_txt in list_reg_patern:
-            res_txt = re.sub(reg_txt, rep_txt, res_txt, flags=re.M)
-
-        PublicFunc.write_text_file(res_txt, output_bmk_path, out_encoding)
+def parse_separator(text):
+    """Separator of the bookmark text, escapes like \\t are allowed"""
+    try:
+        separator = text.encode('latin-1', 'backslashreplace').decode('unicode_escape')
+    except UnicodeDecodeError:
+        raise argparse.ArgumentTypeError(f'invalid separator: {text}')
+    if not separator or '\n' in separator:
+        raise argparse.ArgumentTypeError(f'invalid separator: {text!r}')
+    return separator
 
 
-def get_cmd_args():
+def build_arg_parser(parser_class=argparse.ArgumentParser):
 
     dest_str = ('pdf bookmark tool.\n'
                 'Attention: Paths containing spaces must be enclosed in double quotes')
-    parser = argparse.ArgumentParser(description=dest_str)
+    parser = parser_class(description=dest_str)
     parser.add_argument('-mode', dest='mode', default='add',
-                        choices=list(Constant.DICT_OUT_EXT.keys()),
+                        choices=list(Constant.DICT_OUT_EXT.keys()) + list(Constant.MODE_ALIASES.keys()),
                         action='store',
-                        help='add, remove, export, format.')
+                        help='add, sync, remove, export, format, format_add, detect, merge, split. '
+                             'sync only changes the bookmarks that differ from the bookmark file. '
+                             'export of a txt/json bookmark file converts it to json/txt. '
+                             'format_add formats a txt bookmark file in memory and adds it. '
+                             'detect builds bookmarks from the table of contents or headings '
+                             'in the page text, output a txt/json file or a pdf. '
+                             'merge joins the pdfs of a folder / glob pattern (in natural file name '
+                             'order), nesting the bookmarks of each file under its file name. '
+                             'split writes a pdf for each top level bookmark or -ranges range '
+                             'into an output folder, with the bookmarks of its pages. '
+                             'index stores the bookmarks of all pdfs in a folder (and sub folders) '
+                             'in a full text index, updating only changed files. '
+                             'search finds -query in the bookmark titles of an index.')
     parser.add_argument('-i', dest='i', action='store',
-                        help='origin pdf filename.')
+                        help='origin pdf filename, or a folder / glob pattern for batch processing '
+                             '(merge: the files to join; index: the folder; '
+                             'search: the index file or its folder).')
     parser.add_argument('-bmk', dest='bmk', action='store',
-                        help='bookmarks file.')
+                        help='bookmarks file (batch: folder of bookmark files, default input folder).')
     parser.add_argument('-o', dest='o', action='store',
-                        help='save to filename.')
+                        help='save to filename (batch: output folder, default input folder; '
+                             'split: output folder, default the input file name; '
+                             f'index: the index file, default {OutlineIndex.FILE_NAME} in the folder).')
     parser.add_argument('-y', dest='overwrite', action='store_true',
                         help='overwrite output file if it already exists')
+    parser.add_argument('-j', dest='jobs', type=int, default=0,
+                        help='batch/detect/split: number of worker processes, default cpu count '
+                             '(batch -pipeline: number of build threads).')
+    parser.add_argument('-pipeline', dest='pipeline', action='store_true',
+                        help='batch: overlap reading inputs, building outlines and writing outputs '
+                             'in threads, for slow or network storage. Not for format/split.')
+    parser.add_argument('-queue-depth', dest='queue_depth', type=int, default=4,
+                        help='batch -pipeline: max files waiting between two stages, '
+                             'bounds how far reading runs ahead, default 4.')
+    parser.add_argument('-io-workers', dest='io_workers', type=int, default=4,
+                        help='batch -pipeline: number of read threads and of write threads, default 4.')
+    parser.add_argument('-ext', dest='bmk_ext', action='store',
+                        help='batch: bookmark file type, txt or json. '
+                             'Default: add looks for .txt then .json, export/detect write .txt')
+    parser.add_argument('-incremental', dest='incremental', action='store_true',
+                        help='add/sync/remove: append only the changed objects to the original pdf '
+                             '(incremental update), fall back to a full rewrite if not possible.')
+    parser.add_argument('-object-streams', dest='object_streams', default='preserve',
+                        choices=Constant.OBJECT_STREAM_MODES,
+                        help='full save: object streams mode, default preserve.')
+    parser.add_argument('-recompress', dest='recompress', action='store_true',
+                        help='full save: recompress flate streams.')
+    parser.add_argument('-linearize', dest='linearize', action='store_true',
+                        help='full save: linearize (fast web view) the output pdf.')
+    parser.add_argument('-backend', dest='backend', default=Constant.DEFAULT_BACKEND,
+                        choices=sorted(OutlineBackend.BACKENDS),
+                        help='pdf outline reader/writer: pikepdf (OutlineItem) or objects '
+                             '(outline dictionaries directly, faster), default pikepdf. '
+                             'export streams the outline dictionaries and only uses the '
+                             'destination resolver of the backend.')
+    parser.add_argument('--max-depth', '-max-depth', dest='max_depth', type=int, default=0,
+                        help='export: only export bookmarks up to this level, default all levels.')
+    parser.add_argument('--pages', '-pages', dest='pages', type=parse_page_range,
+                        help='export: only export bookmarks of pages A-B (or A- / -B / A), '
+                             'with their parent bookmarks.')
+    parser.add_argument('-ranges', dest='ranges', type=parse_page_ranges,
+                        help='split: page ranges of the output files, e.g. 1-30,31-60,61-. '
+                             'Default: split at each top level bookmark.')
+    parser.add_argument('-query', dest='query', action='store',
+                        help='search: words that must all appear in the bookmark title.')
+    parser.add_argument('-limit', dest='limit', type=int, default=50,
+                        help='search: max number of results, default 50.')
+    parser.add_argument('-mark-page', dest='mark_page', type=parse_separator, default=None,
+                        help='bookmark text: separator between title and page number, '
+                             'escapes like \\t allowed, default a tab.')
+    parser.add_argument('-mark-level', dest='mark_level', type=parse_separator, default=None,
+                        help='bookmark text: indent of one level, default a tab.')
+    parser.add_argument('-offset', dest='page_offset', type=int, default=0,
+                        help='add/sync/format_add: add this to the page numbers of the bookmark file, '
+                             'until a "//N" line in the file sets another offset, default 0.')
+    parser.add_argument('-page-labels', dest='page_labels', action='store_true',
+                        help='the page numbers of txt bookmark files are the printed page labels of '
+                             'the pdf (e.g. xii, A-3), as if the file started with a "//labels" line; '
+                             'export writes labels too.')
+    parser.add_argument('-encoding', dest='encoding', default='utf-8',
+                        help='encoding of the bookmark files read, default utf-8.')
+    parser.add_argument('-out-encoding', dest='out_encoding', default=None,
+                        help='encoding of the bookmark files written, default the same as -encoding.')
+    parser.add_argument('-max-nodes', dest='max_nodes', type=int, default=0,
+                        help='max items read from an outline, named destination tree or page label '
+                             'tree of a pdf; the items read before are kept and the file is reported. '
+                             f'Default {Constant.MAX_OUTLINE_NODES}.')
+    parser.add_argument('-max-outline-depth', dest='max_outline_depth', type=int, default=0,
+                        help='deeper outline items are skipped and the file is reported, '
+                             f'default {Constant.MAX_OUTLINE_DEPTH}.')
+    parser.add_argument('-time-limit', dest='time_limit', type=float, default=0,
+                        help='seconds each file may spend reading outline structures and scanning '
+                             'pages (detect), the part read in time is kept and the file is reported, '
+                             'default no limit. Opening and saving the pdf are not interrupted.')
+    parser.add_argument('-memory-limit', dest='memory_limit', type=float, default=0,
+                        help='MB the memory of the process may grow while reading the outline '
+                             'structures or scanning the pages of each file, like -time-limit, '
+                             'default no limit.')
+    parser.add_argument('-toc-pages', dest='toc_pages', type=int, default=40,
+                        help='detect: search the table of contents in the first N pages, default 40.')
+    parser.add_argument('-rules', dest='rules', action='store',
+                        help='format/format_add/detect: json file of extra heading rules, e.g. '
+                             '[{"pattern": "第\\\\d+部分", "level": 1}], tried before the built-in rules.')
+    parser.add_argument('-bmk-out', dest='bmk_out', nargs='?', const='', default=None,
+                        help='format_add: also save the formatted bookmarks, '
+                             'to the bookmark file itself if no path is given (batch: a folder).')
+    parser.add_argument('-cache', dest='cache', nargs='?', const='', default=None,
+                        help='skip files whose input, bookmark file, mode and settings did not change '
+                             'since the last run. Optional cache file path, '
+                             f'default {ResultCache.FILE_NAME} in the output folder.')
+    parser.add_argument('-force', dest='force', action='store_true',
+                        help='with -cache: process all files and refresh the cache.')
+    parser.add_argument('-cache-max-age', dest='cache_max_age', type=float, default=30,
+                        help='with -cache: drop cache entries not used for this many days, default 30.')
+    parser.add_argument('--report', '-report', dest='report', action='store',
+                        help='append a JSON line for each processed file to this file: the time, '
+                             'counts, memory at the end and growth, and bytes read/written of '
+                             'each stage, and the peak memory of the process.')
+    parser.add_argument('--profile', '-profile', dest='profile', action='store',
+                        help='save a profile of the run to this file, cProfile stats '
+                             '(see python -m pstats) or html with -profiler pyinstrument.')
+    parser.add_argument('-profiler', dest='profiler', default='cprofile',
+                        choices=['cprofile', 'pyinstrument'],
+                        help='with -profile: profiler to use, pyinstrument must be installed.')
+
+    return parser
+
 
-    args = parser.parse_args()
+def get_cmd_args():
+
+    args = build_arg_parser().parse_args()
 
     # for test
     if not args.i:
@@ -523,98 +3614,735 @@ def get_cmd_args():
     return args
 
 
-def veryfy_args(args):
+def veryfy_args(args, log=print, ask=input):
+    """Check args and fill in default paths, log prints the errors, ask asks before overwriting"""
 
     # if args.mode not in Constant.DICT_OUT_EXT.keys():
     #     print(f'ERROR: Unknow mode: {args.mode}')
     #     exit(2)
     args.mode = args.mode.lower()
+    args.mode = Constant.MODE_ALIASES.get(args.mode, args.mode)
+    args.convert = False
     
     # veryfy input path
     if not args.i:
-        print('ERROR: Input file not be specified!')
+        log('ERROR: Input file not be specified!')
+        sys.exit(2)
+
+    for encoding in [args.encoding, args.out_encoding]:
+        try:
+            encoding and codecs.lookup(encoding)
+        except LookupError:
+            log(f'ERROR: Unknown encoding: {encoding}')
+            sys.exit(2)
+    # 整个任务(批量时每个文件)使用同一个不可变的设置
+    args.config = BookmarkConfig.from_args(args)
+
+    if min(args.max_nodes, args.max_outline_depth, args.time_limit, args.memory_limit) < 0:
+        log('ERROR: -max-nodes, -max-outline-depth, -time-limit and -memory-limit must not be negative')
         sys.exit(2)
 
+    if args.rules:
+        try:
+            BookmarkFormatter.get(args.rules, args.config)
+        except (OSError, ValueError) as e:
+            log(f'ERROR: Format rules file: {e}')
+            sys.exit(2)
+
+    if args.profile and args.profiler == 'pyinstrument':
+        import importlib.util
+        if importlib.util.find_spec('pyinstrument') is None:
+            log('ERROR: -profiler pyinstrument: pyinstrument is not installed')
+            sys.exit(2)
+
+    if args.cache is not None and args.mode in [Constant.MERGE, Constant.SPLIT,
+                                                Constant.INDEX, Constant.SEARCH]:
+        log(f'Warning: -cache is not supported in mode "{args.mode}", ignored')
+        args.cache = None
+
+    # merge 的输入为多个文件, 不是批量模式
+    if args.mode == Constant.MERGE:
+        args.batch = False
+        if not args.o:
+            args.o = (args.i.rstrip('/\\') if os.path.isdir(args.i)
+                      else os.path.join(os.path.dirname(args.i), 'merged'))
+        if os.path.splitext(args.o.lower())[1] != '.pdf':
+            args.o = args.o + '.pdf'
+        # 上次合并的输出文件可能也在输入文件夹中
+        args.parts = [path for path in PublicFunc.list_files(args.i, '.pdf')
+                      if os.path.abspath(path) != os.path.abspath(args.o)]
+        if not args.parts:
+            log(f'ERROR: No .pdf file found in: {args.i}')
+            sys.exit(2)
+        if (not args.overwrite) and (os.path.exists(args.o)):
+            user_choice = ask(f'Destnation file: {args.o} \n already exists, overwrite? (y/n)')
+            if user_choice.lower() != 'y':
+                sys.exit(1)
+        return
+
+    # index 的输入是整个文件夹, search 的输入是书签目录数据库, 都不是批量模式
+    if args.mode in [Constant.INDEX, Constant.SEARCH]:
+        args.batch = False
+        if not os.path.exists(args.i):
+            log(f'ERROR: Input file not exist: {args.i}')
+            sys.exit(2)
+        if args.mode == Constant.INDEX:
+            if not os.path.isdir(args.i):
+                log(f'ERROR: In mode "index", input must be a folder: {args.i}')
+                sys.exit(2)
+            args.o = args.o or os.path.join(args.i, OutlineIndex.FILE_NAME)
+        else:
+            args.o = os.path.join(args.i, OutlineIndex.FILE_NAME) if os.path.isdir(args.i) else args.i
+            if not os.path.isfile(args.o):
+                log(f'ERROR: Index file not exist: {args.o}, create it with -mode index')
+                sys.exit(2)
+            if not args.query or not args.query.strip():
+                log('ERROR: In mode "search", -query must be given')
+                sys.exit(2)
+        return
+
+    # 输入为文件夹或通配符时, 进入批量模式
+    args.batch = os.path.isdir(args.i) or (
+        not os.path.exists(args.i) and any(c in args.i for c in '*?['))
+    if args.batch:
+        if args.bmk and not os.path.isdir(args.bmk):
+            log(f'ERROR: In batch mode, bookmark path must be a folder: {args.bmk}')
+            sys.exit(2)
+        if args.o and os.path.isfile(args.o):
+            log(f'ERROR: In batch mode, output path must be a folder: {args.o}')
+            sys.exit(2)
+        if args.pipeline and args.mode in [Constant.FORMAT, Constant.SPLIT]:
+            log(f'Warning: -pipeline is not supported in mode "{args.mode}", ignored')
+            args.pipeline = False
+        if args.pipeline and args.cache is not None:
+            log('Warning: -cache is not supported with -pipeline, ignored')
+            args.cache = None
+        if args.pipeline and (args.queue_depth < 1 or args.io_workers < 1):
+            log('ERROR: -queue-depth and -io-workers must be at least 1')
+            sys.exit(2)
+        return
+
     if not os.path.exists(args.i):
-        print(f'ERROR: Input file not exist: {args.i}')
+        log(f'ERROR: Input file not exist: {args.i}')
         sys.exit(2)
 
     input_path_parts = os.path.splitext(args.i)
+    # export 的输入为书签文件时, 只做 txt / json 格式转换
+    args.convert = (args.mode == Constant.EXPORT
+                    and input_path_parts[1].lower() in Constant.BOOKMARK_EXTS)
 
-    if ((args.mode in [Constant.ADD, Constant.REMOVE, Constant.EXPORT])
-            and input_path_parts[1].lower() != '.pdf'):
-        print(f'In mode "{args.mode}", Input file must be PDF format!')
+    if ((args.mode in [Constant.ADD, Constant.SYNC, Constant.FORMAT_ADD, Constant.REMOVE,
+                       Constant.EXPORT, Constant.DETECT, Constant.SPLIT])
+            and input_path_parts[1].lower() != '.pdf' and not args.convert):
+        log(f'In mode "{args.mode}", Input file must be PDF format (export: or a txt/json bookmark file)!')
         sys.exit(2)
 
     # veryfy output path
     if not args.o:
         args.o = f'{input_path_parts[0]}{Constant.DICT_OUT_EXT[args.mode]}'
+        if args.convert:
+            # 转换为另一种格式
+            args.o = input_path_parts[0] + ('.txt' if input_path_parts[1].lower() == '.json' else '.json')
         # args.o = f'{input_path_parts[0]}_{args.mode}{Constant.DICT_OUT_EXT[args.mode]}'
 
     output_path_parts = os.path.splitext(args.o.lower())
-    if (args.mode in [Constant.ADD, Constant.REMOVE]) and output_path_parts[1] != '.pdf':
+    if ((args.mode in [Constant.ADD, Constant.SYNC, Constant.FORMAT_ADD, Constant.REMOVE])
+            and output_path_parts[1] != '.pdf'):
         args.o = args.o + '.pdf'
 
-    if (args.mode in [Constant.EXPORT, Constant.FORMAT]) and output_path_parts[1] == '':
+    if (args.mode in [Constant.EXPORT, Constant.FORMAT, Constant.DETECT]) and output_path_parts[1] == '':
         args.o = args.o + '.txt'
 
+    if args.mode == Constant.SPLIT and os.path.isfile(args.o):
+        log(f'ERROR: In mode "{args.mode}", output path must be a folder: {args.o}')
+        sys.exit(2)
+
     if (not args.overwrite) and (os.path.exists(args.o)):
-        user_choice = input(f'Destnation file: {args.o} \n already exists, overwrite? (y/n)')
+        user_choice = ask(f'Destnation file: {args.o} \n already exists, overwrite? (y/n)')
         if user_choice.lower() != 'y':
             sys.exit(1)
 
     # veryfy bookmark path
-    if args.mode == Constant.ADD:
+    if args.mode in [Constant.ADD, Constant.SYNC, Constant.FORMAT_ADD]:
         if (not args.bmk):
             #args.bmk = input('input_bookmark_file_path: ')
             args.bmk = input_path_parts[0] + '.txt'
 
         if not os.path.exists(args.bmk):
-            print(f'ERROR: Bookmark file not exist: {args.bmk} ')
+            log(f'ERROR: Bookmark file not exist: {args.bmk} ')
             sys.exit(2)
 
+    if args.mode == Constant.FORMAT_ADD:
+        if os.path.splitext(args.bmk)[1].lower() != '.txt':
+            log(f'In mode "{args.mode}", Bookmark file must be txt format!')
+            sys.exit(2)
+        if args.bmk_out == '':
+            args.bmk_out = args.bmk
 
-if __name__ == "__main__":
 
-    args = get_cmd_args()
-    
-    print('\n' + '-'*30)
-    print(f'Process mode: \t{args.mode}')
-    print(f'Input file: \t{args.i}')
-    if args.mode == Constant.ADD:
-        print(f'Bookmark file: \t{args.bmk}')
-    print(f'Output file: \t{args.o}')
+def save_pdf(pdf_handler, args, log, fsync=False):
+    """Save with the save options of args, return a short note of the save"""
+    save_mode, bytes_written, save_time = pdf_handler.write_to_pdf(
+        args.o, object_streams=args.object_streams,
+        recompress=args.recompress, linearize=args.linearize, fsync=fsync)
+    note = f'{save_mode} save, {bytes_written:,} bytes, {save_time:.3f} s'
+    log(f"Save pdf: {note}")
+    return note
+
+
+def is_in_place(args):
+    """Whether the job saves over its input pdf"""
+    return os.path.abspath(args.i) == os.path.abspath(args.o)
+
+
+def use_mmap(args):
+    """Whether the job only reads the outline of its input pdf, which is then memory mapped"""
+    return args.mode == Constant.EXPORT
+
+
+def process_file(args, verbose=True, log=None, pdf_pool=None, budget=None):
+    """
+    Run one job described by args, return a short result note.
+    pdf_pool: borrow the input pdf from this pool (see bookmark_server.PdfPool) instead of opening it.
+    budget: OutlineBudget of the job, default from args; damaged outlines are read up to the
+    problem, which is logged and added to the note
+    """
+    log = log or (print if verbose else (lambda *a, **k: None))
+
+    if args.mode == Constant.FORMAT:
+        MyPDFHandler.format_bookmark_file(args.i, args.o, args.rules, args.config)
+        log("Format bookmarks success...")
+        return None
+
+    if args.mode == Constant.EXPORT and args.convert:
+        MyPDFHandler.convert_bookmark_file(args.i, args.o, args.config)
+        log("Convert bookmarks success...")
+        return None
+
+    if args.mode == Constant.INDEX:
+        index = OutlineIndex(args.o)
+        try:
+            files, extracted, removed, failed = index.update(args.i, args.jobs, args.backend, log,
+                                                             OutlineBudget.from_args(args))
+            stats = index.stats()
+        finally:
+            index.close()
+        note = (f'{files} files, {extracted} extracted, {removed} removed, {failed} failed, '
+                f'{stats["files"]} files and {stats["bookmarks"]} bookmarks in the index')
+        log(f"Index bookmarks success: {note}")
+        return note
+
+    if args.mode == Constant.SEARCH:
+        index = OutlineIndex(args.o)
+        try:
+            rows = index.search(args.query, args.limit)
+        finally:
+            index.close()
+        for path, page, level, title in rows:
+            log(f'{path}\t{page if page is not None else ""}\t{"  " * (level - 1)}{title}')
+        note = f'{len(rows)} results'
+        log(f"Search bookmarks: {note}")
+        return note
+
+    budget = budget or OutlineBudget.from_args(args)
+    with budget.activate():
+        if args.mode == Constant.MERGE:
+            page_count = MyPDFHandler.merge_pdfs(
+                args.parts, args.o, object_streams=args.object_streams,
+                recompress=args.recompress, linearize=args.linearize, backend=args.backend)
+            note = f'{len(args.parts)} files, {page_count} pages'
+            log(f"Merge pdf success: {note}")
+        elif pdf_pool is None:
+            note = _process_pdf_file(args, log)
+        else:
+            # 只读的任务用完后把句柄还回池中, 修改过的句柄丢弃
+            read_only = args.mode in [Constant.EXPORT, Constant.SPLIT] or (
+                args.mode == Constant.DETECT and os.path.splitext(args.o)[1].lower() != '.pdf')
+            with pdf_pool.borrow(args.i, read_only, in_place=is_in_place(args),
+                                 mmap=use_mmap(args)) as pdf:
+                note = _process_pdf_file(args, log, pdf)
+
+    for problem in budget.problems:
+        log(f'Warning: partial outline, {problem}')
+    return budget.note(note)
+
+
+def _process_pdf_file(args, log, pdf=None):
+    """process_file of the modes that open the input pdf"""
+    pdf_handler, note = _prepare_pdf_file(args, log, pdf)
+    if pdf_handler is None:
+        return note
+    save_note = save_pdf(pdf_handler, args, log)
+    log("Save pdf success...")
+    return f'{note}, {save_note}' if note else save_note
+
+
+def _prepare_pdf_file(args, log, pdf=None):
+    """
+    Everything of _process_pdf_file but saving the pdf,
+    return (MyPDFHandler to save with save_pdf or None, result note)
+    """
+
+    # 只有输出覆盖输入时才可能需要把输入读入内存
+    in_place = is_in_place(args)
 
     if args.mode == Constant.ADD:
-        pdf_handler = MyPDFHandler(args.i)
-        print("Read origin pdf file success...")
+        pdf_handler = MyPDFHandler(args.i, incremental=args.incremental, pdf=pdf,
+                                   backend=args.backend, in_place=in_place, config=args.config)
+        log("Read origin pdf file success...")
 
         pdf_handler.generate_bookmark_tree(args.bmk)
         pdf_handler.remove_bookmarks()
         #pdf_handler.bookmark_tree.print_tree2()
         pdf_handler.add_bookmarks_to_pdf()
-        print("Parse bookmark success...")
+        log("Parse bookmark success...")
+        return pdf_handler, None
+
+    elif args.mode == Constant.FORMAT_ADD:
+        pdf_handler = MyPDFHandler(args.i, incremental=args.incremental, pdf=pdf,
+                                   backend=args.backend, in_place=in_place, config=args.config)
+        log("Read origin pdf file success...")
+
+        pdf_handler.generate_formatted_bookmark_tree(args.bmk, args.bmk_out, args.rules)
+        if args.bmk_out:
+            log(f"Save formatted bookmarks: {args.bmk_out}")
+        pdf_handler.remove_bookmarks()
+        pdf_handler.add_bookmarks_to_pdf()
+        log("Format and parse bookmark success...")
+        return pdf_handler, None
+
+    elif args.mode == Constant.SYNC:
+        pdf_handler = MyPDFHandler(args.i, incremental=args.incremental, pdf=pdf,
+                                   backend=args.backend, in_place=in_place, config=args.config)
+        log("Read origin pdf file success...")
+
+        pdf_handler.generate_bookmark_tree(args.bmk)
+        edits = pdf_handler.sync_bookmarks()
+        for edit in edits:
+            log(edit)
+        log(f"Sync bookmarks success, {len(edits)} changes...")
+
+        # 书签无变化且原地输出时, 不必重写文件
+        if edits or not in_place:
+            return pdf_handler, f'{len(edits)} changes'
+        return None, f'{len(edits)} changes'
 
-        pdf_handler.write_to_pdf(args.o)
-        print("Save pdf with bookmark success...")
-        
     elif args.mode == Constant.REMOVE:
-        pdf_handler = MyPDFHandler(args.i)
+        pdf_handler = MyPDFHandler(args.i, incremental=args.incremental, pdf=pdf,
+                                   backend=args.backend, in_place=in_place, config=args.config)
         pdf_handler.remove_bookmarks()
-        pdf_handler.write_to_pdf(args.o)
-        print("Remove bookmarks success...")
+        log("Remove bookmarks success...")
+        return pdf_handler, None
 
     elif args.mode == Constant.EXPORT:
-        pdf_handler = MyPDFHandler(args.i)
-        pdf_handler.generate_bookmark_tree()
+        pdf_handler = MyPDFHandler(args.i, pdf=pdf, backend=args.backend, mmap=True,
+                                   config=args.config)
+        pdf_handler.export_bookmarks(args.o, args.max_depth, args.pages)
+        log("Export bookmarks success...")
+        return None, None
+
+    elif args.mode == Constant.DETECT:
+        pdf_handler = MyPDFHandler(args.i, incremental=args.incremental, pdf=pdf,
+                                   backend=args.backend, in_place=in_place, config=args.config)
+        # 批量模式已经按文件并行, 单个文件内不再开进程池
+        detector = pdf_handler.detect_bookmarks(1 if args.batch else args.jobs,
+                                                args.toc_pages, args.rules)
+        if detector.offset is not None:
+            note = (f'{len(detector.toc_entries)} bookmarks from contents pages '
+                    f'{detector.toc_pages[0]}-{detector.toc_pages[-1]}, page offset {detector.offset}')
+        else:
+            note = f'{len(detector.headings)} bookmarks from headings'
+        note += f', {detector.pages_scanned} pages scanned'
+        log(f"Detect bookmarks: {note}")
+
+        if os.path.splitext(args.o)[1].lower() == '.pdf':
+            pdf_handler.remove_bookmarks()
+            pdf_handler.add_bookmarks_to_pdf()
+            log("Detect bookmarks success...")
+            return pdf_handler, note
         pdf_handler.bookmark_tree_to_text_file(args.o)
-        print("Export bookmarks success...")
-        
-    elif args.mode == Constant.FORMAT:
-        MyPDFHandler.format_bookmark_file(args.i, args.o)
-        print("Format bookmarks success...")
-    
-    print('-'*30 + '\n')
+        log("Detect bookmarks success...")
+        return None, note
+
+    elif args.mode == Constant.SPLIT:
+        pdf_handler = MyPDFHandler(args.i, pdf=pdf, backend=args.backend)
+        log("Read origin pdf file success...")
+
+        # 批量模式已经按文件并行, 单个文件的各部分不再开进程池
+        parts = pdf_handler.split_pdf(
+            args.o, args.ranges, 1 if args.batch else args.jobs,
+            object_streams=args.object_streams, recompress=args.recompress,
+            linearize=args.linearize)
+        for out_path, first, last in parts:
+            log(f'  pages {first}-{last} -> {out_path}')
+        note = f'{len(parts)} files'
+        log(f"Split pdf success: {note}")
+        return None, note
+
+
+
+def _run_batch_job(job):
+    """
+    Worker entry of batch mode, returns (input path, exit status, message, cache entry,
+    report record)
+    """
+    if job.error:
+        report = RunMetrics().report(job, 'failed', job.error) if job.report else None
+        return job.i, 2, job.error, None, report
+
+    def _run():
+        if job.cache is not None:
+            return run_cached_job(job, job.cache_entry, verbose=False)
+        return process_file(job, verbose=False), None
+
+    try:
+        (note, entry), report = run_measured(job, _run)
+    except Exception as e:
+        return job.i, 1, f'{type(e).__name__}: {e}', None, getattr(e, 'report', None)
+    return job.i, 0, f'{job.o} ({note})' if note else job.o, entry, report
+
+
+def make_batch_jobs(args):
+    """
+    批量模式: 展开文件夹/通配符输入, 为每个文件生成一个任务
+    """
+    in_paths = PublicFunc.list_files(args.i, Constant.DICT_IN_EXT[args.mode])
+
+    if args.bmk_ext:
+        bmk_exts = ['.' + args.bmk_ext.lstrip('.').lower()]
+    else:
+        bmk_exts = list(Constant.BOOKMARK_EXTS)
+    if args.mode == Constant.FORMAT_ADD:
+        bmk_exts = ['.txt']
+
+    jobs = []
+    for in_path in in_paths:
+        in_dir, in_name = os.path.split(in_path)
+        stem = os.path.splitext(in_name)[0]
+
+        out_ext = Constant.DICT_OUT_EXT[args.mode]
+        if args.mode in [Constant.EXPORT, Constant.DETECT] and args.bmk_ext:
+            out_ext = bmk_exts[0]
+        out_path = os.path.join(args.o or in_dir, stem + out_ext)
+
+        job = argparse.Namespace(**vars(args))
+        job.i, job.o, job.bmk, job.error = in_path, out_path, None, None
+        if args.mode == Constant.FORMAT_ADD and args.bmk_out is not None:
+            job.bmk_out = os.path.join(args.bmk_out or args.bmk or in_dir, stem + '.txt')
+        if args.mode in [Constant.ADD, Constant.SYNC, Constant.FORMAT_ADD]:
+            bmk_dir = args.bmk or in_dir
+            for ext in bmk_exts:
+                bmk_path = os.path.join(bmk_dir, stem + ext)
+                if os.path.exists(bmk_path):
+                    job.bmk = bmk_path
+                    break
+            else:
+                job.error = f'Bookmark file not exist: {os.path.join(bmk_dir, stem + bmk_exts[0])}'
+        jobs.append(job)
+
+    return jobs
+
+
+class BatchPipeline(object):
+    '''
+    批量模式的流水线, 读写与大纲处理重叠进行:
+    读取线程预读书签文件和输入 PDF 的首尾 -> 处理线程生成并写入大纲 -> 写入线程保存并 fsync.
+    预读只让文件进入系统缓存, 不保留内容; 处理阶段按路径惰性打开 PDF (见 MyPDFHandler.open_pdf),
+    只读取用到的对象, 内存不随文件大小增长. 阶段之间是长度为 queue_depth 的有界队列, 下游跟不上时上游等待
+    '''
+
+    # 预读 PDF 开头(文件头, 线性化字典)和末尾(交叉引用表, trailer)的字节数
+    PREFETCH_BYTES = 2**16
+
+    STAGES = ('read', 'build', 'write')
+
+    # 阶段线程退出的信号
+    __STOP = object()
+
+    class Item(object):
+        '''一个任务在流水线中的状态, result 有值时不再进入后续阶段'''
+
+        def __init__(self, job):
+            self.job = job
+            # 读取阶段开始时创建, 不计在输入队列中等待的时间
+            self.metrics = None
+            self.pdf_handler = None
+            self.note = None
+            self.result = None
+
+        def current_metrics(self):
+            return self.metrics.current() if self.metrics is not None else nullcontext()
+
+        def finish(self, status, message, note=None):
+            """Set the result, the same tuple as _run_batch_job"""
+            job = self.job
+            report = None
+            if self.metrics is not None:
+                report = self.metrics.report(job, 'ok' if status == 0 else 'failed', note or message)
+            if status == 0:
+                message = f'{job.o} ({note})' if note else job.o
+            self.result = (job.i, status, message, None, report)
+
+    def __init__(self, read_workers=4, build_workers=1, write_workers=4, queue_depth=4):
+        self.workers = {'read': read_workers, 'build': build_workers, 'write': write_workers}
+        self.queue_depth = queue_depth
+        # 每个阶段: 处理数, 处理耗时, 等待上游耗时, 等待下游(队列已满)耗时, 各线程累计
+        self.stats = {stage: {'items': 0, 'busy': 0.0, 'idle': 0.0, 'blocked': 0.0}
+                      for stage in self.STAGES}
+        self.elapsed = None
+        self.__lock = threading.Lock()
+
+    @staticmethod
+    def _quiet(*args, **kwargs):
+        pass
+
+    def _read(self, item):
+        job = item.job
+        if job.report:
+            item.metrics = RunMetrics()
+        if job.error:
+            item.finish(2, job.error)
+            return
+        with item.current_metrics(), metrics_stage('prefetch') as record:
+            # 只预读, 使文件进入系统缓存, 处理阶段仍按路径读取;
+            # PDF 的其余部分在用到时才读取, 不预读整个文件
+            with open(job.i, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                record['bytes_read'] = len(f.read(self.PREFETCH_BYTES))
+                if size > self.PREFETCH_BYTES:
+                    f.seek(max(self.PREFETCH_BYTES, size - self.PREFETCH_BYTES))
+                    record['bytes_read'] += len(f.read())
+            if job.bmk:
+                with open(job.bmk, 'rb') as f:
+                    record['bytes_read'] += len(f.read())
+
+    def _build(self, item):
+        pdf = MyPDFHandler.open_pdf(item.job.i, is_in_place(item.job), use_mmap(item.job))
+        try:
+            budget = OutlineBudget.from_args(item.job)
+            with item.current_metrics(), budget.activate():
+                pdf_handler, note = _prepare_pdf_file(item.job, self._quiet, pdf)
+        except BaseException:
+            pdf.close()
+            raise
+        item.note = budget.note(note)
+        if pdf_handler is None:
+            pdf.close()
+            item.finish(0, None, item.note)
+        else:
+            item.pdf_handler = pdf_handler
+
+    def _write(self, item):
+        try:
+            with item.current_metrics():
+                save_note = save_pdf(item.pdf_handler, item.job, self._quiet, fsync=True)
+        finally:
+            item.pdf_handler.close()
+            item.pdf_handler = None
+        item.finish(0, None, f'{item.note}, {save_note}' if item.note else save_note)
+
+    def __stage_worker(self, stage, func, in_queue, out_queue, results, remaining):
+        stats = self.stats[stage]
+        while True:
+            start_time = time.perf_counter()
+            item = in_queue.get()
+            busy_start = time.perf_counter()
+            if item is self.__STOP:
+                break
+            try:
+                func(item)
+            except Exception as e:
+                if item.pdf_handler is not None:
+                    item.pdf_handler.close()
+                item.finish(1, f'{type(e).__name__}: {e}')
+            end_time = time.perf_counter()
+            (results if item.result is not None else out_queue).put(item)
+            with self.__lock:
+                stats['items'] += 1
+                stats['idle'] += busy_start - start_time
+                stats['busy'] += end_time - busy_start
+                stats['blocked'] += time.perf_counter() - end_time
+
+        with self.__lock:
+            stats['idle'] += busy_start - start_time
+            remaining[stage] -= 1
+            last = remaining[stage] == 0
+        # 本阶段最后一个线程退出时, 通知下一阶段的线程退出
+        if last and out_queue is not results:
+            next_stage = self.STAGES[self.STAGES.index(stage) + 1]
+            for _ in range(self.workers[next_stage]):
+                out_queue.put(self.__STOP)
+
+    def run(self, jobs, on_result):
+        """Run the jobs, call on_result(result tuple of _run_batch_job) as each job finishes"""
+        start_time = time.perf_counter()
+        # 输入队列不限长度, 读取线程从中取任务
+        job_queue = queue.Queue()
+        for job in jobs:
+            job_queue.put(self.Item(job))
+        for _ in range(self.workers['read']):
+            job_queue.put(self.__STOP)
+        results = queue.Queue()
+        queues = [job_queue] + [queue.Queue(maxsize=self.queue_depth) for _ in self.STAGES[1:]]
+        queues.append(results)
+
+        remaining = dict(self.workers)
+        funcs = {'read': self._read, 'build': self._build, 'write': self._write}
+        threads = []
+        for i, stage in enumerate(self.STAGES):
+            for _ in range(self.workers[stage]):
+                threads.append(threading.Thread(
+                    target=self.__stage_worker, daemon=True,
+                    args=(stage, funcs[stage], queues[i], queues[i + 1], results, remaining)))
+        for thread in threads:
+            thread.start()
+
+        for _ in range(len(jobs)):
+            on_result(results.get().result)
+        for thread in threads:
+            thread.join()
+        self.elapsed = time.perf_counter() - start_time
+
+    def utilization(self):
+        """[(stage, threads, items, busy seconds, utilization, seconds blocked by a full queue)]"""
+        rows = []
+        for stage in self.STAGES:
+            stats = self.stats[stage]
+            capacity = self.elapsed * self.workers[stage]
+            rows.append((stage, self.workers[stage], stats['items'], stats['busy'],
+                         stats['busy'] / capacity if capacity else 0.0, stats['blocked']))
+        return rows
+
+
+def run_batch(args, log=print, ask=input):
+    """Process every file matched by args.i on a process pool, return exit status"""
+    jobs = make_batch_jobs(args)
+    if not jobs:
+        log(f'ERROR: No {Constant.DICT_IN_EXT[args.mode]} file found in: {args.i}')
+        return 2
+
+    if args.o and not os.path.isdir(args.o):
+        os.makedirs(args.o)
+
+    existed = [job for job in jobs if not job.error and os.path.exists(job.o)]
+    if existed and not args.overwrite:
+        user_choice = ask(f'{len(existed)} destination files already exist, overwrite all? (y/n)')
+        if user_choice.lower() != 'y':
+            return 1
+
+    cache = None
+    if args.cache is not None:
+        cache = open_cache(args, jobs[0].o)
+        for job in jobs:
+            job.cache_entry = cache.get(job)
+
+    workers = max(1, min(args.jobs or os.cpu_count() or 1, len(jobs)))
+    log(f'Batch files: \t{len(jobs)}')
+    if args.pipeline:
+        pipeline = BatchPipeline(args.io_workers, workers, args.io_workers, args.queue_depth)
+        log(f'Pipeline: \t{args.io_workers} read, {workers} build, {args.io_workers} write threads, '
+            f'queue depth {args.queue_depth}')
+    else:
+        log(f'Workers: \t{workers}')
+    log('-'*30)
+
+    start_time = time.perf_counter()
+    failed = []
+    jobs_by_input = {job.i: job for job in jobs}
+
+    def _report(result):
+        in_path, status, message, entry, report = result
+        if cache is not None:
+            cache.put(jobs_by_input[in_path], entry)
+        if report is not None:
+            RunMetrics.write_report(args.report, [report])
+        if status == 0:
+            log(f'[ OK ] {in_path} -> {message}')
+        else:
+            log(f'[FAIL] {in_path}: {message}')
+            failed.append(in_path)
+
+    if args.pipeline:
+        pipeline.run(jobs, _report)
+    elif workers == 1:
+        for job in jobs:
+            _report(_run_batch_job(job))
+    else:
+        with concurrent_futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(_run_batch_job, job) for job in jobs]
+            for future in concurrent_futures.as_completed(futures):
+                _report(future.result())
+
+    if cache is not None:
+        cache.save()
+
+    elapsed = time.perf_counter() - start_time
+    log('-'*30)
+    log(f'Total: {len(jobs)}, success: {len(jobs) - len(failed)}, '
+          f'failed: {len(failed)}, time: {elapsed:.2f} s')
+    for in_path in sorted(failed):
+        log(f'  failed: {in_path}')
+    if args.pipeline:
+        log(f'{"stage":<8}{"threads":>8}{"files":>8}{"busy s":>10}{"util":>8}{"blocked s":>11}')
+        for stage, threads, items, busy, utilization, blocked in pipeline.utilization():
+            log(f'{stage:<8}{threads:>8}{items:>8}{busy:>10.2f}{utilization:>8.0%}{blocked:>11.2f}')
+
+    return 1 if failed else 0
+
+
+def run_job(args, log=print, ask=input, pdf_pool=None):
+    """Run the verified args of a command line, return the exit status"""
+    if args.profile:
+        if args.batch and args.jobs != 1:
+            log('Note: the profile only covers this process, use -j 1 to profile batch jobs')
+        return run_profiled(args.profile, args.profiler,
+                            lambda: _run_job(args, log, ask, pdf_pool), log)
+    return _run_job(args, log, ask, pdf_pool)
+
+
+def _run_job(args, log, ask, pdf_pool):
+
+    log('\n' + '-'*30)
+    log(f'Process mode: \t{args.mode}')
+    log(f'Input file: \t{args.i}')
+    if args.mode == Constant.MERGE:
+        log(f'Merge files: \t{len(args.parts)}')
+    if args.batch:
+        status = run_batch(args, log, ask)
+        log('-'*30 + '\n')
+        return status
+
+    if args.mode in [Constant.ADD, Constant.SYNC, Constant.FORMAT_ADD]:
+        log(f'Bookmark file: \t{args.bmk}')
+    log(f'Output file: \t{args.o}')
+
+    cache = open_cache(args, args.o) if args.cache is not None else None
+
+    def _run():
+        if cache is not None:
+            return run_cached_job(args, cache.get(args), log=log, pdf_pool=pdf_pool)
+        return process_file(args, log=log, pdf_pool=pdf_pool), None
+
+    try:
+        (note, entry), report = run_measured(args, _run)
+    except Exception as e:
+        if getattr(e, 'report', None) is not None:
+            RunMetrics.write_report(args.report, [e.report])
+        raise
+    if report is not None:
+        RunMetrics.write_report(args.report, [report])
+    if cache is not None:
+        cache.put(args, entry)
+        cache.save()
+
+    log('-'*30 + '\n')
+    return 0
+
+
+if __name__ == "__main__":
+
+    args = get_cmd_args()
+    sys.exit(run_job(args))
     
     
 # def shell():
@@ -0,0 +1,72 @@
+import os
+import sys
+
+import pytest
+
+pikepdf = pytest.importorskip('pikepdf')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import generate_case_lines, generate_case_pdf, outline_counts
+from bookmark_tool import BookmarkNode, Constant, OutlineBackend
+
+# 与 benchmark.py backends 相同的往返与 /Count 对比, 用很小的合成 pdf;
+# deep 超过 Constant.PIKEPDF_MAX_DEPTH, pikepdf 后端改由 objects 后端读写
+CASES = [
+    {'name': 'small', 'pages': 20, 'nodes': 60, 'max_level': 3, 'named': False},
+    {'name': 'named', 'pages': 20, 'nodes': 60, 'max_level': 3, 'named': True},
+    {'name': 'deep', 'pages': 10, 'nodes': Constant.PIKEPDF_MAX_DEPTH + 50,
+     'max_level': Constant.PIKEPDF_MAX_DEPTH + 20, 'named': False},
+]
+
+BACKENDS = sorted(OutlineBackend.BACKENDS)
+
+
+def _read(pdf, backend):
+    tree = BookmarkNode(title='Root')
+    tree.load_from_pdf(pdf, backend)
+    return tree.convert_to_txt()
+
+
+@pytest.fixture(params=CASES, ids=[case['name'] for case in CASES])
+def case_pdf(request, tmp_path):
+    case = request.param
+    lines = generate_case_lines(case['nodes'], case['pages'], case['max_level'])
+    pdf_path = str(tmp_path / f'{case["name"]}.pdf')
+    generate_case_pdf(pdf_path, case, lines)
+    return pdf_path, lines
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_read(case_pdf, backend):
+    pdf_path, lines = case_pdf
+    expected = BookmarkNode(title='Root')
+    expected.load_from_text(lines)
+    with pikepdf.open(pdf_path) as pdf:
+        assert _read(pdf, backend) == expected.convert_to_txt()
+
+
+def test_write_round_trip(case_pdf, tmp_path):
+    pdf_path, lines = case_pdf
+    tree = BookmarkNode(title='Root')
+    tree.load_from_text(lines)
+    # 写入两次, 第二次追加到已有的大纲
+    twice = BookmarkNode(title='Root')
+    twice.load_from_text(lines + lines)
+    expected_txt = twice.convert_to_txt()
+
+    counts = {}
+    for backend in BACKENDS:
+        out_path = str(tmp_path / f'out_{backend}.pdf')
+        with pikepdf.open(pdf_path) as pdf:
+            del pdf.Root.Outlines
+            tree.add_to_pdf(pdf, backend)
+            tree.add_to_pdf(pdf, backend)
+            pdf.save(out_path)
+        with pikepdf.open(out_path) as pdf:
+            counts[backend] = outline_counts(pdf)
+            for reader in BACKENDS:
+                assert _read(pdf, reader) == expected_txt, f'written by {backend}, read by {reader}'
+
+    for backend in BACKENDS[1:]:
+        assert counts[backend] == counts[BACKENDS[0]], f'/Count of {backend} and {BACKENDS[0]}'
@@ -0,0 +1,57 @@
+import os
+import sys
+
+import pytest
+
+pikepdf = pytest.importorskip('pikepdf')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bookmark_tool import OutlineBudget, OutlineDestResolver
+
+
+def _named_dests_pdf(name_count, leaf_size):
+    """pdf with a /Dests name tree of name_count names, leaf_size names in each leaf"""
+    from pikepdf import Array, Dictionary, String
+
+    pdf = pikepdf.new()
+    pdf.add_blank_page()
+    page = pdf.pages[0].obj
+    kids = Array()
+    for start in range(0, name_count, leaf_size):
+        names = Array()
+        for n in range(start, min(start + leaf_size, name_count)):
+            names.append(String(f'd{n:08d}'))
+            names.append(Array([page, pikepdf.Name.Fit]))
+        kids.append(pdf.make_indirect(Dictionary(Names=names)))
+    pdf.Root.Names = Dictionary(Dests=pdf.make_indirect(Dictionary(Kids=kids)))
+    return pdf
+
+
+@pytest.mark.parametrize('leaf_size', [100, 300])
+def test_named_dests_time_limit(leaf_size):
+    # 叶节点大小不是 CHECK_EVERY 的约数时, 耗时也须定期检查
+    pdf = _named_dests_pdf(3000, leaf_size)
+    budget = OutlineBudget(time_limit=1e-9)
+    with budget.activate():
+        named_dests = OutlineDestResolver.get_named_dests(pdf)
+    assert len(named_dests) < 3000
+    assert any('time limit' in problem for problem in budget.problems)
+
+
+def test_named_dests_max_nodes():
+    pdf = _named_dests_pdf(3000, 100)
+    budget = OutlineBudget(max_nodes=500)
+    with budget.activate():
+        named_dests = OutlineDestResolver.get_named_dests(pdf)
+    assert len(named_dests) < 500
+    assert any('more than 500 items' in problem for problem in budget.problems)
+
+
+def test_named_dests_within_limits():
+    pdf = _named_dests_pdf(3000, 100)
+    budget = OutlineBudget()
+    with budget.activate():
+        named_dests = OutlineDestResolver.get_named_dests(pdf)
+    assert len(named_dests) == 3000
+    assert not budget.problems
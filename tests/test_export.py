@@ -0,0 +1,65 @@
+import os
+import sys
+import random
+
+import pytest
+
+pikepdf = pytest.importorskip('pikepdf')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bookmark_tool import BookmarkNode, MyPDFHandler, OutlineBackend
+
+
+def _random_tree(node_count, page_count, seed=0):
+    """Tree with unsorted pages and pageless nodes (about one in five)"""
+    rnd = random.Random(seed)
+    tree = BookmarkNode(title='Root')
+    path = [tree]
+    for i in range(node_count):
+        level = rnd.randint(1, min(len(path), 4))
+        del path[level:]
+        page_num = None if rnd.random() < 0.2 else rnd.randint(1, page_count)
+        path.append(path[-1].new_child(level=level, title=f't{i}', page_num=page_num))
+    return tree
+
+
+def _items(tree):
+    return [(node.level, node.title, node.page_num) for node, _ in tree.walk()]
+
+
+@pytest.fixture(scope='module')
+def outline_pdf(tmp_path_factory):
+    page_count = 40
+    pdf_path = str(tmp_path_factory.mktemp('export') / 'outline.pdf')
+    pdf = pikepdf.new()
+    for _ in range(page_count):
+        pdf.add_blank_page()
+    _random_tree(300, page_count).add_to_pdf(pdf)
+    pdf.save(pdf_path)
+    pdf.close()
+    return pdf_path, page_count
+
+
+@pytest.mark.parametrize('backend', sorted(OutlineBackend.BACKENDS))
+def test_page_range_matches_copy_to(outline_pdf, backend):
+    # 流式导出的页码范围过滤与 copy_to 的范围相同, 包括没有页码的项
+    pdf_path, page_count = outline_pdf
+    rnd = random.Random(1)
+    ranges = [(1, page_count), (1, 1), (page_count, page_count)]
+    ranges += [tuple(sorted((rnd.randint(1, page_count), rnd.randint(1, page_count))))
+               for _ in range(30)]
+
+    handler = MyPDFHandler(pdf_path, backend=backend)
+    try:
+        tree = BookmarkNode(title='Root')
+        tree.load_from_pdf(handler._MyPDFHandler__pdf_reader, backend)
+        assert list(handler.iter_outline()) == _items(tree)
+        for page_range in ranges:
+            expected = BookmarkNode(title='Root')
+            tree.copy_to(expected, page_range=page_range)
+            # copy_to 把范围之前的页码移到范围的首页, 比较时只看项
+            exported = [(level, title) for level, title, _ in handler.iter_outline(page_range=page_range)]
+            assert exported == [(level, title) for level, title, _ in _items(expected)], page_range
+    finally:
+        handler.close()
@@ -0,0 +1,88 @@
+import os
+import sys
+import sqlite3
+
+import pytest
+
+pikepdf = pytest.importorskip('pikepdf')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bookmark_tool import BookmarkNode, OutlineIndex
+
+TITLES = ['第一章 总论', '第二章 数据结构', '数据 与 算法', '附录A 索引', 'Appendix B', 'a 标', '标题']
+
+
+def _write_pdf(path, titles):
+    pdf = pikepdf.new()
+    pdf.add_blank_page()
+    tree = BookmarkNode(title='Root')
+    for title in titles:
+        tree.new_child(level=1, title=title, page_num=1)
+    tree.add_to_pdf(pdf)
+    pdf.save(path)
+    pdf.close()
+
+
+def _expected(titles, query):
+    terms = query.casefold().split()
+    return [title for title in titles if all(term in title.casefold() for term in terms)]
+
+
+@pytest.fixture
+def index_dir(tmp_path):
+    lib_dir = tmp_path / 'lib'
+    lib_dir.mkdir()
+    _write_pdf(str(lib_dir / 'a.pdf'), TITLES)
+    return tmp_path, lib_dir
+
+
+def _search(index, query):
+    return [title for _, _, _, title in index.search(query, 100)]
+
+
+@pytest.mark.parametrize('query', ['章', '数据', '标', '标题', 'a', 'A 索引', '第二章 结构', 'pp b'])
+def test_short_terms(index_dir, query):
+    tmp_path, lib_dir = index_dir
+    index = OutlineIndex(str(tmp_path / 'index.db'))
+    try:
+        index.update(str(lib_dir), 1, log=lambda *a, **k: None)
+        assert _search(index, query) == _expected(TITLES, query)
+    finally:
+        index.close()
+
+
+def test_short_terms_after_update(index_dir):
+    # 重新提取的文件须从 bookmarks_grams 中删除原来的标题
+    tmp_path, lib_dir = index_dir
+    index = OutlineIndex(str(tmp_path / 'index.db'))
+    try:
+        index.update(str(lib_dir), 1, log=lambda *a, **k: None)
+        titles = ['数据库', '索引']
+        _write_pdf(str(lib_dir / 'a.pdf'), titles)
+        os.utime(str(lib_dir / 'a.pdf'), ns=(0, 1))
+        index.update(str(lib_dir), 1, log=lambda *a, **k: None)
+        for query in ['数据', '章', '索']:
+            assert _search(index, query) == _expected(titles, query)
+    finally:
+        index.close()
+
+
+def test_version_1_index(index_dir):
+    # 版本 1 的数据库没有 bookmarks_grams, 打开时补建
+    tmp_path, lib_dir = index_dir
+    db_path = str(tmp_path / 'index.db')
+    index = OutlineIndex(db_path)
+    index.update(str(lib_dir), 1, log=lambda *a, **k: None)
+    index.close()
+    db = sqlite3.connect(db_path)
+    db.execute('DROP TABLE bookmarks_grams')
+    db.execute('PRAGMA user_version=1')
+    db.commit()
+    db.close()
+
+    index = OutlineIndex(db_path)
+    try:
+        assert _search(index, '数据') == _expected(TITLES, '数据')
+    finally:
+        index.close()
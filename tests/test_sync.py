@@ -0,0 +1,84 @@
+import os
+import sys
+
+import pytest
+
+pikepdf = pytest.importorskip('pikepdf')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmark import generate_case_lines, generate_case_pdf, outline_counts
+from bookmark_tool import BookmarkNode, Constant, OutlineBackend
+
+# deep 超过 Constant.PIKEPDF_MAX_DEPTH, pikepdf 后端改由 objects 后端修改
+CASES = [
+    {'name': 'small', 'pages': 20, 'nodes': 80, 'max_level': 3, 'named': False},
+    {'name': 'named', 'pages': 20, 'nodes': 80, 'max_level': 3, 'named': True},
+    {'name': 'deep', 'pages': 10, 'nodes': Constant.PIKEPDF_MAX_DEPTH + 50,
+     'max_level': Constant.PIKEPDF_MAX_DEPTH + 20, 'named': False},
+]
+
+BACKENDS = sorted(OutlineBackend.BACKENDS)
+
+
+def _edit_lines(lines, pages):
+    """Rename, move and delete leaf lines, insert new leaves after some of the lines"""
+    levels = [len(line) - len(line.lstrip('\t')) for line in lines] + [0]
+    edited = []
+    for i, line in enumerate(lines):
+        indent, rest = line[:levels[i]], line[levels[i]:]
+        title, page = rest.rstrip('\n').rsplit('\t', 1)
+        is_leaf = levels[i + 1] <= levels[i]
+        if is_leaf and i % 11 == 3:
+            continue
+        if i % 7 == 2:
+            title += ' (edited)'
+        if i % 5 == 1:
+            page = str(int(page) % pages + 1)
+        edited.append(f'{indent}{title}\t{page}\n')
+        if is_leaf and i % 13 == 5:
+            edited.append(f'{indent}new {i}\t{pages}\n')
+    return edited
+
+
+@pytest.fixture(params=CASES, ids=[case['name'] for case in CASES])
+def case_pdf(request, tmp_path):
+    case = request.param
+    lines = generate_case_lines(case['nodes'], case['pages'], case['max_level'])
+    pdf_path = str(tmp_path / f'{case["name"]}.pdf')
+    generate_case_pdf(pdf_path, case, lines)
+    return pdf_path, _edit_lines(lines, case['pages'])
+
+
+def test_sync(case_pdf, tmp_path):
+    pdf_path, lines = case_pdf
+    tree = BookmarkNode(title='Root')
+    tree.load_from_text(lines)
+    expected_txt = tree.convert_to_txt()
+
+    results = {}
+    for backend in BACKENDS:
+        out_path = str(tmp_path / f'out_{backend}.pdf')
+        with pikepdf.open(pdf_path) as pdf:
+            edits = tree.sync_to_pdf(pdf, backend)
+            pdf.save(out_path)
+        assert edits and not edits[0].startswith('*'), backend
+        with pikepdf.open(out_path) as pdf:
+            results[backend] = (edits, outline_counts(pdf))
+            for reader in BACKENDS:
+                read = BookmarkNode(title='Root')
+                read.load_from_pdf(pdf, reader)
+                assert read.convert_to_txt() == expected_txt, f'synced by {backend}, read by {reader}'
+
+    for backend in BACKENDS[1:]:
+        assert results[backend] == results[BACKENDS[0]], f'{backend} and {BACKENDS[0]}'
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_sync_unchanged(case_pdf, backend):
+    # 相同的书签树不修改任何大纲项
+    pdf_path, _ = case_pdf
+    with pikepdf.open(pdf_path) as pdf:
+        tree = BookmarkNode(title='Root')
+        tree.load_from_pdf(pdf, backend)
+        assert tree.sync_to_pdf(pdf, backend) == []